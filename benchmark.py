@@ -0,0 +1,430 @@
+#! /usr/bin/env python
+"""
+Benchmarks of tarcheck.
+
+Example:
+
+$python benchmark.py --small_files 20000 --large_files 4
+
+It writes a directory of small and large files to a temporary directory and times checksumming them
+with the original read loop (text mode, a new 1 MiB string for every read) and with tarcheck's hashing core
+(a reused buffer filled with readinto, memory mapping for large files), optionally with other algorithms.
+
+$python benchmark.py --suite --output results.json [--baseline earlier-results.json]
+
+It generates synthetic trees - many tiny files, a few huge files, a deep hierarchy, hard links - archives each of
+them uncompressed and compressed with gzip, bzip2 and xz, and times the inventory check, the checksum comparison and
+the full verification of each archive, each in its own process. The throughput (MB/s and files/s) and peak memory
+use of every run are printed and saved as JSON. Given the results of an earlier run, e.g. of the version in
+production, it reports the runs that have become slower or use more memory.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from distutils.spawn import find_executable
+
+import tarcheck
+
+# The format of the JSON results of the suite
+RESULTS_FORMAT = 'tarcheck-benchmark'
+RESULTS_VERSION = 1
+
+# The parts of tarcheck timed on every archive of the suite
+STAGES = ('inventory', 'checksum', 'verify')
+
+# The compressions of the archives of the suite, with the tarfile mode writing them (xz is written by the xz command)
+COMPRESSIONS = (('none', 'w'), ('gz', 'w:gz'), ('bz2', 'w:bz2'), ('xz', None))
+
+
+def checksum_with_read_loop(raw_file_path, block_size=2 ** 20):
+    """
+    The checksumming of raw files before the hashing core was reworked, as a baseline.
+    :param raw_file_path: str - The path to the raw file to checksum
+    :param block_size: int - The size of the blocks to be read and checksumed
+    :return: checksum: string - The checksum as a string
+    """
+    md5 = hashlib.md5()
+    with open(raw_file_path) as raw_file:
+        while True:
+            data = raw_file.read(block_size)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def write_test_files(dir_path, small_files, small_file_size, large_files, large_file_size):
+    """
+    :param dir_path: str - The directory to write the files in
+    :return: paths: list - The paths of the files written
+    """
+    paths = []
+    for number in xrange(small_files):
+        paths.append(os.path.join(dir_path, 'small-%d' % number))
+        with open(paths[-1], 'wb') as small_file:
+            small_file.write(os.urandom(small_file_size))
+    block = os.urandom(2 ** 20)
+    for number in xrange(large_files):
+        paths.append(os.path.join(dir_path, 'large-%d' % number))
+        with open(paths[-1], 'wb') as large_file:
+            for _ in xrange(large_file_size // len(block)):
+                large_file.write(block)
+    return paths
+
+
+def time_checksums(checksum, paths, repeats):
+    """
+    :param checksum: callable - Checksums the file at the path it's given
+    :param paths: list - The files to checksum
+    :param repeats: int - The number of times to checksum all the files
+    :return: seconds: float - The fastest time to checksum all the files
+    """
+    best = None
+    for _ in xrange(repeats):
+        start = time.time()
+        for path in paths:
+            checksum(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def write_tiny_files(dir_path, scale):
+    """
+    Many tiny files, a hundred per directory.
+    """
+    for number in xrange(int(20000 * scale)):
+        subdir_path = os.path.join(dir_path, 'dir-%d' % (number // 100))
+        if number % 100 == 0:
+            os.mkdir(subdir_path)
+        with open(os.path.join(subdir_path, 'file-%d' % number), 'wb') as tiny_file:
+            tiny_file.write(os.urandom(1024))
+
+
+def write_huge_files(dir_path, scale):
+    """
+    A few huge files.
+    """
+    block = os.urandom(2 ** 20)
+    for number in xrange(2):
+        with open(os.path.join(dir_path, 'huge-%d' % number), 'wb') as huge_file:
+            for _ in xrange(max(1, int(128 * scale))):
+                huge_file.write(block)
+
+
+def write_deep_tree(dir_path, scale):
+    """
+    A deep hierarchy of directories, with a few small files in each.
+    """
+    for branch in xrange(max(1, int(20 * scale))):
+        path = os.path.join(dir_path, 'branch-%d' % branch)
+        for depth in xrange(50):
+            path = os.path.join(path, 'level-%d' % depth)
+            os.makedirs(path)
+            for number in xrange(3):
+                with open(os.path.join(path, 'file-%d' % number), 'wb') as small_file:
+                    small_file.write(os.urandom(4096))
+
+
+def write_hard_links(dir_path, scale):
+    """
+    Files with several hard links each, as in trees of reference data.
+    """
+    os.mkdir(os.path.join(dir_path, 'data'))
+    os.mkdir(os.path.join(dir_path, 'links'))
+    for number in xrange(int(1000 * scale)):
+        file_path = os.path.join(dir_path, 'data', 'file-%d' % number)
+        with open(file_path, 'wb') as linked_file:
+            linked_file.write(os.urandom(64 * 1024))
+        for link in xrange(3):
+            os.link(file_path, os.path.join(dir_path, 'links', 'file-%d-%d' % (number, link)))
+
+
+# The synthetic trees of the suite, by name
+SCENARIOS = (
+    ('tiny-files', write_tiny_files),
+    ('huge-files', write_huge_files),
+    ('deep-tree', write_deep_tree),
+    ('hard-links', write_hard_links),
+)
+
+
+def measure_tree(dir_path):
+    """
+    :param dir_path: str - The path to a tree
+    :return: files, size: int, int - The number of paths to files in the tree, and the number of bytes they have. The
+        bytes of a file with several hard links are counted once, as they are archived and read once
+    """
+    files = size = 0
+    inodes = set()
+    for entry in tarcheck.scan_directory(dir_path):
+        if not os.path.isdir(os.path.join(dir_path, entry.path)):
+            files += 1
+            inode = (entry.stat.st_dev, entry.stat.st_ino)
+            if inode not in inodes:
+                inodes.add(inode)
+                size += entry.stat.st_size
+    return files, size
+
+
+def write_archive(dir_path, archive_path, mode):
+    """
+    Archives a tree, with the directory itself at the root of the archive.
+    :param dir_path: str - The path to the tree
+    :param archive_path: str - The path to write the archive to
+    :param mode: str - The tarfile mode to write it with, or None to compress an uncompressed archive with xz
+    :return: archive_path: str - The path to the archive, or None if it couldn't be written
+    """
+    if mode is None:
+        if not find_executable('xz'):
+            return None
+        write_archive(dir_path, archive_path[:-len('.xz')], 'w')
+        subprocess.check_call(['xz', '-T0', '-1', archive_path[:-len('.xz')]])
+        return archive_path
+    with tarfile.open(archive_path, mode) as tar:
+        tar.add(dir_path, os.path.basename(dir_path))
+    return archive_path
+
+
+def run_stage(stage, archive_path, dir_path, options):
+    """
+    Times a part of tarcheck on an archive.
+    :param stage: str - One of STAGES
+    :param archive_path: str - The path to the archive
+    :param dir_path: str - The path to the archived tree
+    :param options: dict - Keyword arguments for `tarcheck.verify_archive`
+    :return: seconds, peak_rss: float, int - The seconds it took and the peak memory use of the process in kB
+    """
+    start = time.time()
+    if stage == 'inventory':
+        tarcheck.report_missing_files(
+            tarcheck.get_all_files_in_directory_recursively(dir_path),
+            tarcheck.get_all_files_in_archive(archive_path, options.get('decompressor', tarcheck.AUTO_DECOMPRESSOR)))
+    elif stage == 'checksum':
+        tarcheck.verify_archive(archive_path, dir_path, check_inventory=False, **options)
+    else:
+        tarcheck.verify_archive(archive_path, dir_path, **options)
+    return time.time() - start, tarcheck.memory_usage()['hwm']
+
+
+def time_stage(stage, archive_path, dir_path, options, repeats):
+    """
+    Times a part of tarcheck on an archive, each time in a new Python process so that the peak memory use is its own.
+    :return: seconds, peak_rss: float, int - The fastest time of the stage, and its highest peak memory use in kB
+    """
+    best = peak_rss = None
+    for _ in xrange(repeats):
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__),
+            '--run_stage', json.dumps([stage, archive_path, dir_path, options])])
+        seconds, hwm = json.loads(output.splitlines()[-1])
+        best = seconds if best is None else min(best, seconds)
+        peak_rss = max(peak_rss, hwm)
+    return best, peak_rss
+
+
+def run_suite(work_dir, scenarios, compressions, stages=STAGES, scale=1.0, repeats=1, options=None):
+    """
+    Generates the trees and archives of the suite and times tarcheck on them.
+    :param work_dir: str - The directory to generate the trees and archives in
+    :param scenarios: list - The names of the SCENARIOS to run
+    :param compressions: list - The names of the COMPRESSIONS to run
+    :param stages: list - The STAGES to time
+    :param scale: float - The factor to scale the number and size of the generated files by
+    :param repeats: int - The number of runs of each stage to take the fastest of
+    :param options: dict - Keyword arguments for `tarcheck.verify_archive`, e.g. jobs or algorithms
+    :return: runs: list - A dict for each run: scenario, compression, stage, files, bytes, seconds, mb_per_s,
+        files_per_s and peak_rss_kb
+    """
+    runs = []
+    for scenario, write_tree in SCENARIOS:
+        if scenario not in scenarios:
+            continue
+        dir_path = os.path.join(work_dir, scenario)
+        os.mkdir(dir_path)
+        write_tree(dir_path, scale)
+        files, size = measure_tree(dir_path)
+        for compression, mode in COMPRESSIONS:
+            if compression not in compressions:
+                continue
+            archive_path = dir_path + ('.tar' if compression == 'none' else '.tar.' + compression)
+            archive_path = write_archive(dir_path, archive_path, mode)
+            if archive_path is None:
+                print "%s: skipped, %s isn't installed" % (compression, compression)
+                continue
+            for stage in stages:
+                seconds, peak_rss = time_stage(stage, archive_path, dir_path, options or {}, repeats)
+                run = {
+                    'scenario': scenario, 'compression': compression, 'stage': stage, 'files': files, 'bytes': size,
+                    'seconds': seconds, 'mb_per_s': size / float(2 ** 20) / seconds if seconds else None,
+                    'files_per_s': files / seconds if seconds else None, 'peak_rss_kb': peak_rss,
+                }
+                runs.append(run)
+                print format_run(run)
+            os.remove(archive_path)
+        shutil.rmtree(dir_path)
+    return runs
+
+
+def format_run(run):
+    """
+    :param run: dict - A run, as given by `run_suite`
+    :return: line: str - The run, for printing
+    """
+    return "%-10s %-4s %-9s %7d files %9.1f MiB %8.3fs %9.1f MB/s %10.0f files/s %8d kB peak RSS" % (
+        run['scenario'], run['compression'], run['stage'], run['files'], run['bytes'] / float(2 ** 20),
+        run['seconds'], run['mb_per_s'] or 0, run['files_per_s'] or 0, run['peak_rss_kb'])
+
+
+def get_version():
+    """
+    :return: version: str - The git commit of tarcheck, or None if it isn't in a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(tarcheck.__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(runs, baseline_runs, tolerance=0.1):
+    """
+    Finds the runs that are slower or use more memory than in an earlier version.
+    :param runs: list - The runs, as given by `run_suite`
+    :param baseline_runs: list - The runs of the earlier version
+    :param tolerance: float - The fraction by which a run may be slower or use more memory before it counts
+    :return: regressions: list - A description of each run that has regressed
+    """
+    baseline = dict(((run['scenario'], run['compression'], run['stage']), run) for run in baseline_runs)
+    regressions = []
+    for run in runs:
+        earlier = baseline.get((run['scenario'], run['compression'], run['stage']))
+        if earlier is None:
+            continue
+        name = "%s %s %s" % (run['scenario'], run['compression'], run['stage'])
+        if run['seconds'] > earlier['seconds'] * (1 + tolerance):
+            regressions.append("%s: %.3fs, was %.3fs" % (name, run['seconds'], earlier['seconds']))
+        if run['peak_rss_kb'] > earlier['peak_rss_kb'] * (1 + tolerance):
+            regressions.append("%s: %d kB peak RSS, was %d kB" % (name, run['peak_rss_kb'], earlier['peak_rss_kb']))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks tarcheck')
+    parser.add_argument('--small_files', type=int, default=10000, help='The number of small files')
+    parser.add_argument('--small_file_size', type=int, default=4096, help='The size of the small files in bytes')
+    parser.add_argument('--large_files', type=int, default=2, help='The number of large files')
+    parser.add_argument('--large_file_size', type=int, default=2 ** 28,
+                        help='The size of the large files in bytes (a multiple of 1 MiB)')
+    parser.add_argument('--algorithms', type=tarcheck.parse_algorithms, default=tarcheck.DEFAULT_ALGORITHMS,
+                        help='Comma separated checksum algorithms for tarcheck to use (default: md5)')
+    parser.add_argument('--repeats', type=int,
+                        help='The number of runs to take the fastest of (default: 3, or 1 for the suite)')
+    parser.add_argument('--suite', action='store_true',
+                        help='Run the suite of synthetic trees and archives rather than the checksumming benchmark')
+    parser.add_argument('--scenarios', type=lambda names: names.split(','), default=[name for name, _ in SCENARIOS],
+                        help='Comma separated scenarios of the suite to run (default: all of %s)'
+                             % ', '.join(name for name, _ in SCENARIOS))
+    parser.add_argument('--compressions', type=lambda names: names.split(','),
+                        default=[name for name, _ in COMPRESSIONS],
+                        help='Comma separated compressions of the archives of the suite (default: all of %s)'
+                             % ', '.join(name for name, _ in COMPRESSIONS))
+    parser.add_argument('--stages', type=lambda names: names.split(','), default=list(STAGES),
+                        help='Comma separated parts of tarcheck to time (default: all of %s)' % ', '.join(STAGES))
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Factor to scale the number and size of the files of the suite by (default: 1)')
+    parser.add_argument('--jobs', type=int, default=1, help='The number of threads checksumming raw files')
+    parser.add_argument('--work_dir', help='The directory to generate the suite in (default: a temporary directory)')
+    parser.add_argument('--output', help='The path to save the results of the suite to, as JSON')
+    parser.add_argument('--baseline', help='The results of an earlier run of the suite to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='The fraction by which a run may be slower or use more memory than in the baseline '
+                             'before it is reported (default: 0.1)')
+    # Used by the suite to run each stage in a process of its own:
+    parser.add_argument('--run_stage', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.repeats is None:
+        args.repeats = 1 if args.suite else 3
+    return args
+
+
+def run_checksum_benchmark(args):
+    temp_directory = tempfile.mkdtemp()
+    try:
+        paths = write_test_files(
+            temp_directory, args.small_files, args.small_file_size, args.large_files, args.large_file_size)
+        small_paths = paths[:args.small_files]
+        large_paths = paths[args.small_files:]
+        for name, files in (('small files', small_paths), ('large files', large_paths)):
+            if not files:
+                continue
+            baseline = time_checksums(checksum_with_read_loop, files, args.repeats)
+            reworked = time_checksums(
+                lambda path: tarcheck.checksum_raw_file(path, args.algorithms), files, args.repeats)
+            size = sum(os.path.getsize(path) for path in files) / float(2 ** 20)
+            print "%s (%d, %.1f MiB): read loop %.3fs (%.1f MiB/s), tarcheck %.3fs (%.1f MiB/s), speedup %.2fx" % (
+                name, len(files), size, baseline, size / baseline, reworked, size / reworked, baseline / reworked)
+    finally:
+        shutil.rmtree(temp_directory)
+
+
+def run_suite_benchmark(args):
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        runs = run_suite(work_dir, args.scenarios, args.compressions, args.stages, args.scale, args.repeats,
+                         {'jobs': args.jobs, 'algorithms': tarcheck.get_algorithms_name(args.algorithms)})
+    finally:
+        shutil.rmtree(work_dir)
+
+    results = {
+        'format': RESULTS_FORMAT,
+        'version': RESULTS_VERSION,
+        'tarcheck': get_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'time': time.time(),
+        'options': {'scale': args.scale, 'repeats': args.repeats, 'jobs': args.jobs,
+                    'algorithms': tarcheck.get_algorithms_name(args.algorithms)},
+        'runs': runs,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('options') != results['options']:
+            print "Warning: the baseline was run with other options: %s" % baseline.get('options')
+        regressions = compare_results(runs, baseline['runs'], args.tolerance)
+        if regressions:
+            print "Regressions since %s:" % (baseline.get('tarcheck') or args.baseline)
+            for regression in regressions:
+                print regression
+            sys.exit(1)
+        print "No regressions since %s" % (baseline.get('tarcheck') or args.baseline)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.run_stage:
+        stage, archive_path, dir_path, options = json.loads(args.run_stage)
+        if 'algorithms' in options:
+            options['algorithms'] = tarcheck.parse_algorithms(options['algorithms'])
+        print json.dumps(run_stage(stage, str(archive_path), str(dir_path), options))
+    elif args.suite:
+        run_suite_benchmark(args)
+    else:
+        run_checksum_benchmark(args)
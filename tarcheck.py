@@ -41,7 +41,7 @@ where:
 It gives an error if there are files in the archive that can't be found in the directory
 given as input.
 
-It uses < 100MB memory to run.
+It uses < 100MB memory to run with the default --inventory_memory, however many files the archive has.
 
 """
 
@@ -54,9 +54,318 @@ import hashlib
 import fnmatch
 import re
 import logging
+import collections
+import contextlib
+import bz2
+import zlib
+import subprocess
+import multiprocessing
+import sqlite3
+import time
+import json
+import threading
+import stat
+import heapq
+import tempfile
+import resource
+import signal
+import Queue
+import mmap
+import ctypes
+import ctypes.util
+import itertools
+import math
+from multiprocessing.pool import ThreadPool
+from distutils.spawn import find_executable
 
+# Optional fast non-cryptographic hashes
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
 
-def calculate_md5(file_obj, block_size=2 ** 20):
+# os.scandir, or its backport for the Pythons that don't have it
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# The size of the blocks files are read and checksummed in, unless they are smaller than that
+DEFAULT_BLOCK_SIZE = 2 ** 20
+# Raw files at least this big are memory mapped rather than read
+MMAP_MIN_SIZE = 2 ** 24
+
+# The memory the paths of an inventory may take up before they are sorted and written to disk, in bytes. About seven
+# times this is kept in all (see the README), which keeps a run with the default under 100MB
+INVENTORY_MEMORY = 2 ** 23
+# The number of files missing from either side of an inventory (or of a comparison of archives) listed in its report,
+# at most
+MAX_REPORTED_PATHS = 1000
+# Roughly how much memory a path takes up on top of its characters, and a stat that is kept, in bytes
+_PATH_OVERHEAD = 48
+_STAT_OVERHEAD = 256
+
+
+# The buffer each thread reads files into, reused for every file
+_read_buffers = threading.local()
+
+# posix_fadvise(fd, offset, length, advice), from the C library for the Pythons that don't have os.posix_fadvise
+_posix_fadvise = getattr(os, 'posix_fadvise', None)
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+POSIX_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+if _posix_fadvise is None and sys.platform.startswith('linux'):
+    try:
+        _posix_fadvise = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6').posix_fadvise64
+        _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    except (OSError, AttributeError):
+        _posix_fadvise = None
+
+
+class Stats(object):
+    """
+    Cumulative time, bytes, calls and peak memory use of each stage of a verification, e.g. decompression, the
+    checksumming of the archived and of the raw files, the scan of the directory or the inventory check.
+
+    The time of a stage is exclusive: while a stage runs inside another (e.g. decompression while an archived file is
+    checksummed), it only counts towards the inner one. The stages run by several threads - the checksumming of the
+    raw files - have the time of all the threads summed up. The memory use is the highest resident set size sampled
+    at the end of the stage, the first time it ends and then at most every `rss_interval` seconds.
+
+    The stats are only collected once enabled: until then, the stages cost a method call each.
+    """
+
+    def __init__(self, rss_interval=0.1):
+        """
+        :param rss_interval: float - The minimum number of seconds between samples of the memory use
+        """
+        self.enabled = False
+        self.rss_interval = rss_interval
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._progress = None
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the stats collected so far.
+        """
+        with self._lock:
+            # The [seconds, bytes, calls, peak RSS] of each stage, by name
+            self._stages = {}
+            self._started = time.time()
+            self._rss_sampled = 0
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def stage(self, name, size=0):
+        """
+        :param name: str - The name of the stage
+        :param size: int - The number of bytes the stage deals with. It can also be set on the stage once it is known
+        :return: a context manager timing the stage
+        """
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name, size)
+
+    def timed(self, iterable, name):
+        """
+        :param iterable: iterable - Items that take a while to get, e.g. the members of an archive
+        :param name: str - The name of the stage getting them
+        :return: an iterable of the items, timing the stage of getting each one
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed(iterable, name)
+
+    def _timed(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, name, seconds=0, size=0, calls=1):
+        """
+        Adds to the stats of a stage.
+        """
+        now = time.time()
+        rss = None
+        if now - self._rss_sampled >= self.rss_interval or name not in self._stages:
+            self._rss_sampled = now
+            rss = memory_usage()['rss']
+        with self._lock:
+            stage = self._stages.setdefault(name, [0.0, 0, 0, 0])
+            stage[0] += seconds
+            stage[1] += size
+            stage[2] += calls
+            if rss is not None:
+                stage[3] = max(stage[3], rss)
+
+    def report(self):
+        """
+        :return: stats: dict - The wall clock time, the peak memory use of the process and the seconds, bytes, calls,
+            throughput and peak memory use of each stage
+        """
+        with self._lock:
+            stages = dict((name, list(stage)) for name, stage in self._stages.iteritems())
+            wall_seconds = time.time() - self._started
+        return {
+            'wall_seconds': wall_seconds,
+            'peak_rss_kb': memory_usage()['hwm'],
+            'stages': dict((name, {
+                'seconds': seconds,
+                'bytes': size,
+                'calls': calls,
+                'mb_per_s': size / float(2 ** 20) / seconds if size and seconds else None,
+                'peak_rss_kb': peak_rss or None,
+            }) for name, (seconds, size, calls, peak_rss) in stages.iteritems()),
+        }
+
+    def format_progress(self):
+        """
+        :return: line: str - What has been done so far, for a progress line
+        """
+        with self._lock:
+            stages = dict((name, list(stage)) for name, stage in self._stages.iteritems())
+            elapsed = time.time() - self._started
+        _, archive_bytes, members, _ = stages.get('archive_headers', (0, 0, 0, 0))
+        _, decompressed_bytes, _, _ = stages.get('decompress', (0, 0, 0, 0))
+        _, raw_bytes, raw_files, _ = stages.get('raw_checksum', (0, 0, 0, 0))
+        return "Progress: %.0fs, %d members of the archive, %.1f MB decompressed (%.1f MB/s), %d raw files " \
+               "checksummed (%.1f MB), %d kB RSS" % (
+                   elapsed, members, decompressed_bytes / 1e6, decompressed_bytes / 1e6 / max(elapsed, 1e-3),
+                   raw_files, raw_bytes / 1e6, memory_usage()['rss'])
+
+    def start_progress(self, interval, output=None):
+        """
+        Writes a progress line every `interval` seconds, until `stop_progress` is called.
+        :param interval: float - The number of seconds between progress lines
+        :param output: file - Where to write the progress lines (stderr by default)
+        """
+        self.stop_progress()
+        stopped = threading.Event()
+        output = output or sys.stderr
+
+        def write_progress():
+            while not stopped.wait(interval):
+                output.write(self.format_progress() + '\n')
+                output.flush()
+        thread = threading.Thread(target=write_progress)
+        thread.daemon = True
+        thread.start()
+        self._progress = (thread, stopped)
+
+    def stop_progress(self):
+        if self._progress:
+            thread, stopped = self._progress
+            stopped.set()
+            thread.join()
+            self._progress = None
+
+    def _stack(self):
+        """
+        :return: stack: list - The stages running in this thread, innermost last
+        """
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+
+class _Stage(object):
+    """
+    Times a stage of a verification, as the context manager given by `Stats.stage`.
+    """
+
+    def __init__(self, stats, name, size):
+        self.stats = stats
+        self.name = name
+        self.size = size
+        self._seconds = 0.0
+        self._resumed = None
+
+    def __enter__(self):
+        stack = self.stats._stack()
+        now = time.time()
+        if stack:
+            # The stage this one runs in is paused
+            stack[-1]._seconds += now - stack[-1]._resumed
+        stack.append(self)
+        self._resumed = now
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        stack = self.stats._stack()
+        now = time.time()
+        self._seconds += now - self._resumed
+        stack.pop()
+        if stack:
+            stack[-1]._resumed = now
+        self.stats.add(self.name, self._seconds, self.size)
+
+
+class _NoStage(object):
+    """
+    Stands in for a stage when the stats aren't enabled. It is shared by every thread, so the size set on it is
+    ignored rather than kept.
+    """
+
+    @property
+    def size(self):
+        return 0
+
+    @size.setter
+    def size(self, size):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+# The stats of the verifications of this process, collected once enabled (see --stats and --progress)
+STATS = Stats()
+
+
+class _TimedReader(object):
+    """
+    Read-only file object timing the reads from another one as the decompression stage.
+    """
+
+    def __init__(self, file_obj, name='decompress'):
+        self._file_obj = file_obj
+        self._name = name
+
+    def read(self, size=-1):
+        with STATS.stage(self._name) as stage:
+            data = self._file_obj.read(size)
+            stage.size = len(data)
+        return data
+
+
+def calculate_md5(file_obj, block_size=DEFAULT_BLOCK_SIZE):
     """
     :param file_obj: file - The file object to checksum
     :param block_size: int - The size of the blocks to be read and checksumed
@@ -65,130 +374,3681 @@ def calculate_md5(file_obj, block_size=2 ** 20):
     if not file_obj:
         raise ValueError("Missing file argument!")
     md5 = hashlib.md5()
+    _update_hashes(file_obj, [md5], block_size)
+    return md5.hexdigest()
+
+
+def get_block_size(file_size, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    :param file_size: int - The size of the file to be read
+    :param block_size: int - The largest block size
+    :return: block_size: int - The size of the blocks to read the file in: the whole file at once if it is smaller
+        than a block, so small files don't get a large block allocated for them
+    """
+    if file_size is None:
+        return block_size
+    return max(1, min(block_size, file_size))
+
+
+def _get_read_buffer(size):
+    """
+    :param size: int - The smallest size the buffer needs to have
+    :return: buffer: bytearray - The calling thread's read buffer
+    """
+    read_buffer = getattr(_read_buffers, 'buffer', None)
+    if read_buffer is None or len(read_buffer) < size:
+        read_buffer = _read_buffers.buffer = bytearray(max(size, DEFAULT_BLOCK_SIZE))
+    return read_buffer
+
+
+def _update_hashes(file_obj, hashes, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Feeds the whole of a file to several hashes. Files that can `readinto` are read into the thread's reusable
+    buffer, and the hashes are given a view of the bytes read rather than a copy of them.
+    :param file_obj: file - The file object to checksum
+    :param hashes: list - The hashlib-like objects to update
+    :param block_size: int - The size of the blocks to be read and checksumed
+    """
+    readinto = getattr(file_obj, 'readinto', None)
+    if readinto is None:
+        while True:
+            data = file_obj.read(block_size)
+            if not data:
+                break
+            for hash_obj in hashes:
+                hash_obj.update(data)
+        return
+
+    read_buffer = _get_read_buffer(block_size)
+    read_view = memoryview(read_buffer)[:block_size]
+    while True:
+        bytes_read = readinto(read_view)
+        if not bytes_read:
+            break
+        data = buffer(read_buffer, 0, bytes_read)
+        for hash_obj in hashes:
+            hash_obj.update(data)
+
+
+def _update_hashes_from_map(file_obj, hashes, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Feeds the whole of a file on disk to several hashes, by memory mapping it.
+    :param file_obj: file - The file object to checksum, which mustn't be empty
+    :param hashes: list - The hashlib-like objects to update
+    :param block_size: int - The size of the blocks the hashes are given
+    """
+    file_map = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(file_map, 'madvise'):
+            file_map.madvise(mmap.MADV_SEQUENTIAL)
+        for offset in xrange(0, len(file_map), block_size):
+            data = buffer(file_map, offset, block_size)
+            for hash_obj in hashes:
+                hash_obj.update(data)
+    finally:
+        file_map.close()
+
+
+def _advise(file_obj, advice):
+    """
+    Tells the kernel how a file is going to be used, where posix_fadvise is available. This is only a hint, so
+    failures are ignored.
+    :param file_obj: file - The file
+    :param advice: int - The advice, e.g. POSIX_FADV_SEQUENTIAL
+    """
+    if _posix_fadvise is not None:
+        try:
+            _posix_fadvise(file_obj.fileno(), 0, 0, advice)
+        except OSError:
+            pass
+
+
+class _ChecksumHash(object):
+    """
+    Gives a running checksum function, such as zlib.crc32, the interface of the hashes of hashlib.
+    """
+
+    def __init__(self, function, value=0):
+        self._function = function
+        self._value = value
+
+    def update(self, data):
+        self._value = self._function(data, self._value)
+
+    def hexdigest(self):
+        return '%08x' % (self._value & 0xffffffff)
+
+
+# The hash algorithms that checksums can be calculated with, by name. Each gives a new hashlib-like object with
+# `update` and `hexdigest` methods.
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+    'crc32': lambda: _ChecksumHash(zlib.crc32),
+    'adler32': lambda: _ChecksumHash(zlib.adler32, 1),
+}
+if xxhash is not None:
+    HASH_ALGORITHMS['xxh64'] = xxhash.xxh64
+    if hasattr(xxhash, 'xxh3_64'):
+        HASH_ALGORITHMS['xxh3'] = xxhash.xxh3_64
+if blake3 is not None:
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+if crc32c is not None:
+    HASH_ALGORITHMS['crc32c'] = lambda: _ChecksumHash(getattr(crc32c, 'crc32c', None) or crc32c.crc32)
+
+DEFAULT_ALGORITHMS = ('md5', )
+
+
+def register_hash_algorithm(name, hash_factory):
+    """
+    Makes a hash algorithm available for checksumming.
+    :param name: str - The name of the algorithm
+    :param hash_factory: callable - Gives a new hash object, with `update` and `hexdigest` methods like those of hashlib
+    """
+    HASH_ALGORITHMS[name] = hash_factory
+
+
+def get_algorithms_name(algorithms):
+    """
+    :param algorithms: list - The names of the hash algorithms
+    :return: name: str - The name of the combination of the algorithms, as recorded with their checksums
+    """
+    return ','.join(algorithms)
+
+
+def parse_algorithms(algorithms_name):
+    """
+    :param algorithms_name: str - Comma separated names of hash algorithms, e.g. "md5,sha256"
+    :return: algorithms: tuple - The names of the hash algorithms
+    """
+    algorithms = tuple(algorithm.strip().lower() for algorithm in algorithms_name.split(',') if algorithm.strip())
+    if not algorithms:
+        raise ValueError("No checksum algorithm given")
+    for algorithm in algorithms:
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError("Unknown or unavailable checksum algorithm: %s (available: %s)"
+                             % (algorithm, ", ".join(sorted(HASH_ALGORITHMS))))
+    return algorithms
+
+
+def calculate_digests(file_obj, algorithms=DEFAULT_ALGORITHMS, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Checksums a file with several hash algorithms at once, reading it only once.
+    :param file_obj: file - The file object to checksum
+    :param algorithms: list - The names of the hash algorithms to use, from HASH_ALGORITHMS
+    :param block_size: int - The size of the blocks to be read and checksumed
+    :return: checksum: string - The checksums of the file with each algorithm, in the same order, separated by commas
+    """
+    if not file_obj:
+        raise ValueError("Missing file argument!")
+    hashes = [HASH_ALGORITHMS[algorithm]() for algorithm in algorithms]
+    _update_hashes(file_obj, hashes, block_size)
+    return ','.join(hash_obj.hexdigest() for hash_obj in hashes)
+
+
+class ExclusionRules(object):
+    """
+    Any number of wildcard and regex exclusion rules, compiled once into a single matcher. A path is excluded if it
+    matches any of the rules: the whole path matches a shell wildcard, or its start matches a regex. A wildcard
+    matching a directory excludes everything in it too, so excluded directories can be pruned rather than listed.
+    """
+
+    def __init__(self, wildcards=(), regexes=()):
+        """
+        :param wildcards: list - Shell wildcards for the paths to exclude
+        :param regexes: list - Regexes for the paths to exclude
+        """
+        self.wildcards = tuple(wildcards)
+        self.regexes = tuple(regexes)
+        self._wildcard_pattern = None
+        self._regex_pattern = None
+        if self.wildcards:
+            wildcard_regexes = ['(?:%s)' % _translate_wildcard(wildcard) for wildcard in self.wildcards]
+            self._wildcard_pattern = re.compile(r'(?:%s)(?:/.*)?\Z' % '|'.join(wildcard_regexes), re.DOTALL)
+        if self.regexes:
+            for regex in self.regexes:
+                try:
+                    re.compile(regex)
+                except re.error as e:
+                    raise ValueError("Invalid exclusion regex %s: %s" % (regex, e))
+            self._regex_pattern = re.compile('|'.join('(?:%s)' % regex for regex in self.regexes))
+
+    def __nonzero__(self):
+        return bool(self.wildcards or self.regexes)
+
+    def matches(self, path):
+        """
+        :param path: str - The path to check
+        :return: excluded: bool - Whether the path is excluded by any of the rules
+        """
+        if self._wildcard_pattern is not None and self._wildcard_pattern.match(path):
+            return True
+        return self._regex_pattern is not None and self._regex_pattern.match(path) is not None
+
+
+def _translate_wildcard(wildcard):
+    """
+    :param wildcard: str - A shell wildcard
+    :return: regex: str - The regex matching what the wildcard matches, without the end anchor and flags that
+        fnmatch.translate adds, so it can be combined with other regexes
+    """
+    regex = fnmatch.translate(wildcard)
+    for suffix in ('\\Z(?ms)', '\\Z'):
+        if regex.endswith(suffix):
+            return regex[:-len(suffix)]
+    return regex
+
+
+def _as_rules(rules):
+    """
+    :param rules: str or list - None, one rule, or a list of rules
+    :return: rules: tuple - The rules
+    """
+    if not rules:
+        return ()
+    if isinstance(rules, basestring):
+        return (rules, )
+    return tuple(rules)
+
+
+# The exclusion rules compiled so far, by their wildcards and regexes
+_compiled_exclusion_rules = {}
+
+
+def get_exclusion_rules(wildcard=None, regex=None):
+    """
+    :param wildcard: str or list - Optional shell wildcard(s) for the paths to exclude
+    :param regex: str or list - Optional regex(es) for the paths to exclude
+    :return: rules: ExclusionRules - The compiled rules, compiled only the first time they are asked for
+    """
+    key = (_as_rules(wildcard), _as_rules(regex))
+    rules = _compiled_exclusion_rules.get(key)
+    if rules is None:
+        rules = _compiled_exclusion_rules[key] = ExclusionRules(*key)
+    return rules
+
+
+def read_exclusion_rules(rules_path):
+    """
+    Reads exclusion rules from a file, with one rule per line. Lines are shell wildcards, unless they start with
+    "regex:", in which case the rest of the line is a regex. Empty lines and lines starting with "#" are ignored.
+    :param rules_path: str - The path to the file
+    :return: wildcards, regexes: list, list - The rules in the file
+    """
+    wildcards = []
+    regexes = []
+    with open(rules_path) as rules_file:
+        for line in rules_file:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('regex:'):
+                regexes.append(line[len('regex:'):])
+            else:
+                wildcards.append(line)
+    return wildcards, regexes
+
+
+def is_excluded(string, wildcard=None, regex=None):
+    """
+    :param string: str - The path to check
+    :param wildcard: str or list - Optional shell wildcard(s) for the paths to exclude
+    :param regex: str or list - Optional regex(es) for the paths to exclude
+    :return: excluded: bool - Whether the path matches any of the wildcards or regexes
+    """
+    if not wildcard and not regex:
+        # No exclusion criteria, therefore not excluded
+        return False
+    return get_exclusion_rules(wildcard, regex).matches(string)
+
+
+def filter_excluded_from_list(list, exclude_wildcard=None, exclude_regex=None):
+    """
+    Filters excluded strings from the given list according to the given wildcard and regex exclusion rules.
+    :param list: the list to filter
+    :param exclude_wildcard: optional wildcard(s) to strings from list
+    :param exclude_regex: optional regex(es) to strings from list
+    :return: the filtered list
+    """
+    if not exclude_wildcard and not exclude_regex:
+        return [x for x in list]
+    rules = get_exclusion_rules(exclude_wildcard, exclude_regex)
+    return [x for x in list if not rules.matches(x)]
+
+
+# The decompression backends that can feed the tar stream:
+# - tarfile: Python's own decompression (zlib, bz2, or the tarfile module), on a single core
+# - external: an external (parallel where possible) decompressor piping the tar stream, e.g. lbzip2, pigz, xz, zstd
+# - bzip2-blocks: the built-in decoder decompressing the streams of a multi-stream bzip2 file on several processes
+# - auto: the fastest of the above that is available for the archive
+TARFILE_DECOMPRESSOR = 'tarfile'
+EXTERNAL_DECOMPRESSOR = 'external'
+BZIP2_BLOCKS_DECOMPRESSOR = 'bzip2-blocks'
+AUTO_DECOMPRESSOR = 'auto'
+DECOMPRESSORS = (AUTO_DECOMPRESSOR, TARFILE_DECOMPRESSOR, EXTERNAL_DECOMPRESSOR, BZIP2_BLOCKS_DECOMPRESSOR)
+
+_COMPRESSION_MAGIC = (
+    ('bz2', 'BZh'),
+    ('gz', '\x1f\x8b'),
+    ('xz', '\xfd7zXZ\x00'),
+    ('zst', '\x28\xb5\x2f\xfd'),
+)
+_COMPRESSION_MAGIC_BY_NAME = dict(_COMPRESSION_MAGIC)
+
+# External decompressors, in order of preference, writing the decompressed archive to stdout. "{jobs}" is replaced by
+# the number of threads to use:
+_EXTERNAL_DECOMPRESSORS = {
+    'bz2': (['lbzip2', '-d', '-c', '-n', '{jobs}'], ['pbzip2', '-d', '-c', '-p{jobs}']),
+    'gz': (['pigz', '-d', '-c', '-p', '{jobs}'], ),
+    'xz': (['xz', '-d', '-c', '-T', '{jobs}'], ),
+    'zst': (['zstd', '-d', '-c', '-q', '-T{jobs}'], ),
+}
+
+# External compressors, in order of preference, compressing stdin to stdout. "{jobs}" is replaced by the number of
+# threads to use:
+_EXTERNAL_COMPRESSORS = {
+    'bz2': (['lbzip2', '-c', '-n', '{jobs}'], ['pbzip2', '-c', '-p{jobs}']),
+    'gz': (['pigz', '-c', '-p', '{jobs}'], ),
+    'xz': (['xz', '-c', '-T', '{jobs}'], ),
+    'zst': (['zstd', '-c', '-q', '-T{jobs}'], ),
+}
+
+# Compressions that the tarfile module can't decompress by itself
+_EXTERNAL_ONLY_COMPRESSIONS = ('xz', 'zst')
+
+# The backends an archive can be compressed with when it is created: those it can be decompressed with, but for the
+# bzip2 blocks one
+COMPRESSORS = (AUTO_DECOMPRESSOR, TARFILE_DECOMPRESSOR, EXTERNAL_DECOMPRESSOR)
+
+# The compressions of archives, by the suffix of their names
+_COMPRESSION_SUFFIXES = (
+    ('.tar.bz2', 'bz2'), ('.tbz2', 'bz2'), ('.tbz', 'bz2'), ('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.tar.xz', 'xz'),
+    ('.txz', 'xz'), ('.tar.zst', 'zst'), ('.tzst', 'zst'),
+)
+
+# Byte-aligned start of a bzip2 stream: the "BZh" signature, the block size and the magic number of the first block
+_BZIP2_STREAM_HEADER = re.compile('BZh[1-9]\x31\x41\x59\x26\x53\x59')
+
+
+def detect_compression(archive_path):
+    """
+    Works out how an archive is compressed by looking at its magic number.
+    :param archive_path: str - The path to the archive
+    :return: compression: str - One of 'bz2', 'gz', 'xz', 'zst' or None if it isn't a known compression
+    """
+    with open(archive_path, 'rb') as archive:
+        header = archive.read(6)
+    for compression, magic in _COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def find_external_decompressor(compression, jobs=1):
+    """
+    Finds an installed external decompressor for the given compression.
+    :param compression: str - The compression, as returned by `detect_compression`
+    :param jobs: int - The number of threads the decompressor may use
+    :return: command: list - The command to run with the archive path appended, or None if none is installed
+    """
+    return _find_command(_EXTERNAL_DECOMPRESSORS.get(compression, ()), jobs)
+
+
+def find_external_compressor(compression, jobs=1):
+    """
+    Finds an installed external compressor for the given compression.
+    :param compression: str - The compression, one of 'bz2', 'gz', 'xz' or 'zst'
+    :param jobs: int - The number of threads the compressor may use
+    :return: command: list - The command to run, compressing stdin to stdout, or None if none is installed
+    """
+    return _find_command(_EXTERNAL_COMPRESSORS.get(compression, ()), jobs)
+
+
+def _find_command(commands, jobs):
+    """
+    :param commands: list - The commands to choose from, in order of preference
+    :param jobs: int - The number of threads the command may use, replacing "{jobs}" in its arguments
+    :return: command: list - The first command that is installed, or None if none is
+    """
+    for command in commands:
+        if find_executable(command[0]):
+            return [argument.replace('{jobs}', str(jobs)) for argument in command]
+    return None
+
+
+def get_compression_from_name(archive_path):
+    """
+    :param archive_path: str - The path to an archive
+    :return: compression: str - One of 'bz2', 'gz', 'xz', 'zst', as given by the suffix of its name, or None if it
+        isn't compressed
+    """
+    for suffix, compression in _COMPRESSION_SUFFIXES:
+        if archive_path.endswith(suffix):
+            return compression
+    return None
+
+
+def is_multistream_bzip2(archive_path, probe_size=2 ** 22):
+    """
+    Checks whether a bzip2 file is made of several streams (as written by pbzip2 or lbzip2), which is what makes it
+    possible to decompress it on several processes with the built-in decoder.
+    :param archive_path: str - The path to the bzip2 file
+    :param probe_size: int - The number of bytes at the start of the file to look for a second stream in
+    :return: bool - True if a second stream starts within the first `probe_size` bytes
+    """
+    with open(archive_path, 'rb') as archive:
+        data = archive.read(probe_size)
+    return _BZIP2_STREAM_HEADER.search(data, 1) is not None
+
+
+def choose_decompressor(archive_path, jobs=1):
+    """
+    Chooses the fastest decompression backend available for the given archive.
+    :param archive_path: str - The path to the archive
+    :param jobs: int - The number of cores decompression may use
+    :return: decompressor: str - One of the DECOMPRESSORS other than 'auto'
+    """
+    compression = detect_compression(archive_path)
+    if compression in _EXTERNAL_ONLY_COMPRESSIONS:
+        return EXTERNAL_DECOMPRESSOR
+    if compression is None or jobs <= 1:
+        return TARFILE_DECOMPRESSOR
+    if find_external_decompressor(compression, jobs):
+        return EXTERNAL_DECOMPRESSOR
+    if compression == 'bz2' and is_multistream_bzip2(archive_path):
+        return BZIP2_BLOCKS_DECOMPRESSOR
+    return TARFILE_DECOMPRESSOR
+
+
+@contextlib.contextmanager
+def open_archive_stream(archive_path, decompressor=AUTO_DECOMPRESSOR, jobs=None, archive_hash=None):
+    """
+    Opens an archive for streaming through its members, decompressing it with the given backend.
+    :param archive_path: str - The path to the archive
+    :param decompressor: str - The decompression backend, one of DECOMPRESSORS
+    :param jobs: int - The number of cores decompression may use. Defaults to all the cores of the machine
+    :param archive_hash: hashlib hash - Optional hash to update with the (compressed) bytes of the whole archive file
+        as they are read
+    :return: tar: tarfile.TarFile - The archive opened in stream mode
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if decompressor == AUTO_DECOMPRESSOR:
+        decompressor = choose_decompressor(archive_path, jobs)
+    logging.info("Decompressing %s with the %s decompressor" % (archive_path, decompressor))
+
+    if decompressor == TARFILE_DECOMPRESSOR:
+        compression = detect_compression(archive_path)
+        with _open_archive_file(archive_path, archive_hash) as archive:
+            if compression in ('gz', 'bz2'):
+                # Decompressed here rather than by tarfile, which stops at the end of the first gzip member or bzip2
+                # stream of the archive (as written by pigz, bgzip, pbzip2 or lbzip2):
+                with tarfile.open(fileobj=_timed_reader(_StreamsReader(archive, compression)), mode="r|") as tar:
+                    yield tar
+            else:
+                with tarfile.open(fileobj=_timed_reader(archive), mode="r|*") as tar:
+                    yield tar
+
+    elif decompressor == EXTERNAL_DECOMPRESSOR:
+        compression = detect_compression(archive_path)
+        command = find_external_decompressor(compression, jobs)
+        if not command:
+            raise ValueError("ERROR: No external decompressor is installed for this archive: %s" % archive_path)
+        # Errors go to a file rather than a pipe, which would block a decompressor writing more to it than the pipe
+        # holds while its output is being read:
+        stderr = tempfile.TemporaryFile()
+        if archive_hash is None:
+            process = subprocess.Popen(command + [archive_path], stdout=subprocess.PIPE, stderr=stderr)
+            feeder = None
+        else:
+            # The archive is fed to the decompressor from here, so that its bytes go through the hash:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+            feeder = threading.Thread(target=_feed_archive, args=(archive_path, archive_hash, process.stdin))
+            feeder.daemon = True
+            feeder.start()
+        try:
+            with tarfile.open(fileobj=_timed_reader(process.stdout), mode="r|") as tar:
+                yield tar
+            # Reading to the end lets the decompressor check the tail of the archive (and not die of a broken pipe):
+            while process.stdout.read(2 ** 20):
+                pass
+            if process.wait() != 0:
+                raise tarfile.ReadError("%s failed to decompress %s: %s" % (
+                    command[0], archive_path, _read_errors(stderr)))
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            if feeder:
+                feeder.join()
+            stderr.close()
+
+    elif decompressor == BZIP2_BLOCKS_DECOMPRESSOR:
+        with _open_archive_file(archive_path, archive_hash) as archive:
+            reader = ParallelBZ2Reader(archive, jobs)
+            try:
+                with tarfile.open(fileobj=_timed_reader(reader), mode="r|") as tar:
+                    yield tar
+            finally:
+                reader.close()
+
+    else:
+        raise ValueError("Unknown decompressor: %s" % decompressor)
+
+
+def _read_errors(stderr):
+    """
+    :param stderr: file - The temporary file the errors of a subprocess went to
+    :return: errors: str - The end of the errors, enough to tell what went wrong
+    """
+    stderr.seek(0, os.SEEK_END)
+    stderr.seek(max(0, stderr.tell() - 2 ** 16))
+    return stderr.read().strip()
+
+
+@contextlib.contextmanager
+def open_archive_writer(archive_path, compression=None, compressor=AUTO_DECOMPRESSOR, jobs=None, archive_hash=None):
+    """
+    Opens an archive for writing its members in turn, compressing it with the given backend.
+    :param archive_path: str - The path to the archive to write
+    :param compression: str - Optional compression, one of 'bz2', 'gz', 'xz' or 'zst'
+    :param compressor: str - The compression backend, one of COMPRESSORS: tarfile (one core, and neither xz nor
+        zstd), an external compressor (lbzip2 or pbzip2, pigz, `xz -T`, `zstd -T`) or auto (an external compressor
+        when more than one core may be used and one is installed)
+    :param jobs: int - The number of cores compression may use. Defaults to all the cores of the machine
+    :param archive_hash: hashlib hash - Optional hash to update with the (compressed) bytes of the archive file as they
+        are written
+    :return: tar: tarfile.TarFile - The archive opened in stream mode
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    command = None
+    if compression and compressor != TARFILE_DECOMPRESSOR:
+        command = find_external_compressor(compression, jobs)
+        if compressor == AUTO_DECOMPRESSOR and jobs <= 1 and compression not in _EXTERNAL_ONLY_COMPRESSIONS:
+            command = None
+        elif not command and (compressor == EXTERNAL_DECOMPRESSOR or compression in _EXTERNAL_ONLY_COMPRESSIONS):
+            raise ValueError("ERROR: No external compressor is installed for this archive: %s" % archive_path)
+    elif compression in _EXTERNAL_ONLY_COMPRESSIONS:
+        raise ValueError("ERROR: The tarfile module can't compress this archive: %s" % archive_path)
+    logging.info("Compressing %s with %s" % (archive_path, command[0] if command else 'tarfile'))
+
+    with open(archive_path, 'wb') as archive_file:
+        output = _HashingWriter(archive_file, archive_hash) if archive_hash else archive_file
+        if not command:
+            with tarfile.open(fileobj=output, mode="w|" + (compression or '')) as tar:
+                yield tar
+            return
+
+        # The compressed archive comes back through here, so that its bytes go through the hash (and errors go to a
+        # file, so that the compressor doesn't block on them):
+        stderr = tempfile.TemporaryFile()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+        copier = threading.Thread(target=_copy_stream, args=(process.stdout, output))
+        copier.daemon = True
+        copier.start()
+        try:
+            with tarfile.open(fileobj=process.stdin, mode="w|") as tar:
+                yield tar
+            process.stdin.close()
+            copier.join()
+            if process.wait() != 0:
+                raise IOError("%s failed to compress %s: %s" % (command[0], archive_path, _read_errors(stderr)))
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            stderr.close()
+            copier.join()
+
+
+def _copy_stream(source, destination):
+    """
+    Copies a stream to the given destination, until its end. Run in its own thread.
+    :param source: file - The stream to copy
+    :param destination: file - Where to write it to
+    """
     while True:
-        data = file_obj.read(block_size)
+        data = source.read(2 ** 20)
         if not data:
             break
-        md5.update(data)
-    return md5.hexdigest()
+        destination.write(data)
+
+
+def _timed_reader(file_obj):
+    """
+    :param file_obj: file - The decompressed archive
+    :return: file_obj: file - The decompressed archive, with its reads timed as decompression if the stats are enabled
+    """
+    return _TimedReader(file_obj) if STATS.enabled else file_obj
+
+
+@contextlib.contextmanager
+def _open_archive_file(archive_path, archive_hash=None):
+    """
+    Opens the archive file for reading, optionally hashing all of its bytes: those that were not read by the time the
+    caller is done are read and hashed on exit.
+    :param archive_path: str - The path to the archive
+    :param archive_hash: hashlib hash - Optional hash to update with the bytes of the archive file
+    :return: archive: file - The archive file
+    """
+    with open(archive_path, 'rb') as archive:
+        if archive_hash is None:
+            yield archive
+        else:
+            hashing_archive = _HashingReader(archive, archive_hash)
+            yield hashing_archive
+            while hashing_archive.read(2 ** 20):
+                pass
+
+
+def _feed_archive(archive_path, archive_hash, destination):
+    """
+    Copies the archive file to the given destination, hashing it on the way. Run in its own thread.
+    :param archive_path: str - The path to the archive
+    :param archive_hash: hashlib hash - The hash to update with the bytes of the archive file
+    :param destination: file - Where to write the archive to, closed at the end
+    """
+    try:
+        with open(archive_path, 'rb') as archive:
+            while True:
+                data = archive.read(2 ** 20)
+                if not data:
+                    break
+                archive_hash.update(data)
+                destination.write(data)
+    except IOError:
+        # The reading end has gone away, which is reported by the reader
+        pass
+    finally:
+        try:
+            destination.close()
+        except IOError:
+            pass
+
+
+class _HashingReader(object):
+    """
+    Read-only file object updating a hash with all the data read through it.
+    """
+
+    def __init__(self, file_obj, hash_obj):
+        self._file_obj = file_obj
+        self._hash_obj = hash_obj
+
+    def read(self, size=-1):
+        data = self._file_obj.read(size)
+        self._hash_obj.update(data)
+        return data
+
+
+class _HashingWriter(object):
+    """
+    Write-only file object updating a hash with all the data written through it.
+    """
+
+    def __init__(self, file_obj, hash_obj):
+        self._file_obj = file_obj
+        self._hash_obj = hash_obj
+
+    def write(self, data):
+        self._hash_obj.update(data)
+        self._file_obj.write(data)
+
+
+class _DigestingReader(object):
+    """
+    Read-only file object checksumming all the data read through it with the given algorithms.
+    """
+
+    def __init__(self, file_obj, algorithms=DEFAULT_ALGORITHMS):
+        self._file_obj = file_obj
+        self._hashes = [HASH_ALGORITHMS[algorithm]() for algorithm in algorithms]
+
+    def read(self, size=-1):
+        data = self._file_obj.read(size)
+        for hash_obj in self._hashes:
+            hash_obj.update(data)
+        return data
+
+    def hexdigest(self):
+        """
+        :return: checksum: str - The checksum of the data read so far, as given by `calculate_digests`
+        """
+        return ','.join(hash_obj.hexdigest() for hash_obj in self._hashes)
+
+
+def _bzip2_stream_ended(decompressor):
+    """
+    :param decompressor: bz2.BZ2Decompressor - The decompressor to check
+    :return: bool - True if the decompressor has reached the end of its stream
+    """
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        return True
+    return False
+
+
+def _decompress_bzip2_streams(data):
+    """
+    Decompresses a chunk of a bzip2 file that should be made of whole streams. Run in the worker processes of
+    `ParallelBZ2Reader`.
+    :param data: str - The compressed chunk
+    :return: decompressed: str - The decompressed data, or None if the chunk doesn't end with the end of a stream
+    """
+    decompressed = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        try:
+            decompressed.append(decompressor.decompress(data))
+        except IOError:
+            return None
+        if not _bzip2_stream_ended(decompressor):
+            return None
+        data = decompressor.unused_data
+    return ''.join(decompressed)
+
+
+def _split_bzip2_streams(file_obj, read_size=2 ** 22, max_chunk_size=2 ** 24):
+    """
+    Splits a bzip2 file into chunks starting at byte-aligned stream headers.
+    :param file_obj: file - The bzip2 file
+    :param read_size: int - The number of bytes to read at a time
+    :param max_chunk_size: int - The size after which a chunk is cut even if no stream header was found
+    :return: a generator of the compressed chunks
+    """
+    buffer = ''
+    while True:
+        data = file_obj.read(read_size)
+        if not data:
+            if buffer:
+                yield buffer
+            return
+        buffer += data
+        start = 0
+        for match in _BZIP2_STREAM_HEADER.finditer(buffer, 1):
+            yield buffer[start:match.start()]
+            start = match.start()
+        buffer = buffer[start:]
+        if len(buffer) > max_chunk_size:
+            yield buffer
+            buffer = ''
+
+
+class ParallelBZ2Reader(object):
+    """
+    Read-only file object decompressing a bzip2 file on several processes.
+
+    The file is split on the byte-aligned headers that start each bzip2 stream and the streams are decompressed by a
+    pool of processes, a bounded number at a time. This makes multi-stream files (as written by pbzip2 and lbzip2)
+    decompress on all the given cores. Inside a single stream the blocks are only bit-aligned, so a chunk that turns
+    out not to be made of whole streams is decompressed serially instead, and single-stream files decompress at the
+    speed of one core.
+    """
+
+    def __init__(self, file_obj, jobs, read_size=2 ** 22, max_chunk_size=2 ** 24, max_memory=2 ** 25):
+        """
+        :param file_obj: file - The bzip2 file to read from
+        :param jobs: int - The number of processes to decompress on
+        :param read_size: int - The number of compressed bytes to read at a time
+        :param max_chunk_size: int - The size after which a chunk is handed to a worker even if no stream header was
+            found in it
+        :param max_memory: int - The size the compressed chunks handed to the workers and not read yet may add up to,
+            in bytes, however many workers there are. At least one chunk is always handed over
+        """
+        self._pool = multiprocessing.Pool(jobs)
+        self._max_pending = 2 * jobs
+        self._max_memory = max_memory
+        self._decompressor = None
+        self._pieces = self._decompress(_split_bzip2_streams(file_obj, read_size, max_chunk_size))
+        self._piece = ''
+        self._offset = 0
+
+    def read(self, size=-1):
+        """
+        :param size: int - The maximum number of bytes to read, or a negative number to read everything left
+        :return: data: str - The decompressed data, empty at the end of the file
+        """
+        data = []
+        while size != 0:
+            if self._offset >= len(self._piece):
+                self._piece = next(self._pieces, '')
+                self._offset = 0
+                if not self._piece:
+                    break
+            end = len(self._piece) if size < 0 else min(len(self._piece), self._offset + size)
+            data.append(self._piece[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return ''.join(data)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def _decompress(self, chunks):
+        pending = collections.deque()
+        pending_size = 0
+        for chunk in chunks:
+            pending.append((chunk, self._pool.apply_async(_decompress_bzip2_streams, (chunk,))))
+            pending_size += len(chunk)
+            while len(pending) > self._max_pending or len(pending) > 1 and pending_size > self._max_memory:
+                chunk, decompressed = pending.popleft()
+                pending_size -= len(chunk)
+                for piece in self._resolve(chunk, _wait_for_result(decompressed)):
+                    yield piece
+        while pending:
+            chunk, decompressed = pending.popleft()
+            for piece in self._resolve(chunk, _wait_for_result(decompressed)):
+                yield piece
+        if self._decompressor is not None:
+            raise tarfile.ReadError("The bzip2 file ended in the middle of a stream")
+
+    def _resolve(self, chunk, decompressed):
+        """
+        Gives the decompressed data of a chunk, decompressing it serially when the worker couldn't.
+        :param chunk: str - The compressed chunk
+        :param decompressed: str - The data decompressed by the worker, None if it wasn't made of whole streams
+        :return: pieces: list - The decompressed data of the chunk
+        """
+        if self._decompressor is None:
+            if decompressed is not None:
+                return [decompressed] if decompressed else []
+            self._decompressor = bz2.BZ2Decompressor()
+
+        pieces = []
+        while chunk:
+            piece = self._decompressor.decompress(chunk)
+            if piece:
+                pieces.append(piece)
+            chunk = self._decompressor.unused_data
+            if _bzip2_stream_ended(self._decompressor):
+                # Back in step with the workers if the stream ended right at the end of the chunk:
+                self._decompressor = bz2.BZ2Decompressor() if chunk else None
+        return pieces
+
+
+class ChecksumCache(object):
+    """
+    Persistent cache of the checksums of raw files, kept in an SQLite database.
+
+    Files are identified by their device, inode, size and modification time, so a file that hasn't changed since it
+    was last checksummed doesn't need to be read again - re-verifying a directory that hasn't changed only costs a
+    stat per file. Entries are evicted, least recently used first, once there are more than `max_entries` of them,
+    and once they haven't been used for `max_age` seconds.
+    """
+
+    def __init__(self, database_path, max_entries=10 ** 7, max_age=None, batch_size=1000):
+        """
+        :param database_path: str - The path to the SQLite database, created if it doesn't exist
+        :param max_entries: int - The maximum number of checksums to keep
+        :param max_age: float - The number of seconds after which an unused checksum is evicted. Never if None
+        :param batch_size: int - The number of changes to the cache to batch in one transaction
+        """
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._batch_size = batch_size
+        self._stored = {}
+        self._used = []
+        self._connection = sqlite3.connect(database_path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS checksums ("
+            "device INTEGER, inode INTEGER, size INTEGER, mtime REAL, algorithm TEXT, checksum TEXT, "
+            "last_used REAL, PRIMARY KEY (device, inode, size, mtime, algorithm))")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS checksums_last_used ON checksums (last_used)")
+        self._connection.commit()
+
+    def get(self, raw_file_stat, algorithm='md5'):
+        """
+        :param raw_file_stat: os.stat_result - The stat of the raw file
+        :param algorithm: str - The checksum algorithm
+        :return: checksum: str - The cached checksum, or None if the file isn't in the cache or has changed since
+        """
+        key = self._key(raw_file_stat, algorithm)
+        if key in self._stored:
+            return self._stored[key]
+        row = self._connection.execute(
+            "SELECT checksum FROM checksums "
+            "WHERE device = ? AND inode = ? AND size = ? AND mtime = ? AND algorithm = ?", key).fetchone()
+        if row is None:
+            return None
+        self._used.append((time.time(), ) + key)
+        self._flush_if_full()
+        return str(row[0])
+
+    def put(self, raw_file_stat, checksum, algorithm='md5'):
+        """
+        :param raw_file_stat: os.stat_result - The stat of the raw file, taken before it was checksummed
+        :param checksum: str - The checksum of the raw file
+        :param algorithm: str - The checksum algorithm
+        """
+        self._stored[self._key(raw_file_stat, algorithm)] = checksum
+        self._flush_if_full()
+
+    def flush(self):
+        """
+        Writes the pending changes to the database.
+        """
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO checksums (device, inode, size, mtime, algorithm, checksum, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [key + (checksum, now) for key, checksum in self._stored.iteritems()])
+            self._connection.executemany(
+                "UPDATE checksums SET last_used = ? "
+                "WHERE device = ? AND inode = ? AND size = ? AND mtime = ? AND algorithm = ?", self._used)
+        self._stored = {}
+        self._used = []
+
+    def evict(self):
+        """
+        Evicts the checksums that are too old, then the least recently used ones above the maximum number of entries.
+        """
+        self.flush()
+        with self._connection:
+            if self.max_age is not None:
+                self._connection.execute("DELETE FROM checksums WHERE last_used < ?", (time.time() - self.max_age, ))
+            if self.max_entries is not None:
+                self._connection.execute(
+                    "DELETE FROM checksums WHERE rowid IN "
+                    "(SELECT rowid FROM checksums ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries, ))
+
+    def close(self):
+        """
+        Writes the pending changes, evicts the expired checksums and closes the database.
+        """
+        self.evict()
+        self._connection.close()
+
+    def _flush_if_full(self):
+        if len(self._stored) + len(self._used) >= self._batch_size:
+            self.flush()
+
+    @staticmethod
+    def _key(raw_file_stat, algorithm):
+        return (raw_file_stat.st_dev, raw_file_stat.st_ino, raw_file_stat.st_size, raw_file_stat.st_mtime, algorithm)
+
+
+class _CompletedResult(object):
+    """
+    Stands in for the asynchronous result of a pool when the result is already known.
+    """
+
+    def __init__(self, value):
+        self._value = value
+
+    def get(self):
+        return self._value
+
+
+class _FailedResult(object):
+    """
+    Stands in for the asynchronous result of a pool when it is already known to have failed.
+    """
+
+    def __init__(self, error):
+        self._error = error
+
+    def get(self):
+        raise self._error
+
+
+# Stands in for the checksum of the raw file of a hard link that can't be verified
+_UNVERIFIED_LINK = _CompletedResult((None, None))
+
+
+# The types of the members of an archive
+FILE_MEMBER = 'file'
+DIRECTORY_MEMBER = 'directory'
+SYMLINK_MEMBER = 'symlink'
+HARDLINK_MEMBER = 'hardlink'
+OTHER_MEMBER = 'other'
+
+# A member of an archive, with the checksum of its content if it is a file that has been checksummed (None otherwise).
+# Its mode, uid and gid are None when they aren't known, as for members read from an older manifest
+ArchiveMember = collections.namedtuple(
+    'ArchiveMember', ['path', 'type', 'size', 'mtime', 'linkname', 'digest', 'mode', 'uid', 'gid'])
+ArchiveMember.__new__.__defaults__ = (None, None, None)
+
+# The number of threads reading ahead raw files, and the memory the raw files read ahead may take up, in bytes
+PREFETCH_JOBS = 4
+PREFETCH_MEMORY = 2 ** 26
+
+
+class RawFilePrefetcher(object):
+    """
+    Reads ahead the raw files about to be checksummed, so that they are in the page cache by the time they are. The
+    members of the archive are looked ahead of the one being verified, up to `max_files` members and `max_bytes` of
+    raw files to read, and the kernel is told that the raw files that will be checksummed are needed (where
+    posix_fadvise isn't available, they are read instead). This is done by a few threads, so that the round trips of
+    network filesystems overlap.
+
+    The files are read ahead in batches of half the look-ahead, in the order of their inodes - usually close to the
+    order they are on disk - rather than in the order of the archive, so disks seek less. At most `max_files` of them
+    are waiting to be read ahead, or being read ahead, at a time: when the reads fall behind, the others are left to
+    the checksumming, as are those whose members have been given by the time they would be read ahead.
+    """
+
+    def __init__(self, max_files, max_bytes=PREFETCH_MEMORY, jobs=PREFETCH_JOBS):
+        """
+        :param max_files: int - The number of members to look ahead
+        :param max_bytes: int - The size the raw files read ahead, and not checksummed yet, may add up to. Larger
+            files aren't read ahead
+        :param jobs: int - The number of threads reading ahead
+        """
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._pool = ThreadPool(jobs)
+        self._slots = threading.BoundedSemaphore(max_files)
+        # The number of items given so far - the raw files of those are being, or have been, checksummed
+        self._given = 0
+
+    def look_ahead(self, items, find_raw_file):
+        """
+        :param items: iterable - The items to verify, e.g. the members of an archive
+        :param find_raw_file: callable - Given an item, gives the path and stat of the raw file it will need read, or
+            None if it won't need any
+        :return: a generator of the given items, reading ahead the raw files of those coming next
+        """
+        window = collections.deque()
+        window_bytes = 0
+        batch = []
+        for sequence, item in enumerate(items):
+            raw_file = find_raw_file(item)
+            size = raw_file[1].st_size if raw_file and raw_file[1].st_size <= self.max_bytes else 0
+            if size:
+                batch.append((sequence, raw_file))
+            window.append((item, size))
+            window_bytes += size
+            if len(window) >= self.max_files or window_bytes >= self.max_bytes:
+                self._read_ahead(batch)
+                batch = []
+                # Give items until there is room for half a window more, to be read ahead together:
+                while window and (len(window) > self.max_files // 2 or window_bytes > self.max_bytes // 2):
+                    item, size = window.popleft()
+                    window_bytes -= size
+                    self._given += 1
+                    yield item
+        self._read_ahead(batch)
+        while window:
+            self._given += 1
+            yield window.popleft()[0]
+
+    def _read_ahead(self, raw_files):
+        """
+        :param raw_files: list - The sequence number of the item, and the path and stat, of each raw file to read ahead
+        """
+        raw_files = sorted(raw_files, key=lambda (_, raw_file): (raw_file[1].st_dev, raw_file[1].st_ino))
+        for sequence, (raw_file_path, raw_file_stat) in raw_files:
+            if not self._slots.acquire(False):
+                break
+            self._pool.apply_async(self._read_ahead_raw_file, (sequence, raw_file_path, raw_file_stat.st_size))
+
+    def _read_ahead_raw_file(self, sequence, raw_file_path, size):
+        """
+        Reads ahead a raw file, unless its item has been given already.
+        """
+        try:
+            if sequence >= self._given:
+                read_ahead_raw_file(raw_file_path, size)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """
+        Stops reading ahead.
+        """
+        self._pool.terminate()
+        self._pool.join()
+
+
+def read_ahead_raw_file(raw_file_path, size):
+    """
+    Gets a raw file into the page cache, without waiting for it where the kernel can read it in the background.
+    Failures are ignored - they are reported when the file is checksummed.
+    :param raw_file_path: str - The path to the raw file
+    :param size: int - The size of the raw file
+    """
+    with STATS.stage('prefetch', size):
+        try:
+            with open(raw_file_path, 'rb') as raw_file:
+                if _posix_fadvise is not None:
+                    _advise(raw_file, POSIX_FADV_WILLNEED)
+                else:
+                    buffer = _get_read_buffer(DEFAULT_BLOCK_SIZE)
+                    while raw_file.readinto(buffer):
+                        pass
+        except EnvironmentError:
+            pass
+
+
+# The confidence of the bound on the files a sample may have missed, by default
+SAMPLE_CONFIDENCE = 0.95
+
+
+class MemberSample(object):
+    """
+    A seeded random sample of the files of an archive, to verify instead of all of them. Whether a file is in the
+    sample only depends on the seed and its path (and size), not on the order of the archive, so a sample can be
+    repeated, and is the same whether the members are read from the archive, its index or its manifest.
+
+    Each file is in the sample with probability `fraction` or, when sampling by bytes, as if each of its bytes was with
+    probability `fraction` (so the larger files are more likely to be). The members left out of the sample aren't
+    checksummed in the archive, and their raw files aren't even stat'ed. The sample also counts the files (and bytes)
+    it has been given, for the bound on the differing files it may have missed - see `get_missed_bound`.
+    """
+
+    def __init__(self, fraction, seed=0, by_bytes=False):
+        """
+        :param fraction: float - The probability of each file (or byte) to be in the sample, between 0 and 1
+        :param seed: int - The seed of the sample
+        :param by_bytes: bool - Whether to sample the bytes of the archive rather than its files
+        """
+        if not 0 < fraction <= 1:
+            raise ValueError("ERROR: The fraction of the archive to sample has to be between 0 and 1: %s" % fraction)
+        self.fraction = fraction
+        self.seed = seed
+        self.by_bytes = by_bytes
+        # The files (and their bytes) of the archive, and those in the sample
+        self.total_files = 0
+        self.total_bytes = 0
+        self.sampled_files = 0
+        self.sampled_bytes = 0
+
+    def is_sampled(self, member):
+        """
+        :param member: ArchiveMember - A file of the archive
+        :return: bool - Whether the file is in the sample. Hard links aren't, their contents being those of the files
+            they link to
+        """
+        if member.type != FILE_MEMBER:
+            return False
+        # A uniform number between 0 and 1 for the file, from its path:
+        draw = int(hashlib.md5('%s\0%s' % (self.seed, member.path)).hexdigest()[:13], 16) / float(16 ** 13)
+        if not self.by_bytes:
+            return draw < self.fraction
+        if self.fraction >= 1:
+            return member.size > 0
+        # The probability of any of the bytes of the file to be in the sample:
+        return draw < -math.expm1(member.size * math.log1p(-self.fraction))
+
+    def checksum_filter(self, checksum_filter=None):
+        """
+        :param checksum_filter: callable - Optional filter of the files to checksum, e.g.
+            `MetadataPrefilter.should_checksum`, only called for the files in the sample
+        :return: checksum_filter: callable - The filter of the files to checksum, for `iter_archive_members`
+        """
+        return lambda member: self.is_sampled(member) and (not checksum_filter or checksum_filter(member))
+
+    def select(self, members, exclude_wildcard=None, exclude_regex=None):
+        """
+        :param members: iterable - The ArchiveMember of each member of the archive
+        :param exclude_wildcard: optional wildcard for the files not to verify, left out of the counts
+        :param exclude_regex: optional regex for the files not to verify, left out of the counts
+        :return: a generator of the ArchiveMember of each file in the sample, in the order of the archive
+        """
+        rules = get_exclusion_rules(exclude_wildcard, exclude_regex)
+        for member in members:
+            if member.type != FILE_MEMBER or rules and rules.matches(member.path):
+                continue
+            self.total_files += 1
+            self.total_bytes += member.size
+            if self.is_sampled(member):
+                self.sampled_files += 1
+                self.sampled_bytes += member.size
+                yield member
+
+    def get_missed_bound(self, different_files, confidence=SAMPLE_CONFIDENCE):
+        """
+        Bounds the differing files (or bytes, when sampling by bytes) the sample may have missed: if there were more,
+        a sample would have found more than `different_files` of them with a probability of at least `confidence`.
+        When sampling by bytes, the bytes of a differing file count as differing. The bound is then exact when no
+        differing files were found, and approximate (each file found counting as a byte) otherwise.
+        :param different_files: int - The number of files of the sample found to differ
+        :param confidence: float - The confidence of the bound, between 0 and 1
+        :return: missed, rate: int, float - The upper bound on the number of differing files (or bytes) outside the
+            sample, and on their fraction of all the files (or bytes) of the archive
+        """
+        if not 0 < confidence < 1:
+            raise ValueError("ERROR: The confidence of the bound has to be between 0 and 1: %s" % confidence)
+        total, sampled = (self.total_bytes, self.sampled_bytes) if self.by_bytes else (
+            self.total_files, self.sampled_files)
+        if self.fraction >= 1 or not total:
+            return 0, 0.0
+        log_p = math.log(self.fraction)
+        log_q = math.log1p(-self.fraction)
+
+        def probability_of_finding_so_few(differing):
+            # P(at most different_files found | `differing` differing units, each found with probability `fraction`)
+            return sum(math.exp(
+                math.lgamma(differing + 1) - math.lgamma(found + 1) - math.lgamma(differing - found + 1) +
+                found * log_p + (differing - found) * log_q) for found in xrange(different_files + 1))
+
+        # The largest number of differing units that would still be found this few times often enough:
+        low, high = different_files, different_files + 1
+        while probability_of_finding_so_few(high) > 1 - confidence:
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if probability_of_finding_so_few(middle) > 1 - confidence:
+                low = middle
+            else:
+                high = middle
+        missed = min(low - different_files, total - sampled)
+        return missed, missed / float(total)
+
+    def format_report(self, different_files, confidence=SAMPLE_CONFIDENCE):
+        """
+        :param different_files: int - The number of files of the sample found to differ
+        :param confidence: float - The confidence of the bound on the differing files missed
+        :return: report: str - The size of the sample, and the bound on the differing files it may have missed
+        """
+        missed, rate = self.get_missed_bound(different_files, confidence)
+        return ("Sampled %d of %d files (%d of %d bytes) with seed %s. With %g%% confidence, at most %d %s (%.4g%% of "
+                "the archive) differ without having been found" % (
+                    self.sampled_files, self.total_files, self.sampled_bytes, self.total_bytes, self.seed,
+                    confidence * 100, missed, 'bytes' if self.by_bytes else 'files', rate * 100))
+
+
+# The statuses of the verified files: the same in the archive and the directory, with different contents (sizes or
+# checksums), or with the same contents as far as is known but different metadata (e.g. modification times)
+RESULT_OK = 'ok'
+RESULT_DIFFERENT = 'different'
+RESULT_METADATA_DIFFERENT = 'metadata different'
+# The statuses of the files whose raw files are missing from the directory or can't be read, when verifications keep
+# going after them
+RESULT_MISSING = 'missing'
+RESULT_UNREADABLE = 'unreadable'
+# The status of the hard links whose contents can't be compared, because the file they link to wasn't checksummed in
+# the archive (e.g. it was verified by an earlier run)
+RESULT_UNVERIFIED = 'unverified'
+
+# The result of the verification of a file of an archive against its raw file: its path in the archive, its size in
+# the archive, its status, the checksums of the archived and raw files (None if they weren't checksummed), the
+# differences in metadata (as given by `compare_metadata`), the error reported for the file (None if it is ok), the
+# seconds it took to read the member from the archive and the seconds it took to checksum the raw file (None if it
+# wasn't read, e.g. because its checksum was cached)
+FileResult = collections.namedtuple('FileResult', [
+    'path', 'size', 'status', 'archived_digest', 'raw_digest', 'metadata_differences', 'error', 'archive_seconds',
+    'raw_seconds'])
+
+
+class VerificationSummary(object):
+    """
+    What a verification has found besides the results of its files, once they have all been given.
+    """
+
+    def __init__(self):
+        # The number of files verified, including those verified by an earlier run
+        self.total_files = 0
+        # The errors of the files verified by an earlier run, resumed from its journal
+        self.resumed_errors = []
+        # The report of the files in the directory missing from the archive, or None if it wasn't checked
+        self.report = None
+        # Whether the verification stopped at the first file that differs, before the end of the archive
+        self.stopped = False
+
+
+def collect_errors(results, summary):
+    """
+    :param results: iterable - The FileResult of each file verified
+    :param summary: VerificationSummary - The summary of the verification, given to the function giving the results
+    :return: total_files, errors, report: int, list, str - The number of files checked, a list of files that differ
+        from the raw version and the report of files missing from the archive (None if not checked). If giving the
+        results fails, the files found to differ so far are logged before the error is raised
+    """
+    errors = []
+    try:
+        for result in results:
+            if result.error:
+                errors.append(result.error)
+    except Exception:
+        # Don't lose the differences already found when the verification fails part way through:
+        if errors:
+            logging.error("Files found to differ before the verification failed:\n%s" % "\n".join(errors))
+        raise
+    return (summary.total_files, summary.resumed_errors + errors, summary.report)
+
+
+def get_raw_file_failure(dir_path, member_path, error):
+    """
+    :param dir_path: str - The path to the archived directory
+    :param member_path: str - The path of the member in the archive
+    :param error: Exception - The error finding or reading its raw file, as raised by `resolve_raw_file_path` or
+        `checksum_raw_file`
+    :return: status, error: str, str - RESULT_MISSING or RESULT_UNREADABLE, and the error reported for the file
+    """
+    if not any(os.path.lexists(os.path.join(raw_dir_path, member_path))
+               for raw_dir_path in (dir_path, os.path.join(dir_path, os.pardir))):
+        return RESULT_MISSING, member_path + " is missing from the directory"
+    reason = error.strerror if isinstance(error, EnvironmentError) and error.strerror else "not a readable file"
+    return RESULT_UNREADABLE, "%s can't be read: %s" % (member_path, reason)
+
+
+def format_result_json(result):
+    """
+    :param result: FileResult - The result of the verification of a file
+    :return: line: str - The result as a line of JSON
+    """
+    fields = result._asdict()
+    fields['metadata_differences'] = dict(
+        (field, {'raw': raw_value, 'archived': archived_value})
+        for field, raw_value, archived_value in result.metadata_differences)
+    fields['type'] = 'file'
+    return json.dumps(fields, encoding='latin-1', sort_keys=True)
+
+
+def format_summary_json(summary, report, different_files, algorithms, metadata_fields, quick=False,
+                        sample_report=None, stats=False, error=None):
+    """
+    :param summary: VerificationSummary - The summary filled in by the verification
+    :param report: str - The report on the files of the directory that aren't in the archive, or None
+    :param different_files: int - The number of files that differ
+    :param algorithms: tuple - The checksum algorithms used
+    :param metadata_fields: str - The metadata compared
+    :param quick: bool - True if only the metadata was compared
+    :param sample_report: dict - The sample and the bound on the differing files it may have missed, or None
+    :param stats: bool - True to include the time spent in each stage of the verification
+    :param error: str - The error that ended the verification, or None if it got to the end
+    :return: line: str - The summary as a line of JSON
+    """
+    return json.dumps({
+        'type': 'summary',
+        'report': report,
+        'algorithms': get_algorithms_name(algorithms) if not quick else None,
+        'metadata': get_metadata_fields(metadata_fields, quick=quick),
+        'total_files': summary.total_files,
+        'different_files': different_files,
+        'resumed_errors': summary.resumed_errors,
+        'stopped': summary.stopped,
+        'sample': sample_report,
+        'error': error,
+        'peak_rss_kb': memory_usage()['hwm'],
+        'stats': STATS.report() if stats else None,
+    }, encoding='latin-1', sort_keys=True)
+
+
+MANIFEST_SUFFIX = '.manifest'
+MANIFEST_FORMAT = 'tarcheck-manifest'
+MANIFEST_VERSION = 1
+
+
+def compare_checksum_of_all_archived_files_with_raw_files(
+        archive_path, dir_path, exclude_wildcard=None, exclude_regex=None, jobs=1,
+        decompressor=AUTO_DECOMPRESSOR, decompress_jobs=None, checksum_cache=None, algorithms=DEFAULT_ALGORITHMS):
+    """
+    :param archive_path: str - The path to the archive
+    :param dir_path: str - The path to the archived directory
+    :param jobs: int - The number of threads checksumming raw files while the archive is being read
+    :param decompressor: str - The decompression backend, one of DECOMPRESSORS
+    :param decompress_jobs: int - The number of cores decompression may use. Defaults to all the cores
+    :param checksum_cache: ChecksumCache - Optional cache of the checksums of raw files that haven't changed
+    :param algorithms: list - The names of the hash algorithms to checksum the files with (md5 by default)
+    :return: total_files, errors: int, list - The number of files found, a list of errors found
+        in the archive and a list of files that differ from the raw version
+    """
+    total_files, errors, _ = verify_archive(
+        archive_path, dir_path, exclude_wildcard, exclude_regex, check_inventory=False, jobs=jobs,
+        decompressor=decompressor, decompress_jobs=decompress_jobs, checksum_cache=checksum_cache,
+        algorithms=algorithms)
+    return (total_files, errors)
+
+
+def verify_archive(archive_path, dir_path, *args, **kwargs):
+    """
+    Verifies an archive against the directory it was made from, as `iter_verify_archive` does, collecting the errors.
+    :param archive_path: str - The path to the archive
+    :param dir_path: str - The path to the archived directory
+    :return: total_files, errors, report: int, list, str - The number of files checked, a list of files that differ
+        from the raw version and the report of files missing from the archive (None if not checked)
+    """
+    summary = VerificationSummary()
+    return collect_errors(iter_verify_archive(archive_path, dir_path, *args, summary=summary, **kwargs), summary)
+
+
+def verify_archive_with_manifest(manifest_path, dir_path, *args, **kwargs):
+    """
+    Verifies the directory an archive was made from against the manifest of the archive, as
+    `iter_verify_archive_with_manifest` does, collecting the errors.
+    :param manifest_path: str - The path to the manifest written by `verify_archive`
+    :param dir_path: str - The path to the archived directory
+    :return: total_files, errors, report: int, list, str - As returned by `verify_archive`
+    """
+    summary = VerificationSummary()
+    return collect_errors(
+        iter_verify_archive_with_manifest(manifest_path, dir_path, *args, summary=summary, **kwargs), summary)
+
+
+def verify_archive_members(members, dir_path, *args, **kwargs):
+    """
+    Verifies the members of an archive against the directory the archive was made from, as
+    `iter_verify_archive_members` does, collecting the errors.
+    :param members: iterable - The ArchiveMember of each member of the archive
+    :param dir_path: str - The path to the archived directory
+    :return: total_files, errors, report: int, list, str - As returned by `verify_archive`
+    """
+    summary = VerificationSummary()
+    return collect_errors(iter_verify_archive_members(members, dir_path, *args, summary=summary, **kwargs), summary)
+
+
+def resolve_raw_file_path(dir_path, member_path):
+    """
+    Finds the raw file corresponding to an archive member, trying to see if only the contents of the dir was archived
+    or also the parent dir is in the archive.
+    :param dir_path: str - The path to the archived directory
+    :param member_path: str - The path of the member in the archive
+    :return: raw_file_path: str - The absolute path to the raw file
+    """
+    raw_file_path = os.path.abspath(os.path.join(dir_path, member_path))
+    if not os.path.exists(raw_file_path):
+        raw_dir_parent = os.path.abspath(os.path.join(dir_path, os.pardir))
+        raw_file_path = os.path.abspath(os.path.join(raw_dir_parent, member_path))
+        if not os.access(raw_file_path, os.R_OK):
+            err_msg = "ERROR: This user can't access all the files in this directory: %s" % raw_file_path
+            raise ValueError(err_msg)
+        if not os.path.isfile(raw_file_path):
+            err_msg = "ERROR: The directory given as input doesn't contain all the files in the archive: %s" % raw_file_path
+            raise ValueError(err_msg)
+    return raw_file_path
+
+
+def checksum_raw_file(raw_file_path, algorithms=DEFAULT_ALGORITHMS):
+    """
+    :param raw_file_path: str - The path to the raw file to checksum
+    :param algorithms: list - The names of the hash algorithms to use
+    :return: checksum: string - The checksum as a string
+    """
+    hashes = [HASH_ALGORITHMS[algorithm]() for algorithm in algorithms]
+    with STATS.stage('raw_checksum') as stage, open(raw_file_path, 'rb') as raw_file:
+        file_size = stage.size = os.fstat(raw_file.fileno()).st_size
+        if file_size < DEFAULT_BLOCK_SIZE:
+            # Read in one go - the string is no bigger than the file, and there are no blocks to reuse a buffer for:
+            data = raw_file.read()
+            for hash_obj in hashes:
+                hash_obj.update(data)
+        else:
+            _advise(raw_file, POSIX_FADV_SEQUENTIAL)
+            try:
+                if file_size >= MMAP_MIN_SIZE:
+                    _update_hashes_from_map(raw_file, hashes)
+                else:
+                    _update_hashes(raw_file, hashes)
+            finally:
+                # The file won't be read again, so it shouldn't push what else is cached out of the page cache:
+                _advise(raw_file, POSIX_FADV_DONTNEED)
+    return ','.join(hash_obj.hexdigest() for hash_obj in hashes)
+
+
+def _checksum_raw_file_timed(raw_file_path, algorithms=DEFAULT_ALGORITHMS):
+    """
+    :param raw_file_path: str - The path to the raw file to checksum
+    :param algorithms: list - The names of the hash algorithms to use
+    :return: checksum, seconds: str, float - The checksum and the number of seconds it took
+    """
+    started = time.time()
+    checksum = checksum_raw_file(raw_file_path, algorithms)
+    return checksum, time.time() - started
+
+
+def _timed_items(iterable):
+    """
+    :param iterable: iterable - Items that take a while to get, e.g. the members of an archive
+    :return: a generator of the number of seconds each item took to get, and the item
+    """
+    started = time.time()
+    for item in iterable:
+        yield time.time() - started, item
+        started = time.time()
+
+
+def get_member_type(tar_info):
+    """
+    :param tar_info: tarfile.TarInfo - The member of the archive
+    :return: type: str - The type of the member, one of FILE_MEMBER, DIRECTORY_MEMBER, SYMLINK_MEMBER, HARDLINK_MEMBER
+        or OTHER_MEMBER
+    """
+    if tar_info.isfile():
+        return FILE_MEMBER
+    if tar_info.isdir():
+        return DIRECTORY_MEMBER
+    if tar_info.issym():
+        return SYMLINK_MEMBER
+    if tar_info.islnk():
+        return HARDLINK_MEMBER
+    return OTHER_MEMBER
+
+
+def get_archive_member(tar_info, digest=None):
+    """
+    :param tar_info: tarfile.TarInfo - The member of the archive
+    :param digest: str - The checksum of its content, if it is a file that has been checksummed
+    :return: member: ArchiveMember - The member
+    """
+    return ArchiveMember(
+        tar_info.path, get_member_type(tar_info), tar_info.size, tar_info.mtime, tar_info.linkname or None, digest,
+        tar_info.mode, tar_info.uid, tar_info.gid)
+
+
+def iter_archive_members(
+        archive_path, exclude_wildcard=None, exclude_regex=None, decompressor=AUTO_DECOMPRESSOR,
+        decompress_jobs=None, archive_hash=None, only=None, algorithms=DEFAULT_ALGORITHMS, skip_members=0,
+        checksum_filter=None):
+    """
+    Streams through the members of an archive, checksumming the files that aren't excluded.
+    :param archive_path: str - The path to the archive
+    :param exclude_wildcard: optional wildcard for the files not to checksum
+    :param exclude_regex: optional regex for the files not to checksum
+    :param decompressor: str - The decompression backend, one of DECOMPRESSORS
+    :param decompress_jobs: int - The number of cores decompression may use. Defaults to all the cores
+    :param archive_hash: hashlib hash - Optional hash to update with the bytes of the whole archive file
+    :param only: list - Optional paths of the only members to give, or of the directories to give the members of
+    :param algorithms: list - The names of the hash algorithms to checksum the files with
+    :param skip_members: int - The number of members at the start of the archive not to checksum, e.g. because they
+        have already been verified. They are still given, without checksums
+    :param checksum_filter: callable - Optional filter given the ArchiveMember (without checksum) of each file about
+        to be checksummed, returning False for the files not to checksum, e.g. because they are already known to differ
+    :return: a generator of the ArchiveMember of each member, in the order they are in the archive
+    """
+    members = 0
+    with open_archive_stream(archive_path, decompressor, decompress_jobs, archive_hash) as tar:
+        for tar_info in STATS.timed(tar, 'archive_headers'):
+            # Stream mode keeps every member seen so far in tar.members - drop them to keep memory constant:
+            tar.members = []
+            if only and not is_selected(tar_info.path, only):
+                continue
+            members += 1
+
+            member = get_archive_member(tar_info)
+            if members > skip_members and tar_info.isfile() and not is_excluded(
+                    tar_info.name, exclude_wildcard, exclude_regex) and (
+                    not checksum_filter or checksum_filter(member)):
+                # Pretending to extract each file - getting back a handle, but the file isn't actually extracted:
+                archived_file_handle = tar.extractfile(tar_info)
+                if archived_file_handle:
+                    # Checksum the tared up file:
+                    with STATS.stage('archive_checksum', tar_info.size):
+                        member = member._replace(digest=calculate_digests(
+                            archived_file_handle, algorithms, get_block_size(tar_info.size)))
+            yield member
+
+
+def iter_verify_archive(
+        archive_path, dir_path, exclude_wildcard=None, exclude_regex=None, check_inventory=True, jobs=1,
+        decompressor=AUTO_DECOMPRESSOR, decompress_jobs=None, checksum_cache=None, manifest_path=None, only=None,
+        index=None, algorithms=DEFAULT_ALGORITHMS, scan_jobs=None, inventory_memory=INVENTORY_MEMORY, journal=None,
+        quick=False, metadata_fields=None, keep_going=False, fail_fast=False, prefetch_files=0,
+        prefetch_memory=PREFETCH_MEMORY, summary=None, sample=None):
+    """
+    Verifies an archive against the directory it was made from in a single streaming pass over the archive: the
+    member names are collected for the inventory check while every archived file is checksummed and compared with
+    its raw version. The metadata of each file in the archive is compared with the stat of its raw file first, and the
+    files whose sizes differ are reported without being checksummed on either side.
+
+    The result of each file is given as soon as it is known, in the order of the archive, so that nothing accumulates
+    however many files differ.
+    :param archive_path: str - The path to the archive
+    :param dir_path: str - The path to the archived directory
+    :param exclude_wildcard: optional wildcard to exclude certain files or folders
+    :param exclude_regex: optional regex to exclude certain files or folders
+    :param check_inventory: bool - Whether to also report the files in the directory that are not in the archive
+    :param jobs: int - The number of threads checksumming raw files while the archive is being read. With 1 the raw
+        files are checksummed in turn with the archive members
+    :param decompressor: str - The decompression backend, one of DECOMPRESSORS
+    :param decompress_jobs: int - The number of cores decompression may use. Defaults to all the cores
+    :param checksum_cache: ChecksumCache - Optional cache of the checksums of raw files that haven't changed. Only the
+        raw files that are new or have been modified since they were cached are read
+    :param manifest_path: str - Optional path to write the manifest of the archive to, for later runs to verify the
+        directory against with `verify_archive_with_manifest` instead of reading the archive again
+    :param only: list - Optional paths of the only members to verify, or of the directories to verify the members of.
+        The inventory isn't checked when only some members are verified
+    :param index: ArchiveIndex - Optional index of the archive, used to go straight to the `only` members to verify,
+        or past the members already verified when resuming, rather than reading through the archive
+    :param algorithms: list - The names of the hash algorithms to checksum the files with, all of which have to
+        match (md5 by default). They are all calculated with a single read of each file
+    :param scan_jobs: int - The number of directories listed at the same time when scanning the directory. Defaults
+        to `jobs`
+    :param inventory_memory: int - The memory each of the lists of paths for the inventory check may take up before
+        it is sorted on disk, in bytes
+    :param journal: VerificationJournal - Optional journal to record the verified files in, and to resume from. The
+        members it has already verified are neither checksummed nor compared again. The `only` members aren't journaled
+    :param quick: bool - Whether to only compare the metadata of the files, without checksumming them. No manifest is
+        written in quick mode
+    :param metadata_fields: list - The metadata compared, out of METADATA_FIELDS (see `get_metadata_fields`)
+    :param keep_going: bool - Whether to give the files whose raw files are missing or can't be read as results
+        (RESULT_MISSING or RESULT_UNREADABLE) and carry on, rather than raising an error
+    :param fail_fast: bool - Whether to stop at the first file that differs in any way (including missing or
+        unreadable raw files), without reading the rest of the archive. The summary is marked as stopped, and the
+        inventory isn't checked
+    :param prefetch_files: int - The number of members to look ahead of the one being verified, reading ahead the raw
+        files that will be checksummed (none by default). See `RawFilePrefetcher`
+    :param prefetch_memory: int - The size of the raw files read ahead and not checksummed yet may add up to, in bytes
+    :param summary: VerificationSummary - Optional summary to fill in with the number of files verified and the
+        inventory report, once all the results have been given
+    :param sample: MemberSample - Optional sample of the files to verify, instead of all of them. The inventory isn't
+        checked, and neither a manifest nor the journal are written. With an index, the parts of the archive with
+        none of the sample in them aren't even decompressed
+    :return: a generator of the FileResult of each file verified
+    """
+    if summary is None:
+        summary = VerificationSummary()
+    if not archive_path:
+        raise ValueError("Missing path to the tar archive to checksum.")
+    if not os.path.isdir(dir_path):
+        raise ValueError("The directory path to the raw data doesn't point to a directory")
+
+    # The raw files known to differ from their metadata aren't checksummed:
+    prefilter = MetadataPrefilter(dir_path, get_metadata_fields(metadata_fields, quick), quick)
+    checksum_filter = prefilter.should_checksum
+    if sample:
+        # The raw files of the members left out of the sample aren't looked at:
+        checksum_filter = sample.checksum_filter(checksum_filter)
+        check_inventory = False
+        if journal:
+            logging.warning("The journal isn't written when verifying a sample")
+            journal = None
+        if manifest_path:
+            logging.warning("The manifest isn't written when verifying a sample")
+            manifest_path = None
+
+    if only:
+        if index:
+            members = iter_indexed_archive_members(
+                archive_path, index, only, exclude_wildcard, exclude_regex, algorithms,
+                checksum_filter=checksum_filter)
+        else:
+            members = iter_archive_members(
+                archive_path, exclude_wildcard, exclude_regex, decompressor, decompress_jobs, only=only,
+                algorithms=algorithms, checksum_filter=checksum_filter)
+        if sample:
+            members = sample.select(members, exclude_wildcard, exclude_regex)
+        return iter_verify_archive_members(
+            members, dir_path, exclude_wildcard, exclude_regex, False, jobs, checksum_cache, algorithms,
+            prefilter=prefilter, keep_going=keep_going, fail_fast=fail_fast, prefetch_files=prefetch_files,
+            prefetch_memory=prefetch_memory, summary=summary)
+
+    verified_members = journal.verified_members if journal else 0
+    if verified_members and manifest_path:
+        logging.warning("The manifest isn't written when resuming a verification")
+        manifest_path = None
+    if quick and manifest_path:
+        logging.warning("The manifest isn't written in quick mode")
+        manifest_path = None
+
+    if not manifest_path:
+        if (verified_members or sample) and index and index.matches(archive_path):
+            # Go straight past the members that have already been verified, or aren't in the sample:
+            members = iter_indexed_archive_members(
+                archive_path, index, None, exclude_wildcard, exclude_regex, algorithms, verified_members,
+                checksum_filter)
+        else:
+            members = iter_archive_members(
+                archive_path, exclude_wildcard, exclude_regex, decompressor, decompress_jobs, algorithms=algorithms,
+                skip_members=verified_members, checksum_filter=checksum_filter)
+        if sample:
+            members = sample.select(members, exclude_wildcard, exclude_regex)
+        return iter_verify_archive_members(
+            members, dir_path, exclude_wildcard, exclude_regex, check_inventory, jobs, checksum_cache, algorithms,
+            scan_jobs, inventory_memory, journal, prefilter, keep_going, fail_fast, prefetch_files, prefetch_memory,
+            summary)
+
+    return _iter_verify_archive_writing_manifest(
+        archive_path, dir_path, manifest_path, exclude_wildcard, exclude_regex, check_inventory, jobs, decompressor,
+        decompress_jobs, checksum_cache, algorithms, scan_jobs, inventory_memory, journal, prefilter, keep_going,
+        fail_fast, prefetch_files, prefetch_memory, summary)
+
+
+def _iter_verify_archive_writing_manifest(
+        archive_path, dir_path, manifest_path, exclude_wildcard, exclude_regex, check_inventory, jobs, decompressor,
+        decompress_jobs, checksum_cache, algorithms, scan_jobs, inventory_memory, journal, prefilter, keep_going,
+        fail_fast, prefetch_files, prefetch_memory, summary):
+    """
+    Verifies an archive as `iter_verify_archive` does, writing its manifest along the way. The manifest is only
+    written once all the results have been given, and not if the verification stopped before the end of the
+    archive. The files whose raw files are missing or can't be read are marked in the manifest, and when one of them
+    fails the verification, the rest of the archive is still read for the manifest before the error is raised.
+    :return: a generator of the FileResult of each file verified
+    """
+    # The manifest has the checksums of all the files in the archive, excluded, known to differ or not:
+    archive_hash = hashlib.md5()
+    manifest_writer = ManifestWriter(manifest_path, archive_path, algorithms)
+    try:
+        members = manifest_writer.record(iter_archive_members(
+            archive_path, decompressor=decompressor, decompress_jobs=decompress_jobs, archive_hash=archive_hash,
+            algorithms=algorithms))
+        for result in iter_verify_archive_members(
+                members, dir_path, exclude_wildcard, exclude_regex, check_inventory, jobs, checksum_cache, algorithms,
+                scan_jobs, inventory_memory, journal, prefilter, keep_going, fail_fast, prefetch_files,
+                prefetch_memory, summary):
+            if result.status in (RESULT_MISSING, RESULT_UNREADABLE):
+                manifest_writer.mark_failed(result.path, result.error)
+            yield result
+    except (ValueError, EnvironmentError) as e:
+        error = sys.exc_info()
+        # A raw file is missing or can't be read, rather than the archive (in which case it can't be read to the end):
+        try:
+            for _ in members:
+                pass
+        except Exception:
+            pass
+        if manifest_writer.complete:
+            manifest_writer.close(archive_hash.hexdigest(), verification_error=str(e))
+        else:
+            manifest_writer.abort()
+        raise error[0], error[1], error[2]
+    except:
+        manifest_writer.abort()
+        raise
+    if summary.stopped:
+        manifest_writer.abort()
+    else:
+        manifest_writer.close(archive_hash.hexdigest())
+
+
+def iter_verify_archive_with_manifest(
+        manifest_path, dir_path, archive_path=None, exclude_wildcard=None, exclude_regex=None, check_inventory=True,
+        jobs=1, checksum_cache=None, check_archive_checksum=False, scan_jobs=None, inventory_memory=INVENTORY_MEMORY,
+        journal=None, quick=False, metadata_fields=None, keep_going=False, fail_fast=False, prefetch_files=0,
+        prefetch_memory=PREFETCH_MEMORY, summary=None, sample=None):
+    """
+    Verifies the directory an archive was made from against the manifest of the archive, without reading the archive.
+    The files are checksummed with the algorithms the manifest was written with.
+    :param manifest_path: str - The path to the manifest written by `verify_archive`
+    :param dir_path: str - The path to the archived directory
+    :param archive_path: str - Optional path to the archive, to check that it is the one the manifest was written for
+    :param exclude_wildcard: optional wildcard to exclude certain files or folders
+    :param exclude_regex: optional regex to exclude certain files or folders
+    :param check_inventory: bool - Whether to also report the files in the directory that are not in the archive
+    :param jobs: int - The number of threads checksumming raw files
+    :param checksum_cache: ChecksumCache - Optional cache of the checksums of raw files that haven't changed
+    :param check_archive_checksum: bool - Whether to also check the checksum of the archive (which reads all of it)
+        rather than only its size and modification time
+    :param scan_jobs: int - The number of directories listed at the same time when scanning the directory. Defaults
+        to `jobs`
+    :param inventory_memory: int - The memory each of the lists of paths for the inventory check may take up before
+        it is sorted on disk, in bytes
+    :param journal: VerificationJournal - Optional journal to record the verified files in, and to resume from
+    :param quick: bool - Whether to only compare the metadata of the files, without checksumming them
+    :param metadata_fields: list - The metadata compared, out of METADATA_FIELDS (see `get_metadata_fields`)
+    :param keep_going: bool - Whether to give the files whose raw files are missing or can't be read as results
+    :param fail_fast: bool - Whether to stop at the first file that differs in any way
+    :param prefetch_files: int - The number of members to look ahead of the one being verified, reading ahead their
+        raw files
+    :param prefetch_memory: int - The size of the raw files read ahead and not checksummed yet may add up to, in bytes
+    :param summary: VerificationSummary - Optional summary to fill in once all the results have been given
+    :param sample: MemberSample - Optional sample of the files to verify, instead of all of them. The inventory isn't
+        checked, and the journal isn't written
+    :return: a generator of the FileResult of each file verified
+    """
+    if not os.path.isdir(dir_path):
+        raise ValueError("The directory path to the raw data doesn't point to a directory")
+    header = read_manifest_header(manifest_path)
+    if archive_path and not manifest_matches_archive(header, archive_path, check_archive_checksum):
+        raise ValueError("ERROR: The archive has changed since its manifest was written: %s" % archive_path)
+    members = read_manifest_members(manifest_path)
+    if sample:
+        members = sample.select(members, exclude_wildcard, exclude_regex)
+        check_inventory = False
+        if journal:
+            logging.warning("The journal isn't written when verifying a sample")
+            journal = None
+    return iter_verify_archive_members(
+        members, dir_path, exclude_wildcard, exclude_regex, check_inventory, jobs,
+        checksum_cache, parse_algorithms(header['algorithm']), scan_jobs, inventory_memory, journal,
+        MetadataPrefilter(dir_path, get_metadata_fields(metadata_fields, quick), quick), keep_going, fail_fast,
+        prefetch_files, prefetch_memory, summary)
+
+
+def iter_verify_archive_members(
+        members, dir_path, exclude_wildcard=None, exclude_regex=None, check_inventory=True, jobs=1,
+        checksum_cache=None, algorithms=DEFAULT_ALGORITHMS, scan_jobs=None, inventory_memory=INVENTORY_MEMORY,
+        journal=None, prefilter=None, keep_going=False, fail_fast=False, prefetch_files=0,
+        prefetch_memory=PREFETCH_MEMORY, summary=None):
+    """
+    Verifies the members of an archive, as given by `iter_archive_members` or `read_manifest_members`, against the
+    directory the archive was made from.
+    :param members: iterable - The ArchiveMember of each member of the archive
+    :param dir_path: str - The path to the archived directory
+    :param exclude_wildcard: optional wildcard to exclude certain files or folders
+    :param exclude_regex: optional regex to exclude certain files or folders
+    :param check_inventory: bool - Whether to also report the files in the directory that are not in the archive
+    :param jobs: int - The number of threads checksumming raw files while the members are being read
+    :param checksum_cache: ChecksumCache - Optional cache of the checksums of raw files that haven't changed
+    :param algorithms: list - The names of the hash algorithms the members were checksummed with
+    :param scan_jobs: int - The number of directories listed at the same time when scanning the directory for the
+        inventory check. Defaults to `jobs`
+    :param inventory_memory: int - The memory the paths (and stats) of the files in the directory, and the paths of
+        the members of the archive, may each take up for the inventory check before they are sorted on disk, in bytes.
+        The archived files kept for the hard links to them may take up as much before they are moved to disk
+    :param journal: VerificationJournal - Optional journal to record the verified files in. The files of the members
+        it has already verified count towards the results without being checked again
+    :param prefilter: MetadataPrefilter - The comparison of the metadata of the files, done before they are
+        checksummed. Defaults to comparing their sizes
+    :param keep_going: bool - Whether to give the files whose raw files are missing or can't be read as results
+        (RESULT_MISSING or RESULT_UNREADABLE) and carry on, rather than raising an error
+    :param fail_fast: bool - Whether to stop at the first file that differs in any way (including missing or
+        unreadable raw files), without reading the rest of the archive. The summary is marked as stopped, and the
+        inventory isn't checked
+    :param prefetch_files: int - The number of members to look ahead of the one being verified, reading ahead the raw
+        files that will be checksummed (none by default). See `RawFilePrefetcher`
+    :param prefetch_memory: int - The size of the raw files read ahead and not checksummed yet may add up to, in bytes
+    :param summary: VerificationSummary - Optional summary to fill in with the number of files verified (including
+        those verified by an earlier run, whose errors it gets too) and the inventory report
+    :return: a generator of the FileResult of each file verified, in the order of the archive
+    """
+    algorithms_name = get_algorithms_name(algorithms)
+    if summary is None:
+        summary = VerificationSummary()
+    summary.total_files = journal.total_files if journal else 0
+    summary.resumed_errors = list(journal.errors) if journal else []
+    verified_members = journal.verified_members if journal else 0
+    if prefilter is None:
+        prefilter = MetadataPrefilter(dir_path)
+    # The directory to find out about the raw files that are missing or can't be read, when they are given as results
+    failures_dir_path = dir_path if keep_going or fail_fast else None
+    files_in_archive = None
+    files_in_directory = None
+    pool = None
+    prefetcher = None
+    archived_files = None
+
+    try:
+        # The directory is scanned once, up front, for the inventory check. The stats it gives are reused to find the
+        # raw files and to look their checksums up in the cache, rather than stat'ing every file again - as long as
+        # they fit in the memory allowed for the inventory, beyond which the raw files are stat'ed as they are
+        # checksummed:
+        if check_inventory:
+            files_in_archive = PathList(max_memory=inventory_memory)
+            files_in_directory = PathList(max_memory=inventory_memory)
+            directory_entries = {}
+            for entry in scan_directory(dir_path, exclude_wildcard, exclude_regex, scan_jobs or jobs):
+                files_in_directory.append(entry.path)
+                if directory_entries is not None:
+                    directory_entries[entry.path] = entry
+                    if len(directory_entries) * _STAT_OVERHEAD > inventory_memory:
+                        logging.info("Too many files in the directory to keep their stats in memory")
+                        directory_entries = None
+            prefilter.directory_entries = directory_entries
+
+        # Raw files are checksummed by the pool while the archive carries on streaming. The results are collected in
+        # tar order, with at most a couple of pending files per thread so that memory use doesn't depend on the
+        # archive size:
+        pool = ThreadPool(jobs) if jobs > 1 else None
+        max_pending = 2 * jobs if pool else 0
+        pending = collections.deque()
+        # The sizes and checksums of the archived files are kept by path for the hard links to them later in the
+        # archive - whether or not their raw files are linked too, which they aren't in a copy made without keeping
+        # hard links. That is a few hundred bytes a file, in archives with hard links or not, until they take up
+        # `inventory_memory` and are moved to disk (a stream can't be told to have no hard links). The checksums of the
+        # raw files with more than one link are kept by (device, inode) until all their links have been seen, so that
+        # each is read once however many paths it has. As the links of some may be outside the directory, and never
+        # seen, no more checksums are kept than stats would fit in `inventory_memory`, the earliest forgotten first:
+        archived_files = ArchivedDigests(max_memory=inventory_memory)
+        raw_file_md5s = collections.OrderedDict()
+        max_raw_file_md5s = max(1, inventory_memory // _STAT_OVERHEAD)
+
+        items = enumerate(_timed_items(members))
+        # The checksums looked up in the cache for the members looked ahead, by path, so as not to look them up again
+        # when they are verified (None for those not in the cache):
+        cached_raw_file_md5s = collections.OrderedDict()
+        if prefetch_files and not prefilter.quick:
+            def find_raw_file_to_prefetch(item):
+                sequence, (_, member) = item
+                if sequence < verified_members or member.type != FILE_MEMBER or member.digest is None:
+                    return None
+                if (exclude_wildcard or exclude_regex) and is_excluded(member.path, exclude_wildcard, exclude_regex):
+                    return None
+                try:
+                    raw_file = prefilter.find_raw_file(member.path)
+                    if content_differs(prefilter.differences(member)):
+                        return None
+                except (ValueError, EnvironmentError):
+                    return None
+                if checksum_cache:
+                    cached_raw_file_md5s[member.path] = checksum_cache.get(raw_file[1], algorithms_name)
+                    while len(cached_raw_file_md5s) > prefetch_files + 1:
+                        cached_raw_file_md5s.popitem(last=False)
+                    if cached_raw_file_md5s[member.path]:
+                        return None
+                return raw_file
+            prefetcher = RawFilePrefetcher(prefetch_files, prefetch_memory)
+            # The raw files of the members looked ahead are kept for when they are verified:
+            prefilter.remembered = prefetch_files + 1
+            items = prefetcher.look_ahead(items, find_raw_file_to_prefetch)
+
+        for sequence, (archive_seconds, member) in items:
+            if check_inventory:
+                files_in_archive.append(member.path)
+            if sequence < verified_members:
+                # Verified by an earlier run - the hard links to it may not have been
+                if member.type == FILE_MEMBER and not (
+                        (exclude_wildcard or exclude_regex) and
+                        is_excluded(member.path, exclude_wildcard, exclude_regex)):
+                    archived_files.put(member)
+                continue
+
+            if member.type == SYMLINK_MEMBER:
+                logging.warning("This archive contains symlinks that aren't de-referenced: %s" % member.path)
+                continue
+            if member.type not in (FILE_MEMBER, HARDLINK_MEMBER):
+                logging.info("This is not a file - skipping checksum for: %s" % member.path)
+                continue
+
+            # Exclude members
+            if exclude_regex or exclude_wildcard:
+                if is_excluded(member.path, exclude_wildcard, exclude_regex):
+                    continue
+
+            is_hardlink = member.type == HARDLINK_MEMBER
+            if not is_hardlink:
+                archived_files.put(member)
+            else:
+                # A hard link has the contents of the file it links to, earlier in the archive, and the metadata of its
+                # own header (that of the same file). It is compared with the raw file at its own path:
+                linked_file = archived_files.get(member.linkname)
+                if linked_file is None:
+                    logging.warning("The file this hard link links to wasn't verified - skipping checksum for: %s"
+                                    % member.path)
+                    continue
+                member = member._replace(type=FILE_MEMBER, size=linked_file[0], linkname=None, digest=linked_file[1])
+
+            # Compare the metadata first - the files known to differ, and all of them in quick mode, aren't checksummed:
+            try:
+                raw_file_path, raw_file_stat = prefilter.find_raw_file(member.path)
+            except (ValueError, EnvironmentError) as e:
+                if not (keep_going or fail_fast):
+                    raise
+                raw_file_stat, differences, raw_file_md5, cached_raw_file_md5 = None, [], _FailedResult(e), None
+            else:
+                differences = prefilter.differences(member)
+                if prefilter.quick or content_differs(differences):
+                    raw_file_md5, cached_raw_file_md5 = _CompletedResult((None, None)), None
+                elif member.digest is None and is_hardlink:
+                    # The file it links to wasn't checksummed, so neither can it be
+                    raw_file_md5, cached_raw_file_md5 = _UNVERIFIED_LINK, None
+                elif member.digest is None:
+                    continue
+                else:
+                    # Checksum the raw file, unless it has been already under another path, or hasn't changed since its
+                    # checksum was cached
+                    inode = (raw_file_stat.st_dev, raw_file_stat.st_ino)
+                    raw_file_md5 = _take_linked(raw_file_md5s, inode)
+                    cached_raw_file_md5 = None
+                    if raw_file_md5 is None:
+                        if member.path in cached_raw_file_md5s:
+                            cached_raw_file_md5 = cached_raw_file_md5s.pop(member.path)
+                        elif checksum_cache:
+                            cached_raw_file_md5 = checksum_cache.get(raw_file_stat, algorithms_name)
+                        if cached_raw_file_md5:
+                            raw_file_md5 = _CompletedResult((cached_raw_file_md5, None))
+                        elif pool:
+                            raw_file_md5 = pool.apply_async(_checksum_raw_file_timed, (raw_file_path, algorithms))
+                        else:
+                            try:
+                                raw_file_md5 = _CompletedResult(_checksum_raw_file_timed(raw_file_path, algorithms))
+                            except (ValueError, EnvironmentError) as e:
+                                # Raised when the results are compared, in turn, as from the pool
+                                raw_file_md5 = _FailedResult(e)
+                        if raw_file_stat.st_nlink > 1:
+                            raw_file_md5s[inode] = (raw_file_md5, raw_file_stat.st_nlink - 1)
+                            if len(raw_file_md5s) > max_raw_file_md5s:
+                                raw_file_md5s.popitem(last=False)
+            pending.append((
+                member, raw_file_stat, raw_file_md5, cached_raw_file_md5, sequence, differences, archive_seconds))
+
+            while len(pending) > max_pending:
+                result = _compare_pending_checksums(
+                    pending.popleft(), checksum_cache, algorithms_name, journal, failures_dir_path)
+                summary.total_files += 1
+                yield result
+                if fail_fast and result.status != RESULT_OK:
+                    summary.stopped = True
+                    return
+
+        while pending:
+            result = _compare_pending_checksums(
+                pending.popleft(), checksum_cache, algorithms_name, journal, failures_dir_path)
+            summary.total_files += 1
+            yield result
+            if fail_fast and result.status != RESULT_OK:
+                summary.stopped = True
+                return
+
+        if check_inventory:
+            prefilter.directory_entries = directory_entries = None
+            summary.report = report_missing_files(
+                files_in_directory, files_in_archive, exclude_wildcard, exclude_regex, inventory_memory)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        if prefetcher:
+            prefetcher.close()
+        if archived_files is not None:
+            archived_files.close()
+        if summary.stopped and hasattr(members, 'close'):
+            # Stop reading the archive
+            members.close()
+        for paths in (files_in_directory, files_in_archive):
+            if paths is not None:
+                paths.close()
+
+
+def _take_linked(linked, key):
+    """
+    Gets what is kept for the links to a file, forgetting it once all the links have had it.
+    :param linked: dict - The (value, number of links still to come) of each file, by key
+    :param key: the key of the file
+    :return: value - The value kept for the file, or None if there isn't one
+    """
+    if key not in linked:
+        return None
+    value, remaining_links = linked[key]
+    if remaining_links > 1:
+        linked[key] = (value, remaining_links - 1)
+    else:
+        del linked[key]
+    return value
+
+
+def _find_directory_entry(directory_entries, dir_name, member_path):
+    """
+    Finds the raw file of an archive member amongst the scanned files of the archived directory, whether the archive
+    has only the contents of the directory or also the directory itself, as `resolve_raw_file_path` does.
+    :param directory_entries: dict - The DirectoryEntry of each file in the directory, by relative path
+    :param dir_name: str - The name of the directory
+    :param member_path: str - The path of the member in the archive
+    :return: entry: DirectoryEntry - The raw file, or None if it wasn't found
+    """
+    entry = directory_entries.get(member_path)
+    if entry is None and member_path.startswith(dir_name + '/'):
+        entry = directory_entries.get(member_path[len(dir_name) + 1:])
+    if entry is not None and not stat.S_ISREG(entry.stat.st_mode):
+        return None
+    return entry
+
+
+def _compare_pending_checksums(
+        pending_checksums, checksum_cache=None, algorithms_name='md5', journal=None, failures_dir_path=None):
+    """
+    Compares the checksums of an archived file and of its raw version, waiting for the raw one if it is still being
+    calculated, and caches the checksum of the raw file if it was calculated.
+    :param pending_checksums: tuple - The ArchiveMember of the file, the raw file stat, the result giving the raw
+        file checksum and the seconds it took (None, None if the file wasn't checksummed), the cached raw file checksum
+        (None if it wasn't cached), the position of the member in the archive, the differences in its metadata and the
+        seconds it took to read from the archive
+    :param checksum_cache: ChecksumCache - Optional cache to store the checksums of the raw files in
+    :param algorithms_name: str - The name of the hash algorithms the checksums were calculated with
+    :param journal: VerificationJournal - Optional journal to record the verified file in
+    :param failures_dir_path: str - The path to the archived directory, to give a result for a raw file that is
+        missing or can't be read rather than raising the error. None to raise it
+    :return: result: FileResult - The result of the verification of the file
+    """
+    (member, raw_file_stat, raw_file_md5, cached_raw_file_md5, sequence, differences,
+     archive_seconds) = pending_checksums
+    if raw_file_md5 is _UNVERIFIED_LINK:
+        error = "%s can't be verified: the file it links to wasn't checksummed in the archive" % member.path
+        if journal:
+            journal.record(sequence, member.path, None, None, failure=error)
+        return FileResult(member.path, member.size, RESULT_UNVERIFIED, None, None, differences, error, archive_seconds,
+                          None)
+    with STATS.stage('raw_wait'):
+        try:
+            raw_file_md5, raw_seconds = _wait_for_result(raw_file_md5)
+        except (ValueError, EnvironmentError) as e:
+            if failures_dir_path is None:
+                raise
+            status, error = get_raw_file_failure(failures_dir_path, member.path, e)
+            if journal:
+                journal.record(sequence, member.path, member.digest, None, failure=error)
+            return FileResult(member.path, member.size, status, member.digest, None, [], error, archive_seconds, None)
+    if checksum_cache and raw_file_md5 is not None and not cached_raw_file_md5:
+        checksum_cache.put(raw_file_stat, raw_file_md5, algorithms_name)
+    metadata_error = format_metadata_error(member.path, differences) if differences else None
+    if journal:
+        journal.record(sequence, member.path, member.digest, raw_file_md5, metadata_error)
+
+    # Compare md5s:
+    error = format_file_error(member.path, member.digest, raw_file_md5, metadata_error)
+    if content_differs(differences) or raw_file_md5 is not None and raw_file_md5 != member.digest:
+        status = RESULT_DIFFERENT
+    elif differences:
+        status = RESULT_METADATA_DIFFERENT
+    else:
+        status = RESULT_OK
+    return FileResult(
+        member.path, member.size, status, member.digest, raw_file_md5, differences, error, archive_seconds,
+        raw_seconds)
+
+
+def format_checksum_error(member_path, archived_checksum, raw_checksum):
+    """
+    :param member_path: str - The path of the member in the archive
+    :param archived_checksum: str - The checksum of the archived file
+    :param raw_checksum: str - The checksum of the raw file
+    :return: error: str - The error reported for a file that differs between the archive and the directory
+    """
+    return member_path + " " + raw_checksum + " != " + archived_checksum
+
+
+def format_file_error(member_path, archived_checksum, raw_checksum, metadata_error=None):
+    """
+    :param member_path: str - The path of the member in the archive
+    :param archived_checksum: str - The checksum of the archived file (None if it wasn't checksummed)
+    :param raw_checksum: str - The checksum of the raw file (None if it wasn't checksummed)
+    :param metadata_error: str - The error for the metadata of the file, as given by `format_metadata_error`, if it
+        differs
+    :return: error: str - The error reported for the file, for its metadata and checksum together, or None if it is
+        the same in the archive and the directory
+    """
+    if raw_checksum is None or raw_checksum == archived_checksum:
+        return metadata_error
+    if metadata_error is None:
+        return format_checksum_error(member_path, archived_checksum, raw_checksum)
+    return metadata_error + ", " + raw_checksum + " != " + archived_checksum
+
+
+# The metadata of the archived files that can be compared with their raw files
+METADATA_FIELDS = ('size', 'mtime', 'mode', 'uid', 'gid')
+# The metadata compared by default: the size, whose difference means the contents differ too - and in quick mode,
+# where nothing is checksummed, the modification time as well
+DEFAULT_METADATA_FIELDS = ('size', )
+QUICK_METADATA_FIELDS = ('size', 'mtime')
+
+# How to get each field of metadata from the stat of a raw file, and from an archive member
+_RAW_METADATA = {
+    'size': lambda raw_file_stat: raw_file_stat.st_size,
+    'mtime': lambda raw_file_stat: int(raw_file_stat.st_mtime),
+    'mode': lambda raw_file_stat: stat.S_IMODE(raw_file_stat.st_mode),
+    'uid': lambda raw_file_stat: raw_file_stat.st_uid,
+    'gid': lambda raw_file_stat: raw_file_stat.st_gid,
+}
+_ARCHIVED_METADATA = {
+    'size': lambda member: member.size,
+    'mtime': lambda member: int(member.mtime) if member.mtime is not None else None,
+    'mode': lambda member: stat.S_IMODE(member.mode) if member.mode is not None else None,
+    'uid': lambda member: member.uid,
+    'gid': lambda member: member.gid,
+}
+
+
+def parse_metadata_fields(metadata_fields_name):
+    """
+    :param metadata_fields_name: str - Comma separated fields of metadata, e.g. "mtime,mode"
+    :return: fields: tuple - The fields
+    """
+    metadata_fields = tuple(field.strip() for field in metadata_fields_name.split(',') if field.strip())
+    for field in metadata_fields:
+        if field not in METADATA_FIELDS:
+            raise ValueError("ERROR: Unknown metadata: %s. It can be: %s" % (field, ", ".join(METADATA_FIELDS)))
+    return metadata_fields
+
+
+def get_metadata_fields(metadata_fields=None, quick=False):
+    """
+    :param metadata_fields: list - Optional fields of metadata to compare, out of METADATA_FIELDS
+    :param quick: bool - Whether the files are only compared by their metadata
+    :return: fields: tuple - The fields to compare: always the size, plus the given fields, or by default the
+        modification time in quick mode
+    """
+    if metadata_fields is None:
+        return QUICK_METADATA_FIELDS if quick else DEFAULT_METADATA_FIELDS
+    return ('size', ) + tuple(field for field in metadata_fields if field != 'size')
+
+
+def compare_metadata(member, raw_file_stat, metadata_fields=DEFAULT_METADATA_FIELDS):
+    """
+    :param member: ArchiveMember - The archived file
+    :param raw_file_stat: os.stat_result - The stat of its raw file
+    :param metadata_fields: list - The fields of metadata to compare, out of METADATA_FIELDS. The fields the member
+        doesn't have are skipped
+    :return: differences: list - The field, raw value and archived value of each field that differs
+    """
+    differences = []
+    for field in metadata_fields:
+        archived_value = _ARCHIVED_METADATA[field](member)
+        raw_value = _RAW_METADATA[field](raw_file_stat)
+        if archived_value is not None and raw_value != archived_value:
+            differences.append((field, raw_value, archived_value))
+    return differences
+
+
+def content_differs(differences):
+    """
+    :param differences: list - The differences in metadata of a file, as given by `compare_metadata`
+    :return: bool - True if the differences mean that the contents of the files differ too, without reading them
+    """
+    return any(field == 'size' for field, _, _ in differences)
+
+
+def format_metadata_error(member_path, differences):
+    """
+    :param member_path: str - The path of the member in the archive
+    :param differences: list - The differences in metadata, as given by `compare_metadata`
+    :return: error: str - The error reported for a file whose metadata differs between the archive and the directory
+    """
+    return member_path + " " + ", ".join(
+        "%s %s != %s" % (field, oct(raw_value), oct(archived_value)) if field == 'mode' else
+        "%s %s != %s" % (field, raw_value, archived_value) for field, raw_value, archived_value in differences)
+
+
+# Roughly how much memory the size and checksum of an archived file kept by path take up, on top of the characters of
+# its path and checksum, in bytes
+_DIGEST_OVERHEAD = 256
+
+
+class ArchivedDigests(object):
+    """
+    The sizes and checksums of the files of an archive, by path, taking up a bounded amount of memory. They are kept in
+    memory until they take up more than `max_memory` bytes, when they are all moved to a table of an SQLite database
+    in a temporary file.
+    """
+
+    def __init__(self, max_memory=INVENTORY_MEMORY):
+        """
+        :param max_memory: int - The memory the checksums may take up before they are moved to disk, in bytes
+        """
+        self.max_memory = max_memory
+        self._digests = {}
+        self._memory = 0
+        self._database_path = None
+        self._connection = None
+
+    def put(self, member):
+        """
+        :param member: ArchiveMember - An archived file, replacing any kept with the same path
+        """
+        self._digests[member.path] = (member.size, member.digest)
+        self._memory += len(member.path) + len(member.digest or '') + _DIGEST_OVERHEAD
+        if self._memory > self.max_memory:
+            self._spill()
+
+    def get(self, path):
+        """
+        :param path: str - The path of an archived file
+        :return: size, digest: int, str - The size and checksum of the file (None if it wasn't checksummed), or None if
+            there is no file with this path
+        """
+        digest = self._digests.get(path)
+        if digest is None and self._connection is not None:
+            row = self._connection.execute("SELECT size, digest FROM digests WHERE path = ?", (path, )).fetchone()
+            if row is not None:
+                digest = (row[0], str(row[1]) if row[1] is not None else None)
+        return digest
+
+    @property
+    def spilled(self):
+        """
+        Whether the checksums have been moved to disk.
+        """
+        return self._connection is not None
+
+    def _spill(self):
+        """
+        Moves the checksums in memory to disk.
+        """
+        if self._connection is None:
+            database_file, self._database_path = tempfile.mkstemp(prefix='tarcheck-digests-', suffix='.sqlite')
+            os.close(database_file)
+            self._connection = sqlite3.connect(self._database_path)
+            self._connection.text_factory = str
+            self._connection.execute("CREATE TABLE digests (path TEXT PRIMARY KEY, size INTEGER, digest TEXT)")
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?)",
+            ((path, size, digest) for path, (size, digest) in self._digests.iteritems()))
+        self._digests = {}
+        self._memory = 0
+
+    def close(self):
+        """
+        Deletes the checksums on disk.
+        """
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+            os.remove(self._database_path)
+
+
+class MetadataPrefilter(object):
+    """
+    Compares the metadata of the files in an archive with the stats of their raw files, before any of their contents
+    is read. It is given to `verify_archive_members`, which reports the differences and doesn't checksum the raw files
+    whose sizes differ from the archived files' - nor any in quick mode - and to the reader of the archive as its
+    `checksum_filter`, so that no archived files are checksummed in quick mode. The raw files looked up for the last
+    `remembered` members are kept for when they are verified.
+    """
+
+    def __init__(self, dir_path, metadata_fields=DEFAULT_METADATA_FIELDS, quick=False):
+        """
+        :param dir_path: str - The path to the archived directory
+        :param metadata_fields: list - The fields of metadata to compare, out of METADATA_FIELDS
+        :param quick: bool - Whether the files are only compared by their metadata, without being checksummed
+        """
+        self.dir_path = dir_path
+        self.metadata_fields = metadata_fields
+        self.quick = quick
+        # The DirectoryEntry of each file of the scanned directory, by relative path, if they are known
+        self.directory_entries = None
+        # The number of raw files kept, more than one when members are looked ahead of those being verified
+        self.remembered = 1
+        self._absolute_dir_path = os.path.abspath(dir_path)
+        self._dir_name = os.path.basename(self._absolute_dir_path)
+        self._raw_files = collections.OrderedDict()
+
+    def find_raw_file(self, member_path):
+        """
+        :param member_path: str - The path of the member in the archive
+        :return: raw_file_path, raw_file_stat: str, os.stat_result - The path to the raw file of the member and its stat
+        """
+        raw_file = self._raw_files.get(member_path)
+        if raw_file is None:
+            directory_entry = None
+            if self.directory_entries is not None:
+                directory_entry = _find_directory_entry(self.directory_entries, self._dir_name, member_path)
+            if directory_entry:
+                raw_file = (os.path.join(self._absolute_dir_path, directory_entry.path), directory_entry.stat)
+            else:
+                raw_file_path = resolve_raw_file_path(self.dir_path, member_path)
+                raw_file = (raw_file_path, os.stat(raw_file_path))
+            self._raw_files[member_path] = raw_file
+            while len(self._raw_files) > self.remembered:
+                self._raw_files.popitem(last=False)
+        return raw_file
+
+    def differences(self, member):
+        """
+        :param member: ArchiveMember - The archived file
+        :return: differences: list - The differences in metadata with its raw file, as given by `compare_metadata`
+        """
+        return compare_metadata(member, self.find_raw_file(member.path)[1], self.metadata_fields)
+
+    def should_checksum(self, member):
+        """
+        :param member: ArchiveMember - The archived file
+        :return: bool - True if the archived file is to be checksummed: all of them but in quick mode. Those whose raw
+            files differ in size, or are missing, are still checksummed - the hard links to them later in the archive
+            have raw files of their own, compared with their checksums
+        """
+        return not self.quick
+
+
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_FORMAT = 'tarcheck-journal'
+JOURNAL_VERSION = 1
+
+
+def get_default_journal_path(archive_path):
+    """
+    :param archive_path: str - The path to the archive
+    :return: journal_path: str - The path of the journal sitting next to the archive
+    """
+    return archive_path + JOURNAL_SUFFIX
+
+
+class VerificationJournal(object):
+    """
+    Journal of the files of an archive verified so far, so that a verification that is stopped part way through can be
+    resumed rather than started again. It is a JSON lines file with a header describing the verification (the
+    archive's name, size and modification time, the directory, the checksum algorithms, the exclusion rules and the
+    metadata compared) followed by a line per verified file: its position amongst the members of the archive, its
+    path, the checksums of the archived and the raw file (None if they weren't checksummed) and the error for its
+    metadata or for its raw file (when it is missing or can't be read), if any. The files are verified in archive
+    order, so the journal always covers all the members up to the last one in it.
+
+    Lines are flushed to disk every `flush_interval` seconds, so at most the files verified in the last interval are
+    verified again after the process is killed. A journal that doesn't match the verification is started afresh.
+    """
+
+    def __init__(self, journal_path, archive_path, dir_path, algorithms=DEFAULT_ALGORITHMS, exclude_wildcard=None,
+                 exclude_regex=None, resume=False, flush_interval=10, metadata_fields=DEFAULT_METADATA_FIELDS):
+        """
+        :param journal_path: str - The path to the journal
+        :param archive_path: str - The path to the archive being verified
+        :param dir_path: str - The path to the directory the archive is verified against
+        :param algorithms: list - The names of the hash algorithms the files are checksummed with
+        :param exclude_wildcard: optional wildcard(s) for the files not verified
+        :param exclude_regex: optional regex(es) for the files not verified
+        :param resume: bool - Whether to carry on from an existing journal, rather than starting a new one
+        :param flush_interval: float - The number of seconds between flushes of the journal to disk
+        :param metadata_fields: list - The fields of metadata the files are compared by
+        """
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        # The number of members at the start of the archive that have been verified, and the results for their files
+        self.verified_members = 0
+        self.total_files = 0
+        self.errors = []
+
+        archive_stat = os.stat(archive_path)
+        header = {
+            'format': JOURNAL_FORMAT,
+            'version': JOURNAL_VERSION,
+            'archive': {
+                'name': os.path.basename(archive_path),
+                'size': archive_stat.st_size,
+                'mtime': archive_stat.st_mtime,
+            },
+            'dir': os.path.abspath(dir_path),
+            'algorithm': get_algorithms_name(algorithms),
+            'exclude': [list(_as_rules(exclude_wildcard)), list(_as_rules(exclude_regex))],
+            'metadata': list(metadata_fields),
+        }
+        header = json.loads(json.dumps(header, encoding='latin-1'))
+
+        journal_length = None
+        if resume and os.path.exists(journal_path):
+            journal_length = self._read(header)
+            if journal_length is None:
+                logging.warning("The journal is for another verification, starting a new one: %s" % journal_path)
+        if journal_length is None:
+            self._journal = open(journal_path, 'w')
+            self._journal.write(json.dumps(header, encoding='latin-1') + '\n')
+        else:
+            # Carry on after the last complete line
+            self._journal = open(journal_path, 'r+')
+            self._journal.truncate(journal_length)
+            self._journal.seek(journal_length)
+        self.flush()
+
+    def _read(self, header):
+        """
+        Reads the verified files from the journal.
+        :param header: dict - The header the journal should have
+        :return: length: int - The length of the journal up to the last complete line, or None if it doesn't have the
+            given header
+        """
+        with open(self.journal_path) as journal:
+            line = journal.readline()
+            try:
+                if json.loads(line) != header:
+                    return None
+            except ValueError:
+                return None
+            length = len(line)
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line was only partly written
+                    break
+                member_path = record['path'].encode('latin-1')
+                self.verified_members = record['member'] + 1
+                self.total_files += 1
+                if record.get('failure'):
+                    error = record['failure'].encode('latin-1')
+                else:
+                    error = format_file_error(
+                        member_path, record['archived'] and str(record['archived']),
+                        record['raw'] and str(record['raw']),
+                        record.get('metadata') and record['metadata'].encode('latin-1'))
+                if error:
+                    self.errors.append(error)
+                length += len(line)
+        return length
+
+    def record(self, sequence, member_path, archived_checksum, raw_checksum, metadata_error=None, failure=None):
+        """
+        Records a verified file.
+        :param sequence: int - The position of the member amongst the members of the archive, from 0
+        :param member_path: str - The path of the member in the archive
+        :param archived_checksum: str - The checksum of the archived file (None if it wasn't checksummed)
+        :param raw_checksum: str - The checksum of the raw file (None if it wasn't checksummed)
+        :param metadata_error: str - The error for the metadata of the file, if it differs
+        :param failure: str - The error for the raw file, if it is missing or can't be read
+        """
+        self._journal.write(json.dumps(
+            {'member': sequence, 'path': member_path, 'archived': archived_checksum, 'raw': raw_checksum,
+             'metadata': metadata_error, 'failure': failure},
+            encoding='latin-1') + '\n')
+        if time.time() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes what has been recorded to disk.
+        """
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._flushed = time.time()
+
+    def close(self, completed=False):
+        """
+        :param completed: bool - Whether the verification has completed, in which case the journal is deleted
+        """
+        if self._journal.closed:
+            return
+        self.flush()
+        self._journal.close()
+        if completed:
+            os.remove(self.journal_path)
+
+
+def _raise_system_exit(signal_number, frame):
+    """
+    Turns a signal into SystemExit, so that clean up (e.g. flushing the journal) is done when the process is stopped.
+    """
+    raise SystemExit(128 + signal_number)
+
+
+def get_default_manifest_path(archive_path):
+    """
+    :param archive_path: str - The path to the archive
+    :return: manifest_path: str - The path of the manifest sitting next to the archive
+    """
+    return archive_path + MANIFEST_SUFFIX
+
+
+class ManifestWriter(object):
+    """
+    Writes the manifest of an archive: a JSON lines file with a header describing the archive (its size, modification
+    time and checksum) followed by a line per member (path, type, size, modification time, link name, checksum, mode,
+    uid and gid).
+
+    Paths are stored as latin-1 so that any byte string round-trips. The members are written to a temporary file as
+    they are read, and the manifest only appears once `close` is called at the end of a complete pass.
+
+    The members whose raw files were missing or couldn't be read are marked with the error (`raw_failure`), and the
+    header has the number of them and the error that failed the verification, if any. The marks are kept in memory
+    until the manifest is written.
+    """
+
+    def __init__(self, manifest_path, archive_path, algorithms=DEFAULT_ALGORITHMS):
+        """
+        :param manifest_path: str - The path to write the manifest to
+        :param archive_path: str - The path to the archive the manifest is for
+        :param algorithms: list - The names of the hash algorithms the members are checksummed with
+        """
+        self.manifest_path = manifest_path
+        self.archive_path = archive_path
+        self.algorithms = algorithms
+        self._archive_stat = os.stat(archive_path)
+        self._members_path = manifest_path + '.members.tmp'
+        self._members_file = open(self._members_path, 'w')
+        self._total_members = 0
+        self._failures = {}
+        # Whether all the members of the archive have been recorded
+        self.complete = False
+
+    @property
+    def paths(self):
+        """
+        The paths of the files the manifest is written to (and the manifest it replaces, if any), as a tuple.
+        """
+        return self.manifest_path, self._members_path, self.manifest_path + '.tmp'
+
+    def write(self, member):
+        """
+        :param member: ArchiveMember - The member to add to the manifest
+        """
+        self._members_file.write(json.dumps(member._asdict(), encoding='latin-1') + '\n')
+        self._total_members += 1
+
+    def record(self, members):
+        """
+        Writes the given members to the manifest as they go by.
+        :param members: iterable - The ArchiveMember of each member
+        :return: a generator of the given members
+        """
+        for member in members:
+            self.write(member)
+            yield member
+        self.complete = True
+
+    def mark_failed(self, member_path, error):
+        """
+        :param member_path: str - The path of a member whose raw file is missing or can't be read
+        :param error: str - The error reported for the member
+        """
+        self._failures[member_path] = error
+
+    def close(self, archive_md5, archive_stat=None, verification_error=None):
+        """
+        Writes the manifest.
+        :param archive_md5: str - The checksum of the archive file
+        :param archive_stat: os.stat_result - The stat of the archive file, if it has changed since the manifest writer
+            was made because it was being written
+        :param verification_error: str - The error that failed the verification the manifest was written by, if any
+        """
+        if archive_stat is not None:
+            self._archive_stat = archive_stat
+        self._members_file.close()
+        header = {
+            'format': MANIFEST_FORMAT,
+            'version': MANIFEST_VERSION,
+            'algorithm': get_algorithms_name(self.algorithms),
+            'members': self._total_members,
+            'raw_failures': len(self._failures),
+            'verification_error': verification_error,
+            'archive': {
+                'name': os.path.basename(self.archive_path),
+                'size': self._archive_stat.st_size,
+                'mtime': self._archive_stat.st_mtime,
+                'md5': archive_md5,
+            },
+        }
+        temporary_manifest_path = self.manifest_path + '.tmp'
+        with open(temporary_manifest_path, 'w') as manifest:
+            manifest.write(json.dumps(header, encoding='latin-1') + '\n')
+            with open(self._members_path) as members_file:
+                for line in members_file:
+                    if self._failures:
+                        member = json.loads(line)
+                        failure = self._failures.get(member['path'].encode('latin-1'))
+                        if failure is not None:
+                            member['raw_failure'] = failure
+                            line = json.dumps(member, encoding='latin-1') + '\n'
+                    manifest.write(line)
+        os.rename(temporary_manifest_path, self.manifest_path)
+        os.remove(self._members_path)
+
+    def abort(self):
+        """
+        Gives up on writing the manifest.
+        """
+        self._members_file.close()
+        os.remove(self._members_path)
+
+
+def read_manifest_header(manifest_path):
+    """
+    :param manifest_path: str - The path to the manifest
+    :return: header: dict - The header of the manifest, describing the archive
+    """
+    with open(manifest_path) as manifest:
+        header = json.loads(manifest.readline())
+    if header.get('format') != MANIFEST_FORMAT or header.get('version') != MANIFEST_VERSION:
+        raise ValueError("ERROR: This isn't a manifest that this version of tarcheck can read: %s" % manifest_path)
+    return header
+
+
+def read_manifest_members(manifest_path):
+    """
+    :param manifest_path: str - The path to the manifest
+    :return: a generator of the ArchiveMember of each member in the manifest, in the order they are in the archive
+    """
+    with open(manifest_path) as manifest:
+        manifest.readline()
+        for line in manifest:
+            member = json.loads(line)
+            yield ArchiveMember(
+                member['path'].encode('latin-1'), member['type'], member['size'], member['mtime'],
+                member['linkname'].encode('latin-1') if member['linkname'] is not None else None,
+                str(member['digest']) if member['digest'] is not None else None,
+                member.get('mode'), member.get('uid'), member.get('gid'))
+
+
+def manifest_matches_archive(header, archive_path, check_archive_checksum=False):
+    """
+    Checks that an archive is the one a manifest was written for.
+    :param header: dict - The header of the manifest
+    :param archive_path: str - The path to the archive
+    :param check_archive_checksum: bool - Whether to also compare the checksum of the archive (which reads all of it)
+        rather than only its size and modification time
+    :return: bool - True if the archive is the one the manifest was written for
+    """
+    archive_stat = os.stat(archive_path)
+    if archive_stat.st_size != header['archive']['size'] or archive_stat.st_mtime != header['archive']['mtime']:
+        return False
+    if check_archive_checksum:
+        with open(archive_path, 'rb') as archive:
+            return calculate_md5(archive) == header['archive']['md5']
+    return True
+
+
+def create_archive(
+        archive_path, dir_path, manifest_path=None, exclude_wildcard=None, exclude_regex=None,
+        compressor=AUTO_DECOMPRESSOR, compress_jobs=None, algorithms=DEFAULT_ALGORITHMS):
+    """
+    Archives a directory (the directory itself, with all its contents), checksumming every file as it is written to
+    the archive, and writes the manifest of the archive along the way. Each file is only read once: the checksums are
+    those of the bytes that went into the archive. The archive and its manifest aren't archived, should they be in the
+    directory.
+    :param archive_path: str - The path to the archive to write. It is compressed as the suffix of its name says. An
+        existing archive isn't overwritten, and the archive is removed if it can't be written in full
+    :param dir_path: str - The path to the directory to archive
+    :param manifest_path: str - The path to write the manifest to. Defaults to next to the archive
+    :param exclude_wildcard: optional wildcard(s) for the paths in the archive of the files or directories not to
+        archive
+    :param exclude_regex: optional regex(es) for the paths in the archive of the files or directories not to archive
+    :param compressor: str - The compression backend, one of COMPRESSORS
+    :param compress_jobs: int - The number of cores compression may use. Defaults to all the cores
+    :param algorithms: list - The names of the hash algorithms to checksum the files with
+    :return: total_files: int - The number of files archived
+    """
+    if not os.path.isdir(dir_path):
+        raise ValueError("The directory path to the raw data doesn't point to a directory")
+    if os.path.lexists(archive_path):
+        raise ValueError("ERROR: The archive already exists, and isn't overwritten: %s" % archive_path)
+    rules = get_exclusion_rules(exclude_wildcard, exclude_regex)
+    dir_name = os.path.basename(os.path.abspath(dir_path))
+    archive_hash = hashlib.md5()
+    total_files = 0
+    manifest_writer = None
+    try:
+        with open_archive_writer(
+                archive_path, get_compression_from_name(archive_path), compressor, compress_jobs, archive_hash) as tar:
+            manifest_writer = ManifestWriter(manifest_path or get_default_manifest_path(archive_path), archive_path,
+                                             algorithms)
+            output_files = set()
+            for output_path in (archive_path, ) + manifest_writer.paths:
+                if os.path.exists(output_path):
+                    output_stat = os.stat(output_path)
+                    output_files.add((output_stat.st_dev, output_stat.st_ino))
+            for relative_path in _walk_directory_tree(dir_path, rules, dir_name, output_files):
+                tar_info = tar.gettarinfo(
+                    os.path.join(dir_path, relative_path), os.path.join(dir_name, relative_path).rstrip('/'))
+                if tar_info is None:
+                    logging.warning("This kind of file can't be archived - skipping: %s" % relative_path)
+                    continue
+                # As they are in the archive:
+                tar_info.mtime = int(tar_info.mtime)
+                tar_info.mode = stat.S_IMODE(tar_info.mode)
+                digest = None
+                if tar_info.isfile():
+                    with open(os.path.join(dir_path, relative_path), 'rb') as raw_file:
+                        reader = _DigestingReader(raw_file, algorithms)
+                        with STATS.stage('archive_write', tar_info.size):
+                            tar.addfile(tar_info, reader)
+                        digest = reader.hexdigest()
+                    total_files += 1
+                else:
+                    tar.addfile(tar_info)
+                manifest_writer.write(get_archive_member(tar_info, digest))
+    except:
+        if manifest_writer:
+            manifest_writer.abort()
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        raise
+    manifest_writer.close(archive_hash.hexdigest(), os.stat(archive_path))
+    return total_files
+
+
+def _walk_directory_tree(dir_path, rules=None, archive_root='', skipped_files=()):
+    """
+    :param dir_path: str - The path to the directory
+    :param rules: ExclusionRules - Optional rules for the paths not to give, nor to walk into. They are matched on the
+        paths in the archive, as when verifying it
+    :param archive_root: str - The path of the directory in the archive
+    :param skipped_files: set - The (device, inode) of the files not to give, e.g. the archive being written
+    :return: a generator of the relative path of the directory itself ('') and of everything in it, each directory
+        before its contents and in sorted order. Links to directories aren't followed
+    """
+    stack = ['']
+    while stack:
+        relative_path = stack.pop()
+        absolute_path = os.path.join(dir_path, relative_path)
+        raw_file_stat = os.lstat(absolute_path)
+        if (raw_file_stat.st_dev, raw_file_stat.st_ino) in skipped_files:
+            logging.info("This file is written by the archiving - skipping: %s" % relative_path)
+            continue
+        yield relative_path
+        if stat.S_ISDIR(raw_file_stat.st_mode):
+            for name in sorted(os.listdir(absolute_path), reverse=True):
+                child_path = os.path.join(relative_path, name)
+                if not (rules and rules.matches(os.path.join(archive_root, child_path))):
+                    stack.append(child_path)
+
+
+def verify_archive_against_manifest(archive_path, manifest_path, decompressor=AUTO_DECOMPRESSOR, decompress_jobs=None):
+    """
+    Reads an archive back, checking that it is the one its manifest was written for: its checksum, and the path, type,
+    size and checksum of each of its members. This doesn't read the archived directory at all.
+    :param archive_path: str - The path to the archive
+    :param manifest_path: str - The path to its manifest, e.g. as written by `create_archive`
+    :param decompressor: str - The decompression backend, one of DECOMPRESSORS
+    :param decompress_jobs: int - The number of cores decompression may use. Defaults to all the cores
+    :return: total_files, errors: int, list - The number of files in the archive and the differences found
+    """
+    header = read_manifest_header(manifest_path)
+    archive_hash = hashlib.md5()
+    members = iter_archive_members(
+        archive_path, decompressor=decompressor, decompress_jobs=decompress_jobs, archive_hash=archive_hash,
+        algorithms=parse_algorithms(header['algorithm']))
+    total_files, errors = compare_archive_members(members, read_manifest_members(manifest_path))
+    if archive_hash.hexdigest() != header['archive']['md5']:
+        errors.append("The checksum of the archive %s != %s" % (archive_hash.hexdigest(), header['archive']['md5']))
+    return total_files, errors
+
+
+def compare_archive_members(members, expected_members):
+    """
+    Compares the members of an archive with the members it should have, in the same order.
+    :param members: iterable - The ArchiveMember of each member of the archive, with the checksums of its files
+    :param expected_members: iterable - The ArchiveMember of each member the archive should have
+    :return: total_files, errors: int, list - The number of files in the archive and the differences found
+    """
+    total_files = 0
+    errors = []
+    for member, expected_member in itertools.izip_longest(members, expected_members):
+        if member is None:
+            errors.append("%s is missing from the archive" % expected_member.path)
+            continue
+        if member.type == FILE_MEMBER:
+            total_files += 1
+        if expected_member is None:
+            errors.append("%s shouldn't be in the archive" % member.path)
+        elif member.path != expected_member.path:
+            errors.append("%s is in the archive instead of %s" % (member.path, expected_member.path))
+        else:
+            error = format_member_difference(member, expected_member)
+            if error:
+                errors.append(error)
+    return total_files, errors
+
+
+def format_member_difference(member, expected_member):
+    """
+    :param member: ArchiveMember - A member of an archive
+    :param expected_member: ArchiveMember - What the member should be
+    :return: error: str - The first difference between their types, link names, sizes and checksums, as the value of
+        the member != the expected value, or None if they are the same
+    """
+    if member.type != expected_member.type:
+        return "%s type %s != %s" % (member.path, member.type, expected_member.type)
+    if member.linkname != expected_member.linkname:
+        return "%s linkname %s != %s" % (member.path, member.linkname, expected_member.linkname)
+    if member.size != expected_member.size:
+        return "%s size %s != %s" % (member.path, member.size, expected_member.size)
+    if member.digest != expected_member.digest:
+        return format_checksum_error(member.path, expected_member.digest, member.digest)
+    return None
+
+
+# The memory taken up by a member of an archive waiting to be matched, on top of its path
+_MEMBER_OVERHEAD = 512
+
+
+def normalise_member_path(path):
+    """
+    :param path: str - The path of a member of an archive
+    :return: path: str - The path without leading slashes or "./", trailing slashes or redundant separators, so that
+        the same member has the same path in archives written by different tools
+    """
+    return os.path.normpath(path.lstrip('/'))
+
+
+# The report of archives with the same members
+SAME_MEMBERS = "The archives have the same members"
+
+
+def compare_archives(
+        archive_path, other_archive_path, exclude_wildcard=None, exclude_regex=None, decompressor=AUTO_DECOMPRESSOR,
+        decompress_jobs=None, algorithms=DEFAULT_ALGORITHMS, max_memory=INVENTORY_MEMORY,
+        max_listed=MAX_REPORTED_PATHS):
+    """
+    Compares two archives with each other, e.g. an archive and its repacked version, without extracting either. Both
+    are streamed at the same time, each in a thread of its own (and decompressed in processes of their own by the
+    external decompressors), and their members are matched by their normalised paths. The members of either archive
+    that haven't been matched yet, because the archives don't have their members in the same order, are kept in
+    memory up to `max_memory` and then in a temporary table on disk. A path that is more than once in an archive has
+    its members matched in turn with those with the same path in the other archive, and is reported.
+    :param archive_path: str - The path to the first archive
+    :param other_archive_path: str - The path to the second archive
+    :param exclude_wildcard: optional wildcard(s) for the normalised paths of the members not to compare
+    :param exclude_regex: optional regex(es) for the normalised paths of the members not to compare
+    :param decompressor: str - The decompression backend of both archives, one of DECOMPRESSORS
+    :param decompress_jobs: int - The number of cores the decompression of each archive may use. Defaults to all
+    :param algorithms: list - The names of the hash algorithms to checksum the files with
+    :param max_memory: int - The memory the members of each archive waiting to be matched, and the paths of each
+        archive looked through for duplicates, may take up before they are kept on disk, in bytes
+    :param max_listed: int - The number of paths only in one of the archives, or more than once in one, listed in the
+        report for each archive, at most. The report says how many more there are
+    :return: total_files, errors, report: int, list, str - The number of files in the first archive, the differences
+        between the members of both archives (as the value in the second archive != that in the first) and the report
+        of the members that are only in one of them, or more than once in one (SAME_MEMBERS if there are none)
+    """
+    rules = get_exclusion_rules(exclude_wildcard, exclude_regex)
+    archives = (archive_path, other_archive_path)
+    # The excluded members aren't checksummed
+    checksum_filter = (lambda member: not rules.matches(normalise_member_path(member.path))) if rules else None
+    readers = [
+        _MembersInBackground(iter_archive_members(
+            path, decompressor=decompressor, decompress_jobs=decompress_jobs, algorithms=algorithms,
+            checksum_filter=checksum_filter))
+        for path in archives]
+    unmatched = [UnmatchedMembers(max_memory), UnmatchedMembers(max_memory)]
+    paths = [PathList(max_memory=max_memory), PathList(max_memory=max_memory)]
+    total_files = 0
+    errors = []
+    reported = []
+    try:
+        streams = [iter(reader) for reader in readers]
+        while any(streams):
+            # One member of each archive in turn, so that archives with their members in the same order are matched
+            # as they are read:
+            for side, stream in enumerate(streams):
+                if stream is None:
+                    continue
+                member = next(stream, None)
+                if member is None:
+                    streams[side] = None
+                    continue
+                path = normalise_member_path(member.path)
+                if rules and rules.matches(path):
+                    continue
+                paths[side].append(path)
+                if member.type == HARDLINK_MEMBER:
+                    member = member._replace(linkname=normalise_member_path(member.linkname))
+                member = member._replace(path=path)
+                if side == 0 and member.type == FILE_MEMBER:
+                    total_files += 1
+                other_member = unmatched[1 - side].pop(path)
+                if other_member is None:
+                    unmatched[side].put(member)
+                    continue
+                first_member, second_member = (member, other_member) if side == 0 else (other_member, member)
+                error = format_member_difference(second_member, first_member)
+                if error:
+                    errors.append(error)
+
+        # Only the first of the paths are listed, however many there are:
+        for side, other_side in ((0, 1), (1, 0)):
+            if len(unmatched[side]):
+                reported.append("Some members of %s are missing from %s: %s" % (
+                    archives[side], archives[other_side], _format_listed_paths(
+                        list(itertools.islice(unmatched[side].paths(), max_listed)), len(unmatched[side]))))
+        for side in (0, 1):
+            duplicates = []
+            duplicate_count = 0
+            for path in paths[side].duplicates():
+                if max_listed is None or duplicate_count < max_listed:
+                    duplicates.append(path)
+                duplicate_count += 1
+            if duplicates:
+                reported.append("Some paths are more than once in %s: %s" % (
+                    archives[side], _format_listed_paths(duplicates, duplicate_count)))
+    finally:
+        for reader in readers:
+            reader.close()
+        for members in unmatched:
+            members.close()
+        for archive_paths in paths:
+            archive_paths.close()
+
+    return total_files, errors, "\n".join(reported) or SAME_MEMBERS
+
+
+class UnmatchedMembers(object):
+    """
+    The members of an archive that haven't been matched with those of another archive yet, by path. They are kept in
+    memory until they take up more than `max_memory` bytes, when they are all moved to a table of an SQLite database
+    in a temporary file. Several members may have the same path, should it be more than once in the archive: they are
+    matched in the order they were kept in.
+    """
+
+    def __init__(self, max_memory=INVENTORY_MEMORY):
+        """
+        :param max_memory: int - The memory the members may take up before they are moved to disk, in bytes
+        """
+        self.max_memory = max_memory
+        self._members = {}
+        self._length = 0
+        self._memory = 0
+        self._database_path = None
+        self._connection = None
+
+    def __len__(self):
+        return self._length
+
+    def put(self, member):
+        """
+        :param member: ArchiveMember - The member to keep until it is matched, after any kept with the same path
+        """
+        self._members.setdefault(member.path, []).append(member)
+        self._length += 1
+        self._memory += len(member.path) + _MEMBER_OVERHEAD
+        if self._memory > self.max_memory:
+            self._spill()
+
+    def get(self, path):
+        """
+        :param path: str - The path of a member
+        :return: member: ArchiveMember - The first member kept with this path, or None if there isn't one
+        """
+        return self._first(path, forget=False)
+
+    def pop(self, path):
+        """
+        :param path: str - The path of a member
+        :return: member: ArchiveMember - The first member kept with this path, forgotten from now on, or None if there
+            isn't one
+        """
+        return self._first(path, forget=True)
+
+    def _first(self, path, forget):
+        # Those on disk were kept before those in memory
+        if self._connection is not None:
+            row = self._connection.execute(
+                "SELECT rowid, * FROM members WHERE path = ? ORDER BY rowid LIMIT 1", (path, )).fetchone()
+            if row is not None:
+                if forget:
+                    self._connection.execute("DELETE FROM members WHERE rowid = ?", (row[0], ))
+                    self._length -= 1
+                return ArchiveMember(*row[1:])
+        members = self._members.get(path)
+        if not members:
+            return None
+        if not forget:
+            return members[0]
+        member = members.pop(0)
+        if not members:
+            del self._members[path]
+        self._length -= 1
+        self._memory -= len(path) + _MEMBER_OVERHEAD
+        return member
+
+    def paths(self):
+        """
+        :return: a generator of the paths of the members still unmatched, in sorted order (with a path as many times
+            as there are members with it)
+        """
+        paths = [iter(sorted(member.path for member in self._members_in_memory()))]
+        if self._connection is not None:
+            paths.append(row[0] for row in self._connection.execute("SELECT path FROM members ORDER BY path"))
+        return heapq.merge(*paths)
+
+    @property
+    def spilled(self):
+        """
+        Whether the members have been moved to disk.
+        """
+        return self._connection is not None
+
+    def _members_in_memory(self):
+        return itertools.chain.from_iterable(self._members.itervalues())
+
+    def _spill(self):
+        """
+        Moves the members in memory to disk.
+        """
+        if self._connection is None:
+            database_file, self._database_path = tempfile.mkstemp(prefix='tarcheck-members-', suffix='.sqlite')
+            os.close(database_file)
+            self._connection = sqlite3.connect(self._database_path)
+            self._connection.text_factory = str
+            self._connection.execute(
+                "CREATE TABLE members (path TEXT, type TEXT, size INTEGER, mtime INTEGER, linkname TEXT, digest TEXT, "
+                "mode INTEGER, uid INTEGER, gid INTEGER)")
+            self._connection.execute("CREATE INDEX members_path ON members (path)")
+        self._connection.executemany(
+            "INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self._members_in_memory())
+        self._members = {}
+        self._memory = 0
 
+    def close(self):
+        """
+        Deletes the members on disk.
+        """
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+            os.remove(self._database_path)
 
-def is_excluded(string, wildcard=None, regex=None):
-    if not wildcard and not regex:
-        # No exclusion criteria, therefore not excluded
+
+class _MembersInBackground(object):
+    """
+    Streams through the members of an archive in a thread of its own, so that several archives are read at the same
+    time. Iterating over it gives the members, and raises the errors reading them.
+    """
+
+    def __init__(self, members, max_pending=256):
+        """
+        :param members: iterable - The members, e.g. as given by `iter_archive_members`
+        :param max_pending: int - The number of members read ahead, at most
+        """
+        self._queue = Queue.Queue(max_pending)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._read, args=(members, ))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self, members):
+        try:
+            for member in members:
+                if not self._put((member, None)):
+                    return
+            self._put((None, None))
+        except Exception:
+            self._put((None, sys.exc_info()))
+
+    def _put(self, item):
+        """
+        :return: bool - False if reading has been stopped before the item could be queued
+        """
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
         return False
-    if wildcard:
-        return fnmatch.fnmatch(string, wildcard)
-    if regex:
-        pattern = re.compile(regex)
-        if pattern.match(string) is not None:
+
+    def __iter__(self):
+        while True:
+            member, error = _get_from_queue(self._queue)
+            if error:
+                raise error[0], error[1], error[2]
+            if member is None:
+                return
+            yield member
+
+    def close(self):
+        """
+        Stops reading the archive.
+        """
+        self._stopped.set()
+        self._thread.join()
+
+
+def is_selected(path, only):
+    """
+    :param path: str - The path of a member of the archive
+    :param only: list - The paths of the members to select, or of the directories to select the members of
+    :return: bool - True if the member is one of the given paths or is inside one of them
+    """
+    for selected_path in only:
+        selected_path = selected_path.rstrip('/')
+        if path == selected_path or path.startswith(selected_path + '/'):
             return True
-        return False
+    return False
 
 
-def filter_excluded_from_list(list, exclude_wildcard=None, exclude_regex=None):
+INDEX_SUFFIX = '.index'
+
+# A member of an indexed archive, with the offset of its data in the uncompressed tar (None if it can't be read at
+# random, as for sparse files)
+IndexedMember = collections.namedtuple(
+    'IndexedMember', ['path', 'type', 'size', 'mtime', 'linkname', 'data_offset', 'mode', 'uid', 'gid'])
+
+
+def get_default_index_path(archive_path):
     """
-    Filters excluded strings from the given list according to the given wildcard and regex exclusion rules.
-    :param list: the list to filter
-    :param exclude_wildcard: optional wildcard to strings from list
-    :param exclude_regex: optional regex to strings from list
-    :return: the filtered list
+    :param archive_path: str - The path to the archive
+    :return: index_path: str - The path of the index sitting next to the archive
     """
-    return [x for x in list if not is_excluded(x, exclude_wildcard, exclude_regex)]
+    return archive_path + INDEX_SUFFIX
+
+
+class ArchiveIndex(object):
+    """
+    Random-access index of the members of an archive, kept in an SQLite database.
+
+    For every member it records where its data starts in the uncompressed tar, and for compressed archives it records
+    checkpoints: places in the archive file where decompression can start afresh, with the offset in the uncompressed
+    tar they correspond to. Reading a member then only decompresses from the checkpoint before it.
+
+    Checkpoints are the starts of gzip members and bzip2 streams, so archives made of many of them - bgzip'ed
+    (BGZF) tars, tars compressed with pbzip2 or lbzip2 - can be read at random. A single-stream compressed archive only
+    has the checkpoint at its start: resuming inside a deflate stream needs zlib's inflatePrime and inside a bzip2
+    stream bit-aligned blocks, neither of which Python's zlib and bz2 modules can do.
+    """
+
+    def __init__(self, index_path):
+        """
+        :param index_path: str - The path to the SQLite database of the index, created if it doesn't exist
+        """
+        self.index_path = index_path
+        self._connection = sqlite3.connect(index_path)
+        # Member paths are byte strings that needn't be UTF-8:
+        self._connection.text_factory = str
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS archive (size INTEGER, mtime REAL, compression TEXT)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS members (path TEXT, type TEXT, size INTEGER, mtime INTEGER, "
+                "linkname TEXT, data_offset INTEGER, mode INTEGER, uid INTEGER, gid INTEGER)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS members_path ON members (path)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints (compressed_offset INTEGER, uncompressed_offset INTEGER)")
+
+    @classmethod
+    def build(cls, archive_path, index_path, checkpoint_spacing=2 ** 20):
+        """
+        Builds the index of an archive, with one pass through it.
+        :param archive_path: str - The path to the archive
+        :param index_path: str - The path to write the index to, replacing any index there
+        :param checkpoint_spacing: int - The minimum number of uncompressed bytes between checkpoints
+        :return: index: ArchiveIndex - The index
+        """
+        compression = detect_compression(archive_path)
+        if compression not in (None, 'gz', 'bz2'):
+            raise ValueError("ERROR: Only uncompressed, gzip and bzip2 archives can be indexed: %s" % archive_path)
+        archive_stat = os.stat(archive_path)
 
+        temporary_index_path = index_path + '.tmp'
+        if os.path.exists(temporary_index_path):
+            os.remove(temporary_index_path)
+        index = cls(temporary_index_path)
+        with open(archive_path, 'rb') as archive, index._connection:
+            reader = _StreamsReader(archive, compression, checkpoint_spacing=checkpoint_spacing)
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                members = []
+                for tar_info in tar:
+                    tar.members = []
+                    data_offset = tar_info.offset_data if not tar_info.issparse() else None
+                    members.append((
+                        tar_info.path, get_member_type(tar_info), tar_info.size, tar_info.mtime,
+                        tar_info.linkname or None, data_offset, tar_info.mode, tar_info.uid, tar_info.gid))
+                    if len(members) >= 10000:
+                        index._connection.executemany(
+                            "INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", members)
+                        members = []
+                index._connection.executemany("INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", members)
+            index._connection.executemany("INSERT INTO checkpoints VALUES (?, ?)", reader.checkpoints)
+            index._connection.execute(
+                "INSERT INTO archive VALUES (?, ?, ?)", (archive_stat.st_size, archive_stat.st_mtime, compression))
+        index.close()
+        os.rename(temporary_index_path, index_path)
+        return cls(index_path)
 
-def compare_checksum_of_all_archived_files_with_raw_files(archive_path, dir_path, exclude_wildcard=None, exclude_regex=None):
+    def matches(self, archive_path):
+        """
+        :param archive_path: str - The path to the archive
+        :return: bool - True if the index is of the archive as it is now (same size and modification time), and has
+            all that this version of tarcheck records about the members
+        """
+        columns = [column[1] for column in self._connection.execute("PRAGMA table_info(members)")]
+        if tuple(columns) != IndexedMember._fields:
+            return False
+        row = self._connection.execute("SELECT size, mtime FROM archive").fetchone()
+        archive_stat = os.stat(archive_path)
+        return row is not None and row == (archive_stat.st_size, archive_stat.st_mtime)
+
+    @property
+    def compression(self):
+        return self._connection.execute("SELECT compression FROM archive").fetchone()[0]
+
+    def checkpoints(self):
+        """
+        :return: checkpoints: list - The (compressed offset, uncompressed offset) of each checkpoint, in order
+        """
+        return self._connection.execute(
+            "SELECT compressed_offset, uncompressed_offset FROM checkpoints ORDER BY uncompressed_offset").fetchall()
+
+    def members(self, only=None):
+        """
+        :param only: list - Optional paths of the only members to give, or of the directories to give the members of
+        :return: a generator of the IndexedMember of each (selected) member, in the order they are in the archive
+        """
+        if not only:
+            query, parameters = "SELECT * FROM members ORDER BY rowid", ()
+        else:
+            conditions = []
+            parameters = []
+            for selected_path in only:
+                selected_path = selected_path.rstrip('/')
+                # The members inside a directory are those with a path between "directory/" and "directory0":
+                conditions.append("path = ? OR (path >= ? AND path < ?)")
+                parameters.extend([selected_path, selected_path + '/', selected_path + '0'])
+            query = "SELECT * FROM members WHERE %s ORDER BY rowid" % " OR ".join(
+                "(%s)" % condition for condition in conditions)
+        for row in self._connection.execute(query, parameters):
+            yield IndexedMember(*row)
+
+    def close(self):
+        self._connection.close()
+
+
+def iter_indexed_archive_members(
+        archive_path, index, only=None, exclude_wildcard=None, exclude_regex=None, algorithms=DEFAULT_ALGORITHMS,
+        skip_members=0, checksum_filter=None):
     """
+    Goes straight to the given members of an archive using its index, checksumming the files that aren't excluded.
     :param archive_path: str - The path to the archive
-    :param dir_path: str - The path to the archived directory
-    :return: total_files, errors: int, list - The number of files found, a list of errors found
-        in the archive and a list of files that differ from the raw version
+    :param index: ArchiveIndex - The index of the archive
+    :param only: list - Optional paths of the only members to give, or of the directories to give the members of
+    :param exclude_wildcard: optional wildcard for the files not to checksum
+    :param exclude_regex: optional regex for the files not to checksum
+    :param algorithms: list - The names of the hash algorithms to checksum the files with
+    :param skip_members: int - The number of (selected) members at the start of the archive not to checksum. They
+        are still given, without checksums, but none of the archive is read for them
+    :param checksum_filter: callable - Optional filter of the files to checksum, as for `iter_archive_members`
+    :return: a generator of the ArchiveMember of each (selected) member, in the order they are in the archive
     """
-    if not archive_path:
-        raise ValueError("Missing path to the tar archive to checksum.")
-    if not os.path.isdir(dir_path):
-        raise ValueError("The directory path to the raw data doesn't point to a directory")
+    if not index.matches(archive_path):
+        raise ValueError("ERROR: The archive has changed since its index was built: %s" % archive_path)
+    with open(archive_path, 'rb') as archive:
+        reader = _SeekableArchiveReader(archive, index.compression, index.checkpoints())
+        for number, indexed_member in enumerate(index.members(only)):
+            member = ArchiveMember(
+                indexed_member.path, indexed_member.type, indexed_member.size, indexed_member.mtime,
+                indexed_member.linkname, None, indexed_member.mode, indexed_member.uid, indexed_member.gid)
+            if number >= skip_members and member.type == FILE_MEMBER and not is_excluded(
+                    member.path, exclude_wildcard, exclude_regex) and (not checksum_filter or checksum_filter(member)):
+                if indexed_member.data_offset is None:
+                    logging.warning("This member can't be read from the index, skipping checksum for: %s"
+                                    % member.path)
+                else:
+                    reader.seek(indexed_member.data_offset)
+                    with STATS.stage('archive_checksum', member.size):
+                        member = member._replace(digest=calculate_digests(
+                            _LimitedReader(_timed_reader(reader), member.size), algorithms,
+                            get_block_size(member.size)))
+            yield member
 
-    total_files = 0
-    errors = []
-    raw_dir_parent = os.path.abspath(os.path.join(dir_path, os.pardir))
 
-    with tarfile.open(name=archive_path, mode="r|*") as tar:
-        for tar_info in tar:
-            if not tar_info.isfile():
-                logging.info("This is not a file - skipping checksum for: %s" % tar_info.path)
-                continue
-            if tar_info.issym():
-                logging.warning("This archive contains symlinks that aren't de-referenced: %s" % tar_info.path)
-                continue
+class _StreamsReader(object):
+    """
+    Read-only file object decompressing a file made of one or more gzip members or bzip2 streams (or an uncompressed
+    file), keeping track of where each stream starts in the file and in the decompressed data.
+    """
 
-            # Exclude members
-            if exclude_regex or exclude_wildcard:
-                if is_excluded(tar_info.name, exclude_wildcard, exclude_regex):
-                    continue
+    def __init__(self, file_obj, compression, compressed_offset=0, uncompressed_offset=0, checkpoint_spacing=None,
+                 read_size=2 ** 20):
+        """
+        :param file_obj: file - The compressed file, positioned at the start of a stream
+        :param compression: str - 'gz', 'bz2' or None if the file isn't compressed
+        :param compressed_offset: int - The offset of the position of the file
+        :param uncompressed_offset: int - The offset in the decompressed data the position of the file corresponds to
+        :param checkpoint_spacing: int - The minimum number of decompressed bytes between recorded checkpoints. No
+            checkpoints are recorded if None
+        :param read_size: int - The number of compressed bytes to read at a time
+        """
+        self.compression = compression
+        self.position = uncompressed_offset
+        self.checkpoints = [(compressed_offset, uncompressed_offset)] if checkpoint_spacing else []
+        self._file_obj = file_obj
+        self._compressed_offset = compressed_offset
+        self._checkpoint_spacing = checkpoint_spacing
+        self._read_size = read_size
+        self._decompressor = self._new_decompressor()
+        self._decompressed_offset = uncompressed_offset
+        self._stream_start = None
+        self._finished = False
+        self._pending = ''
+        self._data = ''
+        self._data_offset = 0
+
+    def read(self, size=-1):
+        """
+        :param size: int - The maximum number of bytes to read, or a negative number to read everything left
+        :return: data: str - The decompressed data, empty at the end of the file
+        """
+        data = []
+        while size != 0:
+            if self._data_offset >= len(self._data):
+                self._data = self._next_data()
+                self._data_offset = 0
+                if not self._data:
+                    break
+            end = len(self._data) if size < 0 else min(len(self._data), self._data_offset + size)
+            data.append(self._data[self._data_offset:end])
+            if size > 0:
+                size -= end - self._data_offset
+            self._data_offset = end
+        data = ''.join(data)
+        self.position += len(data)
+        return data
+
+    def skip(self, size):
+        """
+        :param size: int - The number of decompressed bytes to skip
+        """
+        while size > 0:
+            data = self.read(min(size, self._read_size))
+            if not data:
+                break
+            size -= len(data)
+
+    def _new_decompressor(self):
+        if self.compression == 'bz2':
+            return bz2.BZ2Decompressor()
+        if self.compression == 'gz':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return None
+
+    def _next_data(self):
+        """
+        :return: data: str - The next piece of decompressed data, empty at the end of the file
+        """
+        while not self._finished:
+            if self._pending:
+                compressed, self._pending = self._pending, ''
+            else:
+                compressed = self._file_obj.read(self._read_size)
+                if not compressed:
+                    return ''
+            if self._decompressor is None:
+                self._compressed_offset += len(compressed)
+                return compressed
+
+            if self._stream_start:
+                # A new stream is starting where the previous one ended:
+                self._record_checkpoint(*self._stream_start)
+                self._stream_start = None
+
+            # Offset of the end of the compressed data given to the decompressor:
+            compressed_end = self._compressed_offset + len(compressed)
+            data = self._decompressor.decompress(compressed)
+            self._decompressed_offset += len(data)
+            stream_ended = self._stream_ended()
+            unused_data = self._decompressor.unused_data if stream_ended else ''
+            self._compressed_offset = compressed_end - len(unused_data)
+            if stream_ended:
+                if unused_data and not unused_data.startswith(_COMPRESSION_MAGIC_BY_NAME[self.compression]):
+                    # Trailing garbage (e.g. padding) after the last stream:
+                    self._finished = True
+                self._decompressor = self._new_decompressor()
+                self._pending = unused_data
+                self._stream_start = (self._compressed_offset, self._decompressed_offset)
+            if data:
+                return data
+        return ''
+
+    def _stream_ended(self):
+        if self.compression == 'bz2':
+            return _bzip2_stream_ended(self._decompressor)
+        # zlib only shows the end of a gzip member through data it didn't use
+        return bool(self._decompressor.unused_data)
+
+    def _record_checkpoint(self, compressed_offset, uncompressed_offset):
+        if not self._checkpoint_spacing:
+            return
+        if uncompressed_offset - self.checkpoints[-1][1] >= self._checkpoint_spacing:
+            self.checkpoints.append((compressed_offset, uncompressed_offset))
 
-            # Pretending to extract each file - getting back a handle, but the file isn't actually extracted:
-            archived_file_handle = tar.extractfile(tar_info)
-            if not archived_file_handle:
+
+class _SeekableArchiveReader(object):
+    """
+    Reads the decompressed data of an archive at random, starting decompression from the closest checkpoint.
+    """
+
+    def __init__(self, file_obj, compression, checkpoints):
+        """
+        :param file_obj: file - The archive file
+        :param compression: str - 'gz', 'bz2' or None if the archive isn't compressed
+        :param checkpoints: list - The (compressed offset, uncompressed offset) of the checkpoints, in order
+        """
+        self._file_obj = file_obj
+        self._compression = compression
+        self._checkpoints = checkpoints or [(0, 0)]
+        self._reader = None
+
+    def seek(self, offset):
+        """
+        :param offset: int - The offset in the decompressed data to go to
+        """
+        if self._compression is None:
+            self._file_obj.seek(offset)
+            self._reader = self._file_obj
+            return
+        checkpoint = max(checkpoint for checkpoint in self._checkpoints if checkpoint[1] <= offset)
+        # Carrying on from where we are is no slower than starting afresh from the checkpoint:
+        if self._reader is None or not checkpoint[1] <= self._reader.position <= offset:
+            self._file_obj.seek(checkpoint[0])
+            self._reader = _StreamsReader(self._file_obj, self._compression, checkpoint[0], checkpoint[1])
+        self._reader.skip(offset - self._reader.position)
+
+    def read(self, size=-1):
+        return self._reader.read(size)
+
+
+class _LimitedReader(object):
+    """
+    Read-only file object giving at most a given number of bytes from another one.
+    """
+
+    def __init__(self, file_obj, size):
+        self._file_obj = file_obj
+        self._remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file_obj.read(size) if size else ''
+        self._remaining -= len(data)
+        return data
+
+
+# A file or folder found by `scan_directory`: its path relative to the scanned directory, and its stat (following
+# symlinks, like os.stat)
+DirectoryEntry = collections.namedtuple('DirectoryEntry', ['path', 'stat'])
+
+
+def _list_directory(directory_path):
+    """
+    :param directory_path: str - The directory to list
+    :return: a list of the name and lstat of each entry in the directory
+    """
+    if scandir is not None:
+        listing = []
+        for entry in scandir(directory_path):
+            try:
+                listing.append((entry.name, entry.stat(follow_symlinks=False)))
+            except OSError:
+                # Gone since the directory was listed
+                pass
+        return listing
+
+    listing = []
+    for name in os.listdir(directory_path):
+        try:
+            listing.append((name, os.lstat(os.path.join(directory_path, name))))
+        except OSError:
+            pass
+    return listing
+
+
+def _scan_one_directory(directory_path, relative_directory, rules):
+    """
+    Lists one directory of the directory tree being scanned.
+    :param directory_path: str - The root of the directory tree
+    :param relative_directory: str - The path of the directory to list, relative to the root
+    :param rules: ExclusionRules - The files and folders to leave out
+    :return: entries, subdirectories: list, list - The DirectoryEntry of each (not excluded) entry in the directory,
+        and the relative paths of its subdirectories to scan next
+    """
+    with STATS.stage('scan'):
+        entries = []
+        subdirectories = []
+        absolute_directory = os.path.join(directory_path, relative_directory)
+        try:
+            listing = _list_directory(absolute_directory)
+        except OSError as e:
+            # Like os.walk, carry on with the rest of the tree
+            logging.warning("Can't list the directory %s: %s" % (absolute_directory, e))
+            return entries, subdirectories
+
+        for name, entry_stat in listing:
+            relative_path = os.path.join(relative_directory, name)
+            if rules and rules.matches(relative_path):
                 continue
+            if stat.S_ISDIR(entry_stat.st_mode):
+                subdirectories.append(relative_path)
+            elif stat.S_ISLNK(entry_stat.st_mode):
+                try:
+                    entry_stat = os.stat(os.path.join(directory_path, relative_path))
+                except OSError:
+                    # A broken link
+                    pass
+                else:
+                    if stat.S_ISDIR(entry_stat.st_mode):
+                        # Links to directories aren't followed, or listed, like os.walk does
+                        continue
+            entries.append(DirectoryEntry(relative_path, entry_stat))
+        return entries, subdirectories
 
-            # Checksum the tared up file:
-            archived_file_md5 = calculate_md5(archived_file_handle)
-
-            # Trying to see if only the contents of the dir was archived or also the parent dir is in the archive:
-            raw_file_path = os.path.abspath(os.path.join(dir_path, tar_info.path))
-            if not os.path.exists(raw_file_path):
-                raw_file_path = os.path.abspath(os.path.join(raw_dir_parent, tar_info.path))
-                if not os.access(raw_file_path, os.R_OK):
-                    err_msg = "ERROR: This user can't access all the files in this directory: %s" % raw_file_path
-                    raise ValueError(err_msg)
-                if not os.path.isfile(raw_file_path):
-                    err_msg = "ERROR: The directory given as input doesn't contain all the files in the archive: %s" % raw_file_path
-                    raise ValueError(err_msg)
-
-            # Checksum the raw file
-            with open(raw_file_path) as raw_file:
-                raw_file_md5 = calculate_md5(raw_file)
-
-            # Compare md5s:
-            if raw_file_md5 != archived_file_md5:
-                error = tar_info.path+ " "+raw_file_md5+" != "+archived_file_md5
-                errors.append(error)
-            tar.members = []
-            total_files += 1
-    return (total_files, errors)
+
+def _scan_one_directory_safely(directory_path, relative_directory, rules):
+    """
+    As `_scan_one_directory`, but an error is given back along with the results rather than being raised, so that the
+    thread pool never loses a result.
+    """
+    try:
+        return _scan_one_directory(directory_path, relative_directory, rules) + (relative_directory, None)
+    except Exception as e:
+        return [], [], relative_directory, e
 
 
-def get_all_files_in_directory_recursively(directory_path):
+# How often threads blocked waiting on each other wake up, so that signals (SIGINT, SIGTERM) are still handled: in
+# Python 2, waiting without a timeout on a lock can't be interrupted
+WAIT_INTERVAL = 0.1
+
+
+def _get_from_queue(queue):
     """
-    Returns a list of all files (including folders) in a given directory.
-    :param directory_path: the directory for which files are to be found
-    :return: a list of the paths for all files in directory, where paths are relative to dir_path
+    :param queue: Queue.Queue - The queue to take an item from
+    :return: item - The next item of the queue, waited for without keeping signals from being handled
+    """
+    while True:
+        try:
+            return queue.get(timeout=WAIT_INTERVAL)
+        except Queue.Empty:
+            pass
+
+
+def _wait_for_result(result):
+    """
+    :param result: multiprocessing.pool.AsyncResult - The result of a task of a pool (or anything else with a `get`
+        method, e.g. a `_CompletedResult`)
+    :return: value - The value of the result, waited for without keeping signals from being handled
+    """
+    if hasattr(result, 'ready'):
+        while not result.ready():
+            result.wait(WAIT_INTERVAL)
+    return result.get()
+
+
+def scan_directory(directory_path, exclude_wildcard=None, exclude_regex=None, jobs=1):
+    """
+    Scans a directory tree, giving the stat of every file and folder in it along with its path, so that they don't
+    need to be stat'ed again. With several jobs, the subdirectories are listed in parallel, which pays off on
+    parallel filesystems such as Lustre, where listing a directory and stat'ing files are slow but scale.
+    :param directory_path: str - The directory to scan
+    :param exclude_wildcard: optional wildcard(s) for the files or folders to leave out. Excluded folders aren't listed
+    :param exclude_regex: optional regex(es) for the files or folders to leave out
+    :param jobs: int - The number of directories listed at the same time
+    :return: a generator of the DirectoryEntry of every file and folder in the directory, with paths relative to it.
+        A folder comes before what's in it, but the order is otherwise arbitrary with several jobs. The entries are
+        given as the directories are listed, so a whole tree is never held in memory
     """
-    relative_file_paths = []
+    rules = get_exclusion_rules(exclude_wildcard, exclude_regex)
 
-    for root, directories, files in os.walk(directory_path):
-        relative_directory = root.replace(directory_path, "")
-        relative_directory = relative_directory.lstrip(os.sep)
+    if jobs <= 1:
+        to_scan = ['']
+        while to_scan:
+            directory_entries, subdirectories = _scan_one_directory(directory_path, to_scan.pop(), rules)
+            for entry in directory_entries:
+                yield entry
+            # Depth first, in the order the directories were listed in
+            to_scan.extend(reversed(subdirectories))
+        return
 
-        if root != directory_path:
-            relative_file_paths.append(relative_directory)
+    pool = ThreadPool(jobs)
+    scanned = Queue.Queue()
+    try:
+        pool.apply_async(_scan_one_directory_safely, (directory_path, '', rules), callback=scanned.put)
+        outstanding = 1
+        while outstanding:
+            directory_entries, subdirectories, relative_directory, error = _get_from_queue(scanned)
+            outstanding -= 1
+            if error is not None:
+                raise error
+            for subdirectory in subdirectories:
+                pool.apply_async(
+                    _scan_one_directory_safely, (directory_path, subdirectory, rules), callback=scanned.put)
+                outstanding += 1
+            for entry in directory_entries:
+                yield entry
+    finally:
+        pool.terminate()
+        pool.join()
 
-        for file_name in files:
-            relative_file_path = os.path.join(relative_directory, file_name)
-            relative_file_paths.append(relative_file_path)
 
-    return relative_file_paths
+def get_all_files_in_directory_recursively(directory_path, exclude_wildcard=None, exclude_regex=None, jobs=1):
+    """
+    Returns a list of all files (including folders) in a given directory.
+    :param directory_path: the directory for which files are to be found
+    :param exclude_wildcard: optional wildcard(s) for the files or folders to leave out. Excluded folders aren't walked
+    :param exclude_regex: optional regex(es) for the files or folders to leave out
+    :param jobs: int - The number of directories listed at the same time
+    :return: a list of the paths for all files in directory, where paths are relative to dir_path
+    """
+    return [entry.path for entry in scan_directory(directory_path, exclude_wildcard, exclude_regex, jobs)]
 
 
-def get_all_files_in_archive(archive_path):
+def get_all_files_in_archive(archive_path, decompressor=AUTO_DECOMPRESSOR, decompress_jobs=None, index=None):
     """
     Returns a list of all files (including folders) in a given archive.
     :param archive_path: the path to the archive in which files are to be found
+    :param decompressor: the decompression backend, one of DECOMPRESSORS
+    :param decompress_jobs: the number of cores decompression may use. Defaults to all the cores
+    :param index: optional ArchiveIndex of the archive to list the files from, instead of reading the archive
     :return: a list of the paths for all files in the archive, where paths are relative to the root of the archive
     """
-    tar = tarfile.open(archive_path)
-    files = [f.path.replace(archive_path, "") for f in tar.getmembers()]
+    if index and index.matches(archive_path):
+        return [member.path.replace(archive_path, "") for member in index.members()]
+
+    files = []
+    with open_archive_stream(archive_path, decompressor, decompress_jobs) as tar:
+        for tar_info in tar:
+            tar.members = []
+            files.append(tar_info.path.replace(archive_path, ""))
     return files
 
 
@@ -205,28 +4065,260 @@ def get_files_in_directory_not_in_archive(
     :param exclude_regex: optional regex to exclude certain files or folders
     :return: a list of files that are in the given directory but not in the given archive. Empty list if no difference
     """
-    files_in_dir = get_all_files_in_directory_recursively(directory_path)
+    files_in_dir = get_all_files_in_directory_recursively(directory_path, exclude_wildcard, exclude_regex)
     files_in_archive = get_all_files_in_archive(archive_path)
+    return find_files_not_in_archive(
+        files_in_dir, files_in_archive, ignore_leading_directories_in_archive, exclude_wildcard, exclude_regex)
 
-    # Strips n leading directories from all paths in archive, where n=archive_strip_components
-    files_in_archive = [os.sep.join(x.split(os.sep)[ignore_leading_directories_in_archive:]) for x in files_in_archive]
 
-    # Find files in directory but not in archive
-    missing_files = [x for x in files_in_dir if x not in files_in_archive]
+def find_files_not_in_archive(
+        files_in_dir, files_in_archive, ignore_leading_directories_in_archive=0, exclude_wildcard=None,
+        exclude_regex=None):
+    """
+    Gets a list of what files out of those in a directory are not in the given list of archive members.
+    :param files_in_dir: the paths of the files in the directory, relative to the directory
+    :param files_in_archive: the paths of the members of the archive, relative to the root of the archive
+    :param ignore_leading_directories_in_archive: ignores the leading n directories in the archive paths
+    :param exclude_wildcard: optional wildcard to exclude certain files or folders
+    :param exclude_regex: optional regex to exclude certain files or folders
+    :return: a list of files that are in the directory but not in the archive. Empty list if no difference
+    """
+    with STATS.stage('inventory'):
+        # Strips n leading directories from all paths in archive, where n=archive_strip_components
+        files_in_archive = set(
+            strip_leading_directories(x, ignore_leading_directories_in_archive) for x in files_in_archive)
 
-    # Apply filters
-    missing_files = filter_excluded_from_list(missing_files, exclude_wildcard, exclude_regex)
+        # Find files in directory but not in archive
+        missing_files = [x for x in files_in_dir if x not in files_in_archive]
+
+        # Apply filters
+        missing_files = filter_excluded_from_list(missing_files, exclude_wildcard, exclude_regex)
 
     return missing_files
 
 
+def strip_leading_directories(path, leading_directories):
+    """
+    :param path: str - A path in the archive
+    :param leading_directories: int - The number of leading directories to strip, like tar's --strip-components
+    :return: path: str - The path without its leading directories, empty if it hasn't got more components than that
+    """
+    if not leading_directories:
+        return path
+    components = path.split(os.sep, leading_directories)
+    return components[leading_directories] if len(components) > leading_directories else ''
+
+
+class PathList(object):
+    """
+    A list of paths that takes up a bounded amount of memory. The paths are kept in memory until they take up more
+    than `max_memory` bytes, when they are sorted and written out to a temporary file as a sorted run. The paths are
+    read back in sorted order by merging the runs, as an external sort does.
+    """
+
+    def __init__(self, paths=(), max_memory=INVENTORY_MEMORY):
+        """
+        :param paths: iterable - The paths to start with
+        :param max_memory: int - The memory the paths may take up before they are written to disk, in bytes
+        """
+        self.max_memory = max_memory
+        self._paths = []
+        self._memory = 0
+        self._length = 0
+        self._runs = []
+        for path in paths:
+            self.append(path)
+
+    def append(self, path):
+        """
+        :param path: str - The path to add
+        """
+        self._paths.append(path)
+        self._length += 1
+        self._memory += len(path) + _PATH_OVERHEAD
+        if self._memory > self.max_memory:
+            self._write_run()
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return self.sorted_paths()
+
+    @property
+    def spilled(self):
+        """
+        Whether some of the paths have been written to disk.
+        """
+        return bool(self._runs)
+
+    def sorted_paths(self):
+        """
+        :return: a generator of the paths, sorted and without duplicates
+        """
+        previous = None
+        for path in self._merge_runs():
+            if path != previous:
+                yield path
+                previous = path
+
+    def duplicates(self):
+        """
+        :return: a generator of the paths added more than once, sorted
+        """
+        previous = duplicate = None
+        for path in self._merge_runs():
+            if path == previous and path != duplicate:
+                yield path
+                duplicate = path
+            previous = path
+
+    def _merge_runs(self):
+        """
+        :return: a generator of all the paths added, sorted
+        """
+        self._paths.sort()
+        # The runs share the memory allowed while they are read back, however many of them there are:
+        read_size = max(2 ** 12, min(2 ** 20, self.max_memory // (2 * len(self._runs) or 1)))
+        runs = [_read_path_run(run_path, read_size) for run_path in self._runs]
+        return heapq.merge(iter(self._paths), *runs)
+
+    def close(self):
+        """
+        Deletes the paths written to disk.
+        """
+        for run_path in self._runs:
+            os.remove(run_path)
+        self._runs = []
+        self._paths = []
+
+    def _write_run(self):
+        self._paths.sort()
+        run_file, run_path = tempfile.mkstemp(prefix='tarcheck-paths-')
+        self._runs.append(run_path)
+        with os.fdopen(run_file, 'wb') as run:
+            for path in self._paths:
+                # Paths can't have NUL characters in them
+                run.write(path)
+                run.write('\0')
+        self._paths = []
+        self._memory = 0
+
+
+def _read_path_run(run_path, read_size=2 ** 20):
+    """
+    :param run_path: str - The path to a sorted run written by a PathList
+    :param read_size: int - The number of bytes read at a time
+    :return: a generator of the paths in the run
+    """
+    with open(run_path, 'rb') as run:
+        remainder = ''
+        while True:
+            data = run.read(read_size)
+            if not data:
+                break
+            paths = (remainder + data).split('\0')
+            remainder = paths.pop()
+            for path in paths:
+                yield path
+
+
+def _merge_sorted_paths(paths, other_paths):
+    """
+    Goes through two sorted sequences of unique paths together, like a merge join.
+    :return: a generator of (path, in_paths, in_other_paths) for every path in either sequence, in sorted order
+    """
+    paths = iter(paths)
+    other_paths = iter(other_paths)
+    path = next(paths, None)
+    other_path = next(other_paths, None)
+    while path is not None or other_path is not None:
+        if other_path is None or (path is not None and path < other_path):
+            yield path, True, False
+            path = next(paths, None)
+        elif path is None or other_path < path:
+            yield other_path, False, True
+            other_path = next(other_paths, None)
+        else:
+            yield path, True, True
+            path = next(paths, None)
+            other_path = next(other_paths, None)
+
+
+# The difference between the files in a directory and the members of the archive made from it:
+# - leading_directories: the number of leading directories of the archive paths that aren't in the directory paths
+# - not_in_archive: the files in the directory that aren't in the archive
+# - not_in_directory: the members of the archive (with their leading directories stripped) that aren't in the directory
+# - not_in_archive_count, not_in_directory_count: the number of each, when only the first of them are listed
+InventoryDifference = collections.namedtuple(
+    'InventoryDifference',
+    ['leading_directories', 'not_in_archive', 'not_in_directory', 'not_in_archive_count', 'not_in_directory_count'])
+
+
+def compare_inventories(
+        files_in_dir, files_in_archive, exclude_wildcard=None, exclude_regex=None, max_leading_directories=1,
+        max_memory=INVENTORY_MEMORY, max_listed=None):
+    """
+    Compares the files in a directory with the members of the archive made from it, both ways. How many leading
+    directories the archive paths have on top of the directory paths (none if only the contents of the directory were
+    archived, one if the directory itself was) is worked out from the same sorted paths, as the number of leading
+    directories that makes the most archive paths match files in the directory. The paths are kept in PathLists, so
+    that memory use is bounded however many there are: the comparisons are merges of sorted paths.
+    :param files_in_dir: the paths of the files in the directory, relative to the directory, or a PathList of them
+    :param files_in_archive: the paths of the members of the archive, relative to the root of the archive
+    :param exclude_wildcard: optional wildcard(s) to exclude certain files or folders
+    :param exclude_regex: optional regex(es) to exclude certain files or folders
+    :param max_leading_directories: int - The largest number of leading directories to try
+    :param max_memory: int - The memory each list of paths may take up before it is sorted on disk, in bytes
+    :param max_listed: int - The number of paths missing from either side to list, at most (all of them if None). The
+        rest are only counted, so that the differences take up bounded memory however many there are
+    :return: difference: InventoryDifference - The differences, in sorted order
+    """
+    rules = get_exclusion_rules(exclude_wildcard, exclude_regex)
+    with STATS.stage('inventory'):
+        directory_paths = files_in_dir if isinstance(files_in_dir, PathList) else PathList(files_in_dir, max_memory)
+        stripped_archive_paths = [PathList(max_memory=max_memory) for _ in range(max_leading_directories + 1)]
+        try:
+            for archive_path in files_in_archive:
+                for leading_directories, stripped_paths in enumerate(stripped_archive_paths):
+                    stripped_path = strip_leading_directories(archive_path, leading_directories)
+                    if stripped_path and stripped_path != '.':
+                        stripped_paths.append(stripped_path)
+
+            matches = []
+            for stripped_paths in stripped_archive_paths:
+                matches.append(sum(
+                    1 for _, in_directory, in_archive in _merge_sorted_paths(
+                        directory_paths.sorted_paths(), stripped_paths.sorted_paths())
+                    if in_directory and in_archive))
+            leading_directories = matches.index(max(matches))
+
+            not_in_archive = []
+            not_in_directory = []
+            counts = [0, 0]
+            for path, in_directory, in_archive in _merge_sorted_paths(
+                    directory_paths.sorted_paths(), stripped_archive_paths[leading_directories].sorted_paths()):
+                if in_directory and in_archive or rules and rules.matches(path):
+                    continue
+                counts[in_archive] += 1
+                if max_listed is None or counts[in_archive] <= max_listed:
+                    (not_in_archive if in_directory else not_in_directory).append(path)
+        finally:
+            for stripped_paths in stripped_archive_paths:
+                stripped_paths.close()
+            if directory_paths is not files_in_dir:
+                directory_paths.close()
+    return InventoryDifference(leading_directories, not_in_archive, not_in_directory, counts[0], counts[1])
+
+
 def memory_usage():
     """
     Memory usage of the current process in kilobytes.
-    :return:
+    :return: a dict of the peak virtual memory ('peak'), the resident set size ('rss') and the peak resident set size
+        ('hwm')
     """
     status = None
-    result = {'peak': 0, 'rss': 0}
+    result = {'peak': 0, 'rss': 0, 'hwm': 0}
     try:
         # This will only work on systems with a /proc file system
         # (like Linux).
@@ -236,22 +4328,383 @@ def memory_usage():
             key = parts[0][2:-1].lower()
             if key in result:
                 result[key] = int(parts[1])
+    except IOError:
+        # Elsewhere, at least the peak resident set size is known (in bytes on macOS, kilobytes elsewhere)
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['hwm'] = max_rss // 1024 if sys.platform == 'darwin' else max_rss
     finally:
         if status is not None:
             status.close()
     return result
 
 
+# A verification of a batch: the archive, the directory it was made from, the exclusion rules and the timeout in
+# seconds (None for the batch's timeout)
+BatchJob = collections.namedtuple('BatchJob', ['tar_path', 'dir', 'exclude_wildcard', 'exclude_regex', 'timeout'])
+
+# The outcomes of the verifications of a batch
+BATCH_OK = 'ok'
+BATCH_DIFFERENT = 'different'
+BATCH_FAILED = 'failed'
+BATCH_TIMED_OUT = 'timed out'
+
+
+def read_batch_jobs(job_list_path):
+    """
+    Reads the list of verifications to run as a batch. A .json file has a list of objects with "tar_path" and "dir"
+    and optionally "exclude", "exclude_regex" (a string or a list of them) and "timeout". Any other file is
+    tab-separated, with a line per verification: the archive path, the directory, then optionally an exclusion
+    wildcard and an exclusion regex. Empty lines and lines starting with "#" are ignored.
+    :param job_list_path: str - The path to the list
+    :return: jobs: list - The BatchJob of each verification
+    """
+    jobs = []
+    with open(job_list_path) as job_list:
+        if job_list_path.endswith('.json'):
+            for job in json.load(job_list):
+                if 'tar_path' not in job or 'dir' not in job:
+                    raise ValueError("ERROR: Every job needs a tar_path and a dir: %s" % job)
+                jobs.append(BatchJob(
+                    _from_json(job['tar_path']), _from_json(job['dir']), _from_json(job.get('exclude')),
+                    _from_json(job.get('exclude_regex')), job.get('timeout')))
+            return jobs
+
+        for line_number, line in enumerate(job_list, 1):
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) < 2 or len(fields) > 4:
+                raise ValueError("ERROR: Line %d of %s should be: tar_path, dir[, exclude[, exclude_regex]], "
+                                 "separated by tabs" % (line_number, job_list_path))
+            fields += [None] * (4 - len(fields))
+            jobs.append(BatchJob(fields[0], fields[1], fields[2] or None, fields[3] or None, None))
+    return jobs
+
+
+def _from_json(value):
+    """
+    :param value: a string, list of strings or None read from JSON
+    :return: the value with byte strings rather than unicode ones
+    """
+    if isinstance(value, list):
+        return [_from_json(item) for item in value]
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def run_batch_job(job, verify_options=None):
+    """
+    Verifies an archive of a batch against its directory.
+    :param job: BatchJob - The verification
+    :param verify_options: dict - Optional keyword arguments for `verify_archive`, e.g. jobs or algorithms
+    :return: result: dict - The tar_path, dir, status (one of BATCH_OK, BATCH_DIFFERENT or BATCH_FAILED),
+        total_files, errors, report, message (for failures) and seconds it took
+    """
+    result = {'tar_path': job.tar_path, 'dir': job.dir, 'total_files': None, 'errors': [], 'report': None,
+              'message': None}
+    start = time.time()
+    try:
+        total_files, errors, report = verify_archive(
+            job.tar_path, job.dir, job.exclude_wildcard, job.exclude_regex, **(verify_options or {}))
+    except Exception as e:
+        result.update(status=BATCH_FAILED, message=str(e) or e.__class__.__name__)
+    else:
+        result.update(
+            status=BATCH_OK if not errors and report == ALL_FILES_IN_ARCHIVE else BATCH_DIFFERENT,
+            total_files=total_files, errors=errors, report=report)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def _run_batch_job_process(number, job, verify_options, results):
+    """
+    Runs a verification of a batch in its own process, giving its result back through a queue. The process leads a
+    process group of its own, so that the decompressors it starts can be killed along with it.
+    """
+    os.setpgid(0, 0)
+    results.put((number, run_batch_job(job, verify_options)))
+
+
+def _kill_batch_job(process):
+    """
+    Kills a verification of a batch, and the decompressors it has started.
+    :param process: multiprocessing.Process - The process running the verification
+    """
+    process.terminate()
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # The process group is gone already, or the process hadn't made it yet
+        pass
+    process.join()
+
+
+def _get_filesystems(job):
+    """
+    :param job: BatchJob - A verification
+    :return: filesystems: set - The devices of the filesystems the archive and the directory are on
+    """
+    filesystems = set()
+    for path in (job.tar_path, job.dir):
+        try:
+            filesystems.add(os.stat(path).st_dev)
+        except OSError:
+            # The verification will fail and report it
+            pass
+    return filesystems
+
+
+def run_batch(jobs, batch_jobs=None, filesystem_jobs=None, timeout=None, verify_options=None, poll_interval=0.5):
+    """
+    Runs a batch of verifications, several at the same time, each in its own process. Verifications that take longer
+    than their timeout are killed.
+    :param jobs: list - The BatchJob of each verification
+    :param batch_jobs: int - The number of verifications run at the same time. Defaults to the number of cores
+        divided by the cores each verification uses: its `jobs` and its `decompress_jobs` (at least one). When
+        `decompress_jobs` isn't given, the verifications share out the cores left for decompression, rather than each
+        decompressing on all the cores
+    :param filesystem_jobs: int - Optional limit to the number of verifications reading from the same filesystem at
+        the same time, so that a filesystem isn't swamped with I/O
+    :param timeout: float - Optional number of seconds after which a verification is killed, for the jobs that don't
+        have their own
+    :param verify_options: dict - Optional keyword arguments for `verify_archive`
+    :param poll_interval: float - The number of seconds between checks for timed out verifications
+    :return: results: list - The result of each verification, as given by `run_batch_job`, in the order of the jobs
+    """
+    verify_options = dict(verify_options or {})
+    cores = multiprocessing.cpu_count()
+    checksum_jobs = max(1, verify_options.get('jobs') or 1)
+    decompress_jobs = verify_options.get('decompress_jobs')
+    if batch_jobs is None:
+        batch_jobs = max(1, cores // (checksum_jobs + (decompress_jobs or 1)))
+    if decompress_jobs is None:
+        verify_options['decompress_jobs'] = max(1, cores // batch_jobs - checksum_jobs)
+    waiting = collections.deque(enumerate(jobs))
+    results = [None] * len(jobs)
+    finished = multiprocessing.Queue()
+    running = {}
+    filesystem_use = collections.Counter()
+
+    def finish(number, result):
+        process, started, filesystems = running.pop(number)
+        process.join()
+        filesystem_use.subtract(filesystems)
+        results[number] = result
+
+    try:
+        while waiting or running:
+            # Start whatever verifications the limits allow, in order, but without one waiting on a busy filesystem
+            # holding up those after it:
+            for _ in range(len(waiting)):
+                if len(running) >= batch_jobs:
+                    break
+                number, job = waiting.popleft()
+                filesystems = _get_filesystems(job)
+                if filesystem_jobs and any(filesystem_use[filesystem] >= filesystem_jobs for filesystem in filesystems):
+                    waiting.append((number, job))
+                    continue
+                process = multiprocessing.Process(
+                    target=_run_batch_job_process, args=(number, job, verify_options, finished))
+                process.daemon = True
+                process.start()
+                running[number] = (process, time.time(), filesystems)
+                filesystem_use.update(filesystems)
+            if waiting:
+                # Keep the jobs in their order
+                waiting = collections.deque(sorted(waiting))
+
+            try:
+                number, result = finished.get(timeout=poll_interval)
+            except Queue.Empty:
+                pass
+            else:
+                finish(number, result)
+
+            now = time.time()
+            for number, (process, started, filesystems) in running.items():
+                job = jobs[number]
+                job_timeout = job.timeout if job.timeout is not None else timeout
+                if job_timeout is not None and now - started > job_timeout:
+                    _kill_batch_job(process)
+                    finish(number, {
+                        'tar_path': job.tar_path, 'dir': job.dir, 'status': BATCH_TIMED_OUT, 'total_files': None,
+                        'errors': [], 'report': None, 'message': "Killed after %s seconds" % job_timeout,
+                        'seconds': now - started})
+                elif not process.is_alive():
+                    # It may have finished since the queue was checked - otherwise it died without a result
+                    while True:
+                        try:
+                            finished_number, result = finished.get(timeout=poll_interval)
+                        except Queue.Empty:
+                            break
+                        finish(finished_number, result)
+                    if number in running:
+                        finish(number, {
+                            'tar_path': job.tar_path, 'dir': job.dir, 'status': BATCH_FAILED, 'total_files': None,
+                            'errors': [], 'report': None,
+                            'message': "The verification stopped with exit code %s" % process.exitcode,
+                            'seconds': now - started})
+    finally:
+        for process, _, _ in running.values():
+            _kill_batch_job(process)
+    return results
+
+
+def summarize_batch(results):
+    """
+    :param results: list - The results of the verifications of a batch, as given by `run_batch`
+    :return: report: dict - The machine-readable report of the batch: a summary of how many verifications had each
+        outcome, and the results
+    """
+    summary = collections.Counter(result['status'] for result in results)
+    return {
+        'summary': dict((status, summary[status])
+                        for status in (BATCH_OK, BATCH_DIFFERENT, BATCH_FAILED, BATCH_TIMED_OUT)),
+        'jobs': results,
+    }
+
+
+# The output formats: the errors once the verification is over, or the result of each file as soon as it is known
+TEXT_FORMAT = 'text'
+JSONL_FORMAT = 'jsonl'
+OUTPUT_FORMATS = (TEXT_FORMAT, JSONL_FORMAT)
+
+
 def parse_args():
     """
     Parses the arguments given via the command line.
     :return: parsed arguments
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument('--tar_path', required=True, help='Path to the tar archive')
-    parser.add_argument('--dir', required=True, help='Path to the directory that has been archived')
-    parser.add_argument('--exclude', required=False, help='A shell wildcard telling which files to exclude by name')
-    parser.add_argument('--exclude_regex', required=False, help='A regex telling which files to exclude by name')
+    parser.add_argument('--tar_path', required=False, help='Path to the tar archive (required unless --batch is given)')
+    parser.add_argument('--dir', required=False,
+                        help='Path to the directory that has been archived (required unless --batch is given)')
+    parser.add_argument('--exclude', required=False, action='append',
+                        help='A shell wildcard telling which files to exclude by name. Can be given more than once')
+    parser.add_argument('--exclude_regex', required=False, action='append',
+                        help='A regex telling which files to exclude by name. Can be given more than once')
+    parser.add_argument('--exclude_from', required=False, action='append',
+                        help='A file of exclusion rules, one per line: shell wildcards, or regexes prefixed with '
+                             '"regex:". Can be given more than once')
+    parser.add_argument('--jobs', required=False, type=int, default=1,
+                        help='Number of threads checksumming the raw files while the archive is being read')
+    parser.add_argument('--scan_jobs', required=False, type=int,
+                        help='Number of threads listing the directories of the dir at the same time, which speeds up '
+                             'parallel filesystems such as Lustre (default: the same as --jobs)')
+    parser.add_argument('--inventory_memory', required=False, type=int, default=INVENTORY_MEMORY // 2 ** 20,
+                        help='The memory in MB that the paths of the files in the dir, and of the members of the '
+                             'archive, may each take up before they are sorted on disk (default: %(default)s)')
+    parser.add_argument('--decompressor', required=False, choices=DECOMPRESSORS, default=AUTO_DECOMPRESSOR,
+                        help='How to decompress the archive (default: the fastest available)')
+    parser.add_argument('--decompress_jobs', required=False, type=int,
+                        help='Number of cores used for decompressing the archive (default: all of them)')
+    parser.add_argument('--checksum_cache', required=False,
+                        help='Path to a database caching the checksums of the files in the directory between runs')
+    parser.add_argument('--checksum_cache_max_entries', required=False, type=int, default=10 ** 7,
+                        help='Maximum number of checksums kept in the cache (default: 10 million)')
+    parser.add_argument('--checksum_cache_max_age', required=False, type=float,
+                        help='Number of days after which an unused checksum is evicted from the cache')
+    parser.add_argument('--manifest', required=False, action='store_true',
+                        help='Verify the directory against the manifest next to the archive if there is one for this '
+                             'archive, or write it while verifying the archive otherwise')
+    parser.add_argument('--manifest_path', required=False,
+                        help='Path to the manifest, if not next to the archive (implies --manifest)')
+    parser.add_argument('--check_archive_checksum', required=False, action='store_true',
+                        help='Check the checksum of the archive against its manifest, not only its size and '
+                             'modification time')
+    parser.add_argument('--index', required=False, action='store_true',
+                        help='Use the index next to the archive (<tar_path>.index) to read the --only members at '
+                             'random, or to go straight past the members already verified (--resume) or out of the '
+                             '--sample, building it first if there is none for this archive. It is neither built nor '
+                             'used when all of the archive is verified')
+    parser.add_argument('--journal', required=False, action='store_true',
+                        help='Keep a journal of the verified files next to the archive (<tar_path>.journal), flushed '
+                             'every few seconds, so that the verification can be resumed with --resume if it is '
+                             'stopped. The journal is deleted once the verification completes')
+    parser.add_argument('--journal_path', required=False,
+                        help='The path to the journal, if it shouldn\'t be next to the archive (implies --journal)')
+    parser.add_argument('--resume', required=False, action='store_true',
+                        help='Resume a verification that was stopped, from its journal: the files already verified '
+                             'are neither read from the archive nor from the dir again (implies --journal)')
+    parser.add_argument('--only', required=False, nargs='+', metavar='PATH',
+                        help='Only verify these members of the archive, or the members in these directories of the '
+                             'archive')
+    parser.add_argument('--algorithms', required=False, type=parse_algorithms,
+                        help='Comma separated checksum algorithms, all calculated in one read of each file and all '
+                             'of which have to match, e.g. md5,sha256 or a fast one such as crc32, xxh3, blake3 or '
+                             'crc32c when installed (default: md5, or those of the manifest used). Available: %s'
+                             % ', '.join(sorted(HASH_ALGORITHMS)))
+    parser.add_argument('--quick', required=False, action='store_true',
+                        help='Only compare the metadata of the files in the archive with their raw files (by default '
+                             'the size and modification time), without checksumming any of them')
+    parser.add_argument('--metadata', required=False, type=parse_metadata_fields,
+                        help='Comma separated metadata of the files to compare before checksumming them, out of %s. '
+                             'The size is always compared, and the raw files whose sizes differ are not checksummed '
+                             '(default: size, and mtime too with --quick)' % ', '.join(METADATA_FIELDS))
+    parser.add_argument('--batch', required=False,
+                        help='Verify all the archives in a job list rather than one: a .json file with a list of '
+                             '{"tar_path", "dir", optionally "exclude", "exclude_regex" and "timeout"}, or a file '
+                             'with a line per archive of tab-separated tar_path, dir and optionally exclude and '
+                             'exclude_regex. The verifications are run in their own processes, and a JSON report of '
+                             'all of them is printed')
+    parser.add_argument('--batch_jobs', required=False, type=int,
+                        help='Number of verifications of the batch run at the same time (default: the number of '
+                             'cores divided by the cores each uses, --jobs plus --decompress_jobs, at least one)')
+    parser.add_argument('--filesystem_jobs', required=False, type=int,
+                        help='Maximum number of verifications of the batch reading from the same filesystem at the '
+                             'same time (default: no limit)')
+    parser.add_argument('--timeout', required=False, type=float,
+                        help='Number of seconds after which a verification of the batch is killed (default: none)')
+    parser.add_argument('--batch_report', required=False,
+                        help='Path to write the JSON report of the batch to, rather than printing it')
+    parser.add_argument('--compare_with', required=False, metavar='OTHER_TAR_PATH',
+                        help='Compare the archive with another archive, e.g. its repacked version, instead of with '
+                             'the dir: both are read at the same time, and nothing is extracted')
+    parser.add_argument('--create', required=False, action='store_true',
+                        help='Create the archive from the dir instead of verifying it, checksumming the files as they '
+                             'are archived and writing the manifest of the archive (see --manifest_path), then read '
+                             'the archive back and verify it against its manifest. The archive is compressed as the '
+                             'suffix of its name says')
+    parser.add_argument('--compressor', required=False, choices=COMPRESSORS, default=AUTO_DECOMPRESSOR,
+                        help='With --create, the compression backend: tarfile (one core, no xz or zstd), external '
+                             '(pigz, lbzip2 or pbzip2, xz -T, zstd -T) or auto (default: external if installed and '
+                             'more than one core may be used)')
+    parser.add_argument('--compress_jobs', required=False, type=int,
+                        help='With --create, the number of cores used for compressing the archive (default: all of '
+                             'them)')
+    parser.add_argument('--prefetch', required=False, type=int, default=0, metavar='FILES',
+                        help='The number of members of the archive to look ahead of the one being verified, reading '
+                             'ahead the raw files that will be checksummed (default 0: none)')
+    parser.add_argument('--prefetch_memory', required=False, type=int, default=PREFETCH_MEMORY // 2 ** 20,
+                        help='The size in MB the raw files read ahead, and not checksummed yet, may add up to '
+                             '(default: %(default)s)')
+    parser.add_argument('--keep_going', required=False, action='store_true',
+                        help='Report the files of the archive that are missing from the directory, or can\'t be read, '
+                             'and carry on with the verification rather than stopping with an error')
+    parser.add_argument('--fail_fast', required=False, action='store_true',
+                        help='Stop at the first file that differs in any way, without reading the rest of the archive, '
+                             'and exit with status 1')
+    parser.add_argument('--sample', required=False, type=float, metavar='FRACTION',
+                        help='Only verify a random sample of the files, each with this probability, and report a bound '
+                             'on the differing files the sample may have missed')
+    parser.add_argument('--sample_by_bytes', required=False, action='store_true',
+                        help='With --sample, sample the bytes rather than the files, so that larger files are more '
+                             'likely to be verified')
+    parser.add_argument('--sample_seed', required=False, type=int, default=0,
+                        help='With --sample, the seed of the sample: the same seed gives the same sample (default 0)')
+    parser.add_argument('--sample_confidence', required=False, type=float, default=SAMPLE_CONFIDENCE,
+                        help='With --sample, the confidence of the bound on the differing files missed (default %s)'
+                             % SAMPLE_CONFIDENCE)
+    parser.add_argument('--format', required=False, choices=OUTPUT_FORMATS, default=TEXT_FORMAT,
+                        help='The output format: text (default), or jsonl for a line of JSON per file as soon as it '
+                             'is verified, followed by a summary line')
+    parser.add_argument('--stats', required=False, action='store_true',
+                        help='Print the time, bytes, calls, throughput and peak memory use of each stage of the '
+                             'verification at the end, as JSON')
+    parser.add_argument('--progress', required=False, type=float, metavar='SECONDS',
+                        help='Write a progress line to stderr every SECONDS seconds')
     parser.add_argument('--log', required=False, help='Logging level, see: https://docs.python.org/2/howto/logging.html')
 
     try:
@@ -260,8 +4713,13 @@ def parse_args():
         print "%s: %s" % (e.strerror, e.filename)
         parser.print_help()
         sys.exit(1)
-    else:
-        return args
+    if not args.batch and (not args.tar_path or not args.dir and not args.compare_with):
+        parser.error("--tar_path and --dir are required, unless --batch or --compare_with is given")
+    # The algorithms given, if any, to check against those of a manifest:
+    args.given_algorithms = args.algorithms
+    if args.algorithms is None:
+        args.algorithms = DEFAULT_ALGORITHMS
+    return args
 
 
 def set_user_defined_logging_level(log_level):
@@ -288,29 +4746,62 @@ def report_files_in_directory_but_not_in_archive(
     :param exclude_regex: optional regex to exclude certain files or folders
     :return: report of what files are in the directory but not in the archive
     """
-    files_in_directory = get_all_files_in_directory_recursively(directory_path)
-    files_in_directory = filter_excluded_from_list(files_in_directory, exclude_wildcard=None, exclude_regex=None)
+    files_in_directory = get_all_files_in_directory_recursively(directory_path, exclude_wildcard, exclude_regex)
+    files_in_archive = get_all_files_in_archive(archive_path)
+    return report_missing_files(files_in_directory, files_in_archive, exclude_wildcard, exclude_regex)
+
 
-    archive_ignore_leading_directories = 0
+# The report of an inventory check that found all the files of the directory in the archive
+ALL_FILES_IN_ARCHIVE = "All files in the directory are in the archive"
 
-    while archive_ignore_leading_directories <= 1:
-        missing_files = get_files_in_directory_not_in_archive(
-            directory_path, archive_path, archive_ignore_leading_directories, exclude_wildcard, exclude_regex)
 
-        if len(missing_files) == 0:
-            # All files in directory (minus excluded) were in archive
-            return "All files in the directory are in the archive"
+def report_missing_files(
+        files_in_directory, files_in_archive, exclude_wildcard=None, exclude_regex=None, max_memory=INVENTORY_MEMORY,
+        max_listed=MAX_REPORTED_PATHS):
+    """
+    Creates a report of what files out of those in a directory are not in the given list of archive members (if any),
+    considering any given exclusion criteria, and of the members of the archive that are not in the directory (if
+    any). The archive paths are matched with or without their leading directory, whichever fits, to cover archives
+    made with or without the parent directory.
+    :param files_in_directory: the paths of the files in the directory, relative to the directory
+    :param files_in_archive: the paths of the members of the archive, relative to the root of the archive
+    :param exclude_wildcard: optional wildcard to exclude certain files or folders
+    :param exclude_regex: optional regex to exclude certain files or folders
+    :param max_memory: the memory each list of paths may take up before it is sorted on disk, in bytes
+    :param max_listed: the number of files missing from either side listed in the report, at most. The report says
+        how many more there are
+    :return: report of what files are in the directory but not in the archive, and the other way round
+    """
+    difference = compare_inventories(
+        files_in_directory, files_in_archive, exclude_wildcard, exclude_regex, max_memory=max_memory,
+        max_listed=max_listed)
+    missing_files = _format_listed_paths(difference.not_in_archive, difference.not_in_archive_count)
+
+    if difference.not_in_archive_count == 0:
+        # All files in directory (minus excluded) were in archive
+        report = ALL_FILES_IN_ARCHIVE
+    elif difference.not_in_archive_count < len(files_in_directory):
+        # A strict subset of the set of files in the directory are in the set of files in the archive
+        report = "Some files in directory are missing from the archive: %s" % missing_files
+    else:
+        # All files are missing
+        report = "All files in the directory are missing from the archive: %s" % missing_files
 
-        elif len(missing_files) < len(files_in_directory):
-            # A strict subset of the set of files in the directory are in the set of files in the archive
-            return "Some files in directory are missing from the archive: %s" % missing_files
+    if difference.not_in_directory_count:
+        report += "\nSome members of the archive are missing from the directory: %s" % _format_listed_paths(
+            difference.not_in_directory, difference.not_in_directory_count)
+    return report
 
-        else:
-            # Maybe the tar file has more leading directories? i.e. everything parent/file, parent/folder/file
-            archive_ignore_leading_directories += 1
 
-    # All files are missing
-    return "All files in the directory are missing from the archive: %s" % files_in_directory
+def _format_listed_paths(paths, count):
+    """
+    :param paths: list - The first paths of a list
+    :param count: int - The number of paths in the whole list
+    :return: paths: str - The paths, followed by the number of those left out, if any
+    """
+    if count > len(paths):
+        return "%s and %d more" % (paths, count - len(paths))
+    return str(paths)
 
 
 if __name__ == '__main__':
@@ -319,23 +4810,272 @@ if __name__ == '__main__':
     if args.log:
         set_user_defined_logging_level(args.log)
 
-    # Report files that are in the directory but are not in the archive
-    print report_files_in_directory_but_not_in_archive(args.dir, args.tar_path, args.exclude, args.exclude_regex)
-
+    # All the exclusion rules are compiled once, up front:
     try:
-        total_files, errors = compare_checksum_of_all_archived_files_with_raw_files(
-            args.tar_path, args.dir, args.exclude, args.exclude_regex)
+        for rules_path in args.exclude_from or []:
+            wildcards, regexes = read_exclusion_rules(rules_path)
+            args.exclude = (args.exclude or []) + wildcards
+            args.exclude_regex = (args.exclude_regex or []) + regexes
+        get_exclusion_rules(args.exclude, args.exclude_regex)
+    except IOError as e:
+        print "%s: %s" % (e.strerror, e.filename)
+        sys.exit(1)
+    except ValueError as e:
+        print e.message
+        sys.exit(1)
+
+    if args.batch:
+        try:
+            batch = run_batch(
+                read_batch_jobs(args.batch), args.batch_jobs, args.filesystem_jobs, args.timeout, {
+                    'jobs': args.jobs, 'decompressor': args.decompressor, 'decompress_jobs': args.decompress_jobs,
+                    'algorithms': args.algorithms, 'scan_jobs': args.scan_jobs,
+                    'inventory_memory': args.inventory_memory * 2 ** 20, 'quick': args.quick,
+                    'metadata_fields': args.metadata, 'keep_going': args.keep_going, 'fail_fast': args.fail_fast,
+                    'prefetch_files': args.prefetch, 'prefetch_memory': args.prefetch_memory * 2 ** 20})
+        except IOError as e:
+            print "%s: %s" % (e.strerror, e.filename)
+            sys.exit(1)
+        except ValueError as e:
+            print e.message
+            sys.exit(1)
+        batch_report = json.dumps(summarize_batch(batch), encoding='latin-1', indent=2, sort_keys=True)
+        if args.batch_report:
+            with open(args.batch_report, 'w') as batch_report_file:
+                batch_report_file.write(batch_report + '\n')
+        else:
+            print batch_report
+        # Like a single verification, which exits 1 on a difference, an incomplete inventory or an error, the batch
+        # fails if any of its verifications did:
+        sys.exit(0 if all(result['status'] == BATCH_OK for result in batch) else 1)
 
+    if args.stats or args.progress:
+        STATS.enable()
+        STATS.reset()
+    if args.progress:
+        STATS.start_progress(args.progress)
+
+    if args.compare_with:
+        try:
+            total_files, errors, report = compare_archives(
+                args.tar_path, args.compare_with, args.exclude, args.exclude_regex, args.decompressor,
+                args.decompress_jobs, args.algorithms, args.inventory_memory * 2 ** 20)
+        except ValueError as e:
+            print e.message
+            sys.exit(1)
+        finally:
+            STATS.stop_progress()
+        print report
+        print "Checksum algorithms: %s" % get_algorithms_name(args.algorithms)
         print "Total files in the archive: %s" % total_files
-        print "Number of files that differ between the archive and original: %d" % len(errors)
+        print "Number of files that differ between the archives: %d" % len(errors)
+        print "Peak memory use (RSS): %d kB" % memory_usage()['hwm']
+        if args.stats:
+            print "Stats:"
+            print json.dumps(STATS.report(), indent=2, sort_keys=True)
+        if errors:
+            print "FILES different:"
+            for err in errors:
+                print str(err)
+        sys.exit(0 if not errors and report == SAME_MEMBERS else 1)
 
+    if args.create:
+        # The files are checksummed as they are archived, and the archive is then read back once, against its manifest:
+        manifest_path = args.manifest_path or get_default_manifest_path(args.tar_path)
+        try:
+            create_archive(
+                args.tar_path, args.dir, manifest_path, args.exclude, args.exclude_regex, args.compressor,
+                args.compress_jobs, args.algorithms)
+            print "Archive created: %s" % args.tar_path
+            print "Manifest written: %s" % manifest_path
+            total_files, errors = verify_archive_against_manifest(
+                args.tar_path, manifest_path, args.decompressor, args.decompress_jobs)
+        except ValueError as e:
+            print e.message
+            sys.exit(1)
+        except EnvironmentError as e:
+            # E.g. the compressor failing, or the disk being full
+            print "ERROR: %s" % e
+            sys.exit(1)
+        finally:
+            STATS.stop_progress()
+        print "Checksum algorithms: %s" % get_algorithms_name(args.algorithms)
+        print "Total files in the archive: %s" % total_files
+        print "Number of files that differ between the archive and its manifest: %d" % len(errors)
+        print "Peak memory use (RSS): %d kB" % memory_usage()['hwm']
+        if args.stats:
+            print "Stats:"
+            print json.dumps(STATS.report(), indent=2, sort_keys=True)
         if errors:
             print "FILES different:"
             for err in errors:
                 print str(err)
+        # The archive just written isn't the one its manifest describes:
+        sys.exit(1 if errors else 0)
 
-    except ValueError as e:
-        print e.message
+    checksum_cache = None
+    if args.checksum_cache:
+        max_age = args.checksum_cache_max_age * 24 * 60 * 60 if args.checksum_cache_max_age is not None else None
+        checksum_cache = ChecksumCache(args.checksum_cache, args.checksum_cache_max_entries, max_age)
 
+    manifest_path = args.manifest_path
+    if args.manifest and not manifest_path:
+        manifest_path = get_default_manifest_path(args.tar_path)
 
+    journal_path = args.journal_path
+    if (args.journal or args.resume) and not journal_path:
+        journal_path = get_default_journal_path(args.tar_path)
+    journal = None
+    # Walltime limits and preemption stop jobs with SIGTERM: clean up as when interrupted, so the journal is flushed
+    signal.signal(signal.SIGTERM, _raise_system_exit)
 
+    index = None
+    summary = VerificationSummary()
+    different_files = 0
+    try:
+        use_manifest = manifest_path and os.path.exists(manifest_path) and manifest_matches_archive(
+            read_manifest_header(manifest_path), args.tar_path, args.check_archive_checksum)
+        if use_manifest:
+            args.algorithms = parse_algorithms(read_manifest_header(manifest_path)['algorithm'])
+            if args.given_algorithms is not None and args.given_algorithms != args.algorithms:
+                raise ValueError("ERROR: The manifest was written with %s, not %s: leave out --algorithms to verify "
+                                 "against it, or remove it to write a new one" % (
+                                     get_algorithms_name(args.algorithms), get_algorithms_name(args.given_algorithms)))
+        # A quick verification doesn't read enough to be worth resuming. A sample is neither journaled nor resumed -
+        # once verified, it would delete the journal of an earlier run that was stopped:
+        if journal_path and args.sample is not None:
+            logging.warning("The journal isn't written when verifying a sample - leaving %s as it is" % journal_path)
+        elif journal_path and not args.only and not args.quick:
+            journal = VerificationJournal(
+                journal_path, args.tar_path, args.dir, args.algorithms, args.exclude, args.exclude_regex, args.resume,
+                metadata_fields=get_metadata_fields(args.metadata))
+            if journal.verified_members:
+                logging.info("Resuming after the first %d members of the archive" % journal.verified_members)
+
+        if args.index:
+            index_path = get_default_index_path(args.tar_path)
+            if os.path.exists(index_path):
+                index = ArchiveIndex(index_path)
+            # Building the index is a pass through the whole archive, only worth it when just part of the archive is
+            # read afterwards - otherwise the archive is streamed as it would be without an index:
+            reads_part = args.only or not use_manifest and (
+                args.sample is not None or journal is not None and journal.verified_members)
+            if not reads_part:
+                logging.info("The index isn't needed to verify all of %s" % args.tar_path)
+            elif index is None or not index.matches(args.tar_path):
+                logging.info("Building the index of %s" % args.tar_path)
+                if index:
+                    index.close()
+                index = ArchiveIndex.build(args.tar_path, index_path)
+
+        sample = None
+        if args.sample is not None:
+            if not 0 < args.sample_confidence < 1:
+                raise ValueError("ERROR: The confidence of the bound has to be between 0 and 1: %s"
+                                 % args.sample_confidence)
+            sample = MemberSample(args.sample, args.sample_seed, args.sample_by_bytes)
+        if args.only:
+            results = iter_verify_archive(
+                args.tar_path, args.dir, args.exclude, args.exclude_regex, jobs=args.jobs,
+                decompressor=args.decompressor, decompress_jobs=args.decompress_jobs, checksum_cache=checksum_cache,
+                only=args.only, index=index, algorithms=args.algorithms, quick=args.quick,
+                metadata_fields=args.metadata, keep_going=args.keep_going, fail_fast=args.fail_fast,
+                prefetch_files=args.prefetch, prefetch_memory=args.prefetch_memory * 2 ** 20, summary=summary,
+                sample=sample)
+        elif use_manifest:
+            # The archive has already been read once - the directory is checked against its manifest instead:
+            results = iter_verify_archive_with_manifest(
+                manifest_path, args.dir, exclude_wildcard=args.exclude, exclude_regex=args.exclude_regex,
+                jobs=args.jobs, checksum_cache=checksum_cache, scan_jobs=args.scan_jobs,
+                inventory_memory=args.inventory_memory * 2 ** 20, journal=journal, quick=args.quick,
+                metadata_fields=args.metadata, keep_going=args.keep_going, fail_fast=args.fail_fast,
+                prefetch_files=args.prefetch, prefetch_memory=args.prefetch_memory * 2 ** 20, summary=summary,
+                sample=sample)
+        else:
+            # Checksums the archive and works out which files are missing from it in a single pass:
+            results = iter_verify_archive(
+                args.tar_path, args.dir, args.exclude, args.exclude_regex, jobs=args.jobs,
+                decompressor=args.decompressor, decompress_jobs=args.decompress_jobs, checksum_cache=checksum_cache,
+                manifest_path=manifest_path, algorithms=args.algorithms, scan_jobs=args.scan_jobs,
+                inventory_memory=args.inventory_memory * 2 ** 20, index=index, journal=journal, quick=args.quick,
+                metadata_fields=args.metadata, keep_going=args.keep_going, fail_fast=args.fail_fast,
+                prefetch_files=args.prefetch, prefetch_memory=args.prefetch_memory * 2 ** 20, summary=summary,
+                sample=sample)
+
+        if args.format == JSONL_FORMAT:
+            # Every result is written as soon as it is known, and nothing is kept:
+            for result in results:
+                print format_result_json(result)
+                sys.stdout.flush()
+                different_files += result.error is not None
+            different_files += len(summary.resumed_errors)
+            errors = None
+        else:
+            _, errors, _ = collect_errors(results, summary)
+            different_files = len(errors)
+        if journal and not summary.stopped:
+            journal.close(completed=True)
+        report = summary.report
+        if summary.stopped:
+            report = "Stopped at the first file that differs"
+        elif args.only:
+            report = "Only the given members were verified: %s" % args.only
+        sample_report = None
+        if sample and not summary.stopped:
+            # The bound on the differing files the sample may have missed:
+            report = (report + "\n" if args.only else "") + sample.format_report(
+                different_files, args.sample_confidence)
+            missed, missed_rate = sample.get_missed_bound(different_files, args.sample_confidence)
+            sample_report = {
+                'fraction': sample.fraction, 'seed': sample.seed, 'by_bytes': sample.by_bytes,
+                'total_files': sample.total_files, 'sampled_files': sample.sampled_files,
+                'total_bytes': sample.total_bytes, 'sampled_bytes': sample.sampled_bytes,
+                'confidence': args.sample_confidence, 'missed': missed, 'missed_rate': missed_rate}
+
+        if args.format == JSONL_FORMAT:
+            print format_summary_json(
+                summary, report, different_files, args.algorithms, args.metadata, args.quick, sample_report,
+                args.stats)
+        else:
+            # Report files that are in the directory but are not in the archive
+            print report
+
+            if args.quick:
+                print "Metadata compared: %s" % ", ".join(get_metadata_fields(args.metadata, quick=True))
+            else:
+                print "Checksum algorithms: %s" % get_algorithms_name(args.algorithms)
+            print "Total files in the archive: %s" % summary.total_files
+            print "Number of files that differ between the archive and original: %d" % different_files
+            print "Peak memory use (RSS): %d kB" % memory_usage()['hwm']
+            if args.stats:
+                print "Stats:"
+                print json.dumps(STATS.report(), indent=2, sort_keys=True)
+
+            if errors:
+                print "FILES different:"
+                for err in errors:
+                    print str(err)
+        # The verification fails if any file differs (or is missing from either side), or it stopped before the end:
+        inventory_incomplete = summary.report is not None and summary.report != ALL_FILES_IN_ARCHIVE
+        if different_files or inventory_incomplete or summary.stopped:
+            sys.exit(1)
+
+    except ValueError as e:
+        if args.format == JSONL_FORMAT:
+            # The lines already written stay valid JSON, and the summary says what was verified before the error:
+            print json.dumps({'type': 'error', 'error': e.message}, encoding='latin-1', sort_keys=True)
+            print format_summary_json(
+                summary, summary.report, different_files, args.algorithms, args.metadata, args.quick,
+                stats=args.stats, error=e.message)
+        else:
+            print e.message
+        sys.exit(1)
+
+    finally:
+        STATS.stop_progress()
+        if journal:
+            journal.close()
+        if checksum_cache:
+            checksum_cache.close()
+        if index:
+            index.close()
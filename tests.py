@@ -5,6 +5,21 @@ import tarcheck
 import os
 import logging
 import io
+import hashlib
+import bz2
+import zlib
+import gzip
+import shutil
+import subprocess
+import sys
+import tempfile
+import tarfile
+import json
+import time
+import signal
+import Queue
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 
 TEST_FILES_BASE_PATH = 'test-cases'
 
@@ -98,6 +113,950 @@ class DirContentPermissionDenied(unittest.TestCase):
         self.assertRaises(ValueError, tarcheck.compare_checksum_of_all_archived_files_with_raw_files, archive_path, dir_path)
 
 
+class TestCalculateDigests(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.calculate_digests`.
+    """
+    def test_default_is_md5(self):
+        self.assertEqual(tarcheck.calculate_digests(io.BytesIO(b'data')), hashlib.md5(b'data').hexdigest())
+
+    def test_several_algorithms_in_one_pass(self):
+        digests = tarcheck.calculate_digests(io.BytesIO(b'data' * 1000), ('sha256', 'crc32'), block_size=7)
+        self.assertEqual(digests, '%s,%08x' % (hashlib.sha256(b'data' * 1000).hexdigest(),
+                                               zlib.crc32(b'data' * 1000) & 0xffffffff))
+
+    def test_adler32(self):
+        self.assertEqual(tarcheck.calculate_digests(io.BytesIO(b'data'), ('adler32', )),
+                         '%08x' % (zlib.adler32(b'data') & 0xffffffff))
+
+    def test_parse_algorithms(self):
+        self.assertEqual(tarcheck.parse_algorithms('MD5, sha1'), ('md5', 'sha1'))
+        self.assertRaises(ValueError, tarcheck.parse_algorithms, 'md5,nohash')
+        self.assertRaises(ValueError, tarcheck.parse_algorithms, ',')
+
+    def test_register_hash_algorithm(self):
+        tarcheck.register_hash_algorithm('test-sha224', hashlib.sha224)
+        try:
+            self.assertEqual(tarcheck.calculate_digests(io.BytesIO(b'data'), tarcheck.parse_algorithms('test-sha224')),
+                             hashlib.sha224(b'data').hexdigest())
+        finally:
+            del tarcheck.HASH_ALGORITHMS['test-sha224']
+
+    def test_verify_archive_with_several_algorithms(self):
+        archive_path = 'test-cases/test-diff-content/test-data.tar.bz2'
+        dir_path = 'test-cases/test-diff-content/test-data'
+        total_files, errors, _ = tarcheck.verify_archive(archive_path, dir_path, algorithms=('crc32', 'sha1'), jobs=2)
+        self.assertEqual(total_files, 5)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('test-data/pip.txt '))
+
+
+class TestChecksumRawFile(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.checksum_raw_file`.
+    """
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.mmap_min_size = tarcheck.MMAP_MIN_SIZE
+
+    def tearDown(self):
+        tarcheck.MMAP_MIN_SIZE = self.mmap_min_size
+        shutil.rmtree(self.temp_directory)
+
+    def _write_file(self, data):
+        path = os.path.join(self.temp_directory, 'raw-file')
+        with open(path, 'wb') as raw_file:
+            raw_file.write(data)
+        return path
+
+    def test_read_file(self):
+        data = os.urandom(3 * 2 ** 20 + 5)
+        path = self._write_file(data)
+        self.assertEqual(tarcheck.checksum_raw_file(path), hashlib.md5(data).hexdigest())
+        self.assertEqual(tarcheck.checksum_raw_file(path, ('sha1', 'md5')),
+                         '%s,%s' % (hashlib.sha1(data).hexdigest(), hashlib.md5(data).hexdigest()))
+
+    def test_memory_mapped_file(self):
+        tarcheck.MMAP_MIN_SIZE = 1
+        data = os.urandom(2 ** 20 + 5)
+        self.assertEqual(tarcheck.checksum_raw_file(self._write_file(data)), hashlib.md5(data).hexdigest())
+
+    def test_empty_file(self):
+        tarcheck.MMAP_MIN_SIZE = 0
+        self.assertEqual(tarcheck.checksum_raw_file(self._write_file(b'')), hashlib.md5(b'').hexdigest())
+
+    def test_block_size(self):
+        self.assertEqual(tarcheck.get_block_size(10), 10)
+        self.assertEqual(tarcheck.get_block_size(0), 1)
+        self.assertEqual(tarcheck.get_block_size(2 ** 30), tarcheck.DEFAULT_BLOCK_SIZE)
+        self.assertEqual(tarcheck.get_block_size(None), tarcheck.DEFAULT_BLOCK_SIZE)
+
+
+class TestVerifyArchive(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.verify_archive`.
+    """
+    def test_same_content_all_files_in_archive(self):
+        archive_path = 'test-cases/test-same-content/test-data.tar.bz2'
+        dir_path = 'test-cases/test-same-content/test-data'
+        total_files, errors, report = tarcheck.verify_archive(archive_path, dir_path)
+        self.assertEqual(total_files, 5)
+        self.assertEqual(len(errors), 0)
+        self.assertEqual(report, "All files in the directory are in the archive")
+
+    def test_diff_content_reports_different_file(self):
+        archive_path = 'test-cases/test-diff-content/test-data.tar.bz2'
+        dir_path = 'test-cases/test-diff-content/test-data'
+        total_files, errors, report = tarcheck.verify_archive(archive_path, dir_path)
+        self.assertEqual(total_files, 5)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(report, "All files in the directory are in the archive")
+
+    def test_differences_logged_when_verification_fails(self):
+        temp_directory = tempfile.mkdtemp()
+        try:
+            dir_path = os.path.join(temp_directory, 'test-data')
+            shutil.copytree('test-cases/test-same-content/test-data', dir_path)
+            # A file that differs, before one that is missing in the archive
+            with open(os.path.join(dir_path, 'pip.txt'), 'a') as raw_file:
+                raw_file.write('more')
+            os.remove(os.path.join(dir_path, 'smth.err'))
+            records = []
+            handler = logging.Handler()
+            handler.emit = records.append
+            logging.root.addHandler(handler)
+            try:
+                self.assertRaises(ValueError, tarcheck.verify_archive,
+                                  'test-cases/test-same-content/test-data.tar.bz2', dir_path)
+            finally:
+                logging.root.removeHandler(handler)
+            self.assertIn('test-data/pip.txt size', '\n'.join(
+                record.getMessage() for record in records if record.levelno == logging.ERROR))
+        finally:
+            shutil.rmtree(temp_directory)
+
+    def test_only_contents_archived(self):
+        archive_path = 'test-cases/test-only-contents-archived/test-data.tar.bz2'
+        dir_path = 'test-cases/test-only-contents-archived/test-data'
+        total_files, errors, report = tarcheck.verify_archive(archive_path, dir_path)
+        self.assertEqual(total_files, 4)
+        self.assertEqual(report, "All files in the directory are in the archive")
+
+    def test_diff_content_with_jobs(self):
+        archive_path = 'test-cases/test-diff-content/test-data.tar.bz2'
+        dir_path = 'test-cases/test-diff-content/test-data'
+        total_files, errors, _ = tarcheck.verify_archive(archive_path, dir_path, jobs=3)
+        self.assertEqual(total_files, 5)
+        self.assertEqual(errors, ["test-data/pip.txt size 16 != 15"])
+
+    def test_files_missing_with_jobs(self):
+        archive_path = 'test-cases/test-files-missing/test-data.tar.bz2'
+        dir_path = 'test-cases/test-files-missing/test-data'
+        self.assertRaises(ValueError, tarcheck.verify_archive, archive_path, dir_path, jobs=2)
+
+    def test_without_inventory_check(self):
+        archive_path = 'test-cases/test-same-content/test-data.tar.bz2'
+        dir_path = 'test-cases/test-same-content/test-data'
+        _, _, report = tarcheck.verify_archive(archive_path, dir_path, check_inventory=False)
+        self.assertIsNone(report)
+
+
+class TestDecompressors(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.open_archive_stream` and the decompression backends.
+    """
+    archive_path = 'test-cases/test-same-content/test-data.tar.bz2'
+    dir_path = 'test-cases/test-same-content/test-data'
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        with open(self.archive_path, 'rb') as archive:
+            self.tar_data = bz2.decompress(archive.read())
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_detect_compression(self):
+        self.assertEqual(tarcheck.detect_compression(self.archive_path), 'bz2')
+        self.assertIsNone(tarcheck.detect_compression(self.__write_archive('test-data.tar', self.tar_data)))
+
+    def test_uncompressed_archive(self):
+        archive_path = self.__write_archive('test-data.tar', self.tar_data)
+        self.__expect_verified(archive_path, tarcheck.AUTO_DECOMPRESSOR)
+
+    def test_tarfile_decompressor(self):
+        self.__expect_verified(self.archive_path, tarcheck.TARFILE_DECOMPRESSOR)
+
+    def test_bzip2_blocks_decompressor_with_single_stream(self):
+        self.__expect_verified(self.archive_path, tarcheck.BZIP2_BLOCKS_DECOMPRESSOR)
+
+    def test_bzip2_blocks_decompressor_with_multiple_streams(self):
+        streams = [bz2.compress(self.tar_data[i:i + 1000]) for i in range(0, len(self.tar_data), 1000)]
+        archive_path = self.__write_archive('test-data.tar.bz2', ''.join(streams))
+        self.assertTrue(tarcheck.is_multistream_bzip2(archive_path))
+        self.__expect_verified(archive_path, tarcheck.BZIP2_BLOCKS_DECOMPRESSOR)
+
+    def test_parallel_bzip2_reader_with_chunks_cut_inside_streams(self):
+        streams = [bz2.compress(self.tar_data[i:i + 3000]) for i in range(0, len(self.tar_data), 3000)]
+        reader = tarcheck.ParallelBZ2Reader(io.BytesIO(''.join(streams)), 2, read_size=100, max_chunk_size=150)
+        try:
+            self.assertEqual(reader.read(), self.tar_data)
+        finally:
+            reader.close()
+
+    def test_parallel_bzip2_reader_within_memory(self):
+        streams = [bz2.compress(self.tar_data[i:i + 1000]) for i in range(0, len(self.tar_data), 1000)]
+        reader = tarcheck.ParallelBZ2Reader(io.BytesIO(''.join(streams)), 4, read_size=100, max_memory=1)
+        try:
+            self.assertEqual(reader.read(), self.tar_data)
+        finally:
+            reader.close()
+
+    def test_external_decompressor_writing_many_errors(self):
+        archive_path = self.__write_archive('test-data.tar', self.tar_data)
+        # More errors than a pipe holds, before any output
+        command = ['sh', '-c', 'head -c 1000000 /dev/zero | tr "\\0" x >&2; cat "$0"']
+        find_external_decompressor = tarcheck.find_external_decompressor
+        tarcheck.find_external_decompressor = lambda compression, jobs: command
+        try:
+            self.__expect_verified(archive_path, tarcheck.EXTERNAL_DECOMPRESSOR)
+        finally:
+            tarcheck.find_external_decompressor = find_external_decompressor
+
+    @unittest.skipUnless(find_executable('xz'), "xz is not installed")
+    def test_external_decompressor_with_xz(self):
+        archive_path = self.__compress_with(['xz', '-c'], 'test-data.tar.xz')
+        self.assertEqual(tarcheck.choose_decompressor(archive_path), tarcheck.EXTERNAL_DECOMPRESSOR)
+        self.__expect_verified(archive_path, tarcheck.AUTO_DECOMPRESSOR)
+
+    @unittest.skipUnless(find_executable('zstd'), "zstd is not installed")
+    def test_external_decompressor_with_zstd(self):
+        archive_path = self.__compress_with(['zstd', '-q', '-c'], 'test-data.tar.zst')
+        self.assertEqual(tarcheck.detect_compression(archive_path), 'zst')
+        self.__expect_verified(archive_path, tarcheck.EXTERNAL_DECOMPRESSOR)
+
+    def test_unknown_decompressor(self):
+        self.assertRaises(ValueError, tarcheck.get_all_files_in_archive, self.archive_path, 'unknown')
+
+    def __write_archive(self, name, data):
+        archive_path = os.path.join(self.temp_directory, name)
+        with open(archive_path, 'wb') as archive:
+            archive.write(data)
+        return archive_path
+
+    def __compress_with(self, command, name):
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        compressed, _ = process.communicate(self.tar_data)
+        return self.__write_archive(name, compressed)
+
+    def __expect_verified(self, archive_path, decompressor):
+        total_files, errors, report = tarcheck.verify_archive(
+            archive_path, self.dir_path, decompressor=decompressor, decompress_jobs=2)
+        self.assertEqual(total_files, 5)
+        self.assertEqual(len(errors), 0)
+        self.assertEqual(report, "All files in the directory are in the archive")
+
+
+class TestMetadataPrefilter(unittest.TestCase):
+    """
+    Unit tests for comparing the metadata of the files before checksumming them, and for quick mode.
+    """
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.dir_path = os.path.join(self.temp_directory, 'test-data')
+        os.mkdir(self.dir_path)
+        for name, data in (('a.txt', 'aaaa'), ('b.txt', 'bbbb'), ('c.txt', 'cccc')):
+            with open(os.path.join(self.dir_path, name), 'w') as raw_file:
+                raw_file.write(data)
+        self.archive_path = os.path.join(self.temp_directory, 'test-data.tar')
+        with tarfile.open(self.archive_path, 'w') as tar:
+            tar.add(self.dir_path, 'test-data')
+        self.calculate_digests = tarcheck.calculate_digests
+        self.checksum_raw_file = tarcheck.checksum_raw_file
+
+    def tearDown(self):
+        tarcheck.calculate_digests = self.calculate_digests
+        tarcheck.checksum_raw_file = self.checksum_raw_file
+        shutil.rmtree(self.temp_directory)
+
+    def _count_checksums(self):
+        checksummed = {'archived': 0, 'raw': 0}
+
+        def calculate_digests(*args):
+            checksummed['archived'] += 1
+            return self.calculate_digests(*args)
+
+        def checksum_raw_file(*args):
+            checksummed['raw'] += 1
+            return self.checksum_raw_file(*args)
+        tarcheck.calculate_digests = calculate_digests
+        tarcheck.checksum_raw_file = checksum_raw_file
+        return checksummed
+
+    def test_compare_metadata(self):
+        member = tarcheck.ArchiveMember('a.txt', tarcheck.FILE_MEMBER, 4, 1000.5, None, None, 0o100644, 1, 2)
+        os.utime(os.path.join(self.dir_path, 'a.txt'), (1000, 1000))
+        raw_file_stat = os.stat(os.path.join(self.dir_path, 'a.txt'))
+        self.assertEqual(tarcheck.compare_metadata(member, raw_file_stat, tarcheck.QUICK_METADATA_FIELDS), [])
+        self.assertEqual(tarcheck.compare_metadata(member._replace(size=5), raw_file_stat), [('size', 4, 5)])
+        # Unknown metadata isn't compared:
+        self.assertEqual(tarcheck.compare_metadata(member._replace(uid=None), raw_file_stat, ('uid', )), [])
+
+    def test_parse_metadata_fields(self):
+        self.assertEqual(tarcheck.parse_metadata_fields('mtime, mode'), ('mtime', 'mode'))
+        self.assertRaises(ValueError, tarcheck.parse_metadata_fields, 'mtime,colour')
+        self.assertEqual(tarcheck.get_metadata_fields(('mode', 'size')), ('size', 'mode'))
+        self.assertEqual(tarcheck.get_metadata_fields(quick=True), tarcheck.QUICK_METADATA_FIELDS)
+
+    def test_raw_files_of_different_sizes_not_checksummed(self):
+        with open(os.path.join(self.dir_path, 'b.txt'), 'w') as raw_file:
+            raw_file.write('bbbbb')
+        checksummed = self._count_checksums()
+        total_files, errors, _ = tarcheck.verify_archive(self.archive_path, self.dir_path, jobs=2)
+        self.assertEqual(total_files, 3)
+        self.assertEqual(errors, ['test-data/b.txt size 5 != 4'])
+        # The archived file is still checksummed, for any hard links to it
+        self.assertEqual(checksummed, {'archived': 3, 'raw': 2})
+
+    def test_files_of_same_size_checksummed(self):
+        with open(os.path.join(self.dir_path, 'b.txt'), 'w') as raw_file:
+            raw_file.write('BBBB')
+        total_files, errors, _ = tarcheck.verify_archive(self.archive_path, self.dir_path)
+        self.assertEqual(total_files, 3)
+        self.assertEqual(errors, ['test-data/b.txt %s != %s' % (
+            hashlib.md5('BBBB').hexdigest(), hashlib.md5('bbbb').hexdigest())])
+
+        # One error for the file, with its metadata and its checksum:
+        os.utime(os.path.join(self.dir_path, 'b.txt'), (1000, 1000))
+        _, errors, _ = tarcheck.verify_archive(self.archive_path, self.dir_path, metadata_fields=('mtime', ))
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('test-data/b.txt mtime 1000 != '))
+        self.assertTrue(errors[0].endswith(', %s != %s' % (
+            hashlib.md5('BBBB').hexdigest(), hashlib.md5('bbbb').hexdigest())))
+
+    def test_quick(self):
+        checksummed = self._count_checksums()
+        self.assertEqual(tarcheck.verify_archive(self.archive_path, self.dir_path, quick=True),
+                         (3, [], "All files in the directory are in the archive"))
+
+        os.utime(os.path.join(self.dir_path, 'c.txt'), (1000, 1000))
+        os.chmod(os.path.join(self.dir_path, 'a.txt'), 0o600)
+        mode = oct(os.stat(os.path.join(self.dir_path, 'b.txt')).st_mode & 0o777)
+        total_files, errors, _ = tarcheck.verify_archive(
+            self.archive_path, self.dir_path, quick=True, metadata_fields=('mtime', 'mode'))
+        self.assertEqual(total_files, 3)
+        # The files are in the archive in the order they were listed in:
+        errors.sort()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(errors[0], "test-data/a.txt mode 0600 != %s" % mode)
+        self.assertTrue(errors[1].startswith('test-data/c.txt mtime 1000 != '))
+        self.assertEqual(checksummed, {'archived': 0, 'raw': 0})
+
+    def test_quick_with_manifest(self):
+        manifest_path = tarcheck.get_default_manifest_path(self.archive_path)
+        tarcheck.verify_archive(self.archive_path, self.dir_path, manifest_path=manifest_path)
+        os.utime(os.path.join(self.dir_path, 'c.txt'), (1000, 1000))
+        total_files, errors, _ = tarcheck.verify_archive_with_manifest(
+            manifest_path, self.dir_path, self.archive_path, quick=True)
+        self.assertEqual(total_files, 3)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('test-data/c.txt mtime 1000 != '))
+
+
+class TestHardLinks(unittest.TestCase):
+    """
+    Unit tests for verifying the hard links of an archive, and checksumming each file once however many links it has.
+    """
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.dir_path = os.path.join(self.temp_directory, 'test-data')
+        os.mkdir(self.dir_path)
+        with open(os.path.join(self.dir_path, 'genome.fa'), 'w') as raw_file:
+            raw_file.write('ACGT' * 1000)
+        os.link(os.path.join(self.dir_path, 'genome.fa'), os.path.join(self.dir_path, 'genome-link.fa'))
+        os.link(os.path.join(self.dir_path, 'genome.fa'), os.path.join(self.dir_path, 'genome-link2.fa'))
+        self.archive_path = os.path.join(self.temp_directory, 'test-data.tar')
+        with tarfile.open(self.archive_path, 'w') as tar:
+            for name in ('genome.fa', 'genome-link.fa', 'genome-link2.fa'):
+                tar.add(os.path.join(self.dir_path, name), os.path.join('test-data', name))
+        self.calculate_digests = tarcheck.calculate_digests
+        self.checksum_raw_file = tarcheck.checksum_raw_file
+
+    def tearDown(self):
+        tarcheck.calculate_digests = self.calculate_digests
+        tarcheck.checksum_raw_file = self.checksum_raw_file
+        shutil.rmtree(self.temp_directory)
+
+    def _count_checksums(self):
+        checksummed = {'archived': 0, 'raw': 0}
+
+        def calculate_digests(*args):
+            checksummed['archived'] += 1
+            return self.calculate_digests(*args)
+
+        def checksum_raw_file(*args):
+            checksummed['raw'] += 1
+            return self.checksum_raw_file(*args)
+        tarcheck.calculate_digests = calculate_digests
+        tarcheck.checksum_raw_file = checksum_raw_file
+        return checksummed
+
+    def test_hard_links_verified_and_checksummed_once(self):
+        members = list(tarcheck.iter_archive_members(self.archive_path))
+        self.assertEqual([member.type for member in members],
+                         [tarcheck.FILE_MEMBER, tarcheck.HARDLINK_MEMBER, tarcheck.HARDLINK_MEMBER])
+        for jobs in (1, 3):
+            checksummed = self._count_checksums()
+            total_files, errors, report = tarcheck.verify_archive(self.archive_path, self.dir_path, jobs=jobs)
+            self.assertEqual((total_files, errors), (3, []))
+            self.assertEqual(report, "All files in the directory are in the archive")
+            self.assertEqual(checksummed, {'archived': 1, 'raw': 1})
+
+    def test_hard_links_differ(self):
+        with open(os.path.join(self.dir_path, 'genome.fa'), 'r+') as raw_file:
+            raw_file.write('T')
+        total_files, errors, _ = tarcheck.verify_archive(self.archive_path, self.dir_path)
+        self.assertEqual(total_files, 3)
+        self.assertEqual([error.split(' ')[0] for error in errors],
+                         ['test-data/genome.fa', 'test-data/genome-link.fa', 'test-data/genome-link2.fa'])
+
+    def test_hard_links_with_manifest(self):
+        manifest_path = tarcheck.get_default_manifest_path(self.archive_path)
+        expected = tarcheck.verify_archive(self.archive_path, self.dir_path, manifest_path=manifest_path)
+        checksummed = self._count_checksums()
+        self.assertEqual(tarcheck.verify_archive_with_manifest(manifest_path, self.dir_path), expected)
+        self.assertEqual(checksummed, {'archived': 0, 'raw': 1})
+
+    def test_hard_links_with_raw_copies_not_linked(self):
+        copy_path = os.path.join(self.temp_directory, 'copy', 'test-data')
+        os.makedirs(copy_path)
+        for name in ('genome.fa', 'genome-link.fa', 'genome-link2.fa'):
+            shutil.copy(os.path.join(self.dir_path, name), copy_path)
+        # The archived files are kept in memory, or moved to disk
+        for inventory_memory in (tarcheck.INVENTORY_MEMORY, 1):
+            checksummed = self._count_checksums()
+            total_files, errors, _ = tarcheck.verify_archive(
+                self.archive_path, copy_path, inventory_memory=inventory_memory)
+            self.assertEqual((total_files, errors), (3, []))
+            self.assertEqual(checksummed, {'archived': 1, 'raw': 3})
+        with open(os.path.join(copy_path, 'genome-link2.fa'), 'r+') as raw_file:
+            raw_file.write('T')
+        total_files, errors, _ = tarcheck.verify_archive(self.archive_path, copy_path)
+        self.assertEqual(total_files, 3)
+        self.assertEqual([error.split(' ')[0] for error in errors], ['test-data/genome-link2.fa'])
+
+    def test_raw_files_with_links_outside_the_directory(self):
+        # The raw files have links outside the directory, which are never seen
+        for name in ('genome-link.fa', 'genome-link2.fa'):
+            os.rename(os.path.join(self.dir_path, name), os.path.join(self.temp_directory, name))
+            shutil.copy(os.path.join(self.dir_path, 'genome.fa'), os.path.join(self.dir_path, name))
+            os.link(os.path.join(self.dir_path, name), os.path.join(self.temp_directory, name + '.link'))
+        checksummed = self._count_checksums()
+        total_files, errors, _ = tarcheck.verify_archive(
+            self.archive_path, self.dir_path, inventory_memory=tarcheck._STAT_OVERHEAD, check_inventory=False)
+        self.assertEqual((total_files, errors), (3, []))
+        self.assertEqual(checksummed, {'archived': 1, 'raw': 3})
+
+    def test_hard_link_to_file_of_different_size(self):
+        dir_path = os.path.join(self.temp_directory, 'd')
+        os.mkdir(dir_path)
+        with open(os.path.join(dir_path, 'b.txt'), 'w') as raw_file:
+            raw_file.write('the archived')
+        os.link(os.path.join(dir_path, 'b.txt'), os.path.join(dir_path, 'a.txt'))
+        archive_path = os.path.join(self.temp_directory, 'd.tar')
+        with tarfile.open(archive_path, 'w') as tar:
+            for name in ('b.txt', 'a.txt'):
+                tar.add(os.path.join(dir_path, name), os.path.join('d', name))
+        # The raw copies aren't linked: b.txt has another size, and a.txt the same size but other contents
+        os.remove(os.path.join(dir_path, 'a.txt'))
+        with open(os.path.join(dir_path, 'b.txt'), 'w') as raw_file:
+            raw_file.write('a file of another size')
+        with open(os.path.join(dir_path, 'a.txt'), 'w') as raw_file:
+            raw_file.write('THE ARCHIVED')
+        total_files, errors, _ = tarcheck.verify_archive(archive_path, dir_path)
+        self.assertEqual(total_files, 2)
+        self.assertEqual(errors, ['d/b.txt size 22 != 12', 'd/a.txt %s != %s' % (
+            hashlib.md5('THE ARCHIVED').hexdigest(), hashlib.md5('the archived').hexdigest())])
+
+    def test_hard_link_to_file_verified_by_earlier_run(self):
+        journal_path = os.path.join(self.temp_directory, 'test-data.journal')
+        journal = tarcheck.VerificationJournal(
+            journal_path, self.archive_path, self.dir_path, tarcheck.DEFAULT_ALGORITHMS, None, None, False)
+        results = tarcheck.iter_verify_archive(self.archive_path, self.dir_path, journal=journal)
+        next(results)
+        results.close()
+        journal.close()
+        journal = tarcheck.VerificationJournal(
+            journal_path, self.archive_path, self.dir_path, tarcheck.DEFAULT_ALGORITHMS, None, None, True)
+        results = list(tarcheck.iter_verify_archive(self.archive_path, self.dir_path, journal=journal))
+        journal.close()
+        # The links can't be verified without the checksum of the file they link to, but aren't left out
+        self.assertEqual([(result.path, result.status) for result in results], [
+            ('test-data/genome-link.fa', tarcheck.RESULT_UNVERIFIED),
+            ('test-data/genome-link2.fa', tarcheck.RESULT_UNVERIFIED)])
+
+    def test_archived_digests(self):
+        archived_digests = tarcheck.ArchivedDigests(max_memory=1000)
+        members = [tarcheck.ArchiveMember('dir/%d' % i, tarcheck.FILE_MEMBER, i, 0, None, 'digest%d' % i)
+                   for i in range(6)]
+        for member in members[:2]:
+            archived_digests.put(member)
+        self.assertFalse(archived_digests.spilled)
+        for member in members[2:] + [members[0]._replace(size=10)]:
+            archived_digests.put(member)
+        self.assertTrue(archived_digests.spilled)
+        self.assertEqual([archived_digests.get(member.path) for member in members],
+                         [(10, 'digest0')] + [(i, 'digest%d' % i) for i in range(1, 6)])
+        self.assertIsNone(archived_digests.get('dir/6'))
+        archived_digests.close()
+
+    def test_hard_link_to_excluded_file_skipped(self):
+        total_files, errors, _ = tarcheck.verify_archive(
+            self.archive_path, self.dir_path, exclude_wildcard='*/genome.fa', check_inventory=False)
+        self.assertEqual((total_files, errors), (0, []))
+
+
+class TestChecksumCache(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.ChecksumCache`.
+    """
+    archive_path = 'test-cases/test-same-content/test-data.tar.bz2'
+    dir_path = 'test-cases/test-same-content/test-data'
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.database_path = os.path.join(self.temp_directory, 'cache.sqlite')
+        self.raw_file_path = os.path.join(self.dir_path, 'pip.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_get_checksum_put_earlier(self):
+        cache = tarcheck.ChecksumCache(self.database_path)
+        cache.put(os.stat(self.raw_file_path), 'abc')
+        cache.close()
+        cache = tarcheck.ChecksumCache(self.database_path)
+        self.assertEqual(cache.get(os.stat(self.raw_file_path)), 'abc')
+        self.assertIsNone(cache.get(os.stat(self.raw_file_path), algorithm='sha256'))
+        cache.close()
+
+    def test_get_checksum_of_modified_file(self):
+        raw_file_path = os.path.join(self.temp_directory, 'raw.txt')
+        with open(raw_file_path, 'w') as raw_file:
+            raw_file.write('before')
+        cache = tarcheck.ChecksumCache(self.database_path)
+        cache.put(os.stat(raw_file_path), 'abc')
+        os.utime(raw_file_path, (0, 0))
+        self.assertIsNone(cache.get(os.stat(raw_file_path)))
+        cache.close()
+
+    def test_evict_least_recently_used(self):
+        cache = tarcheck.ChecksumCache(self.database_path, max_entries=1)
+        cache.put(os.stat(self.raw_file_path), 'abc')
+        cache.put(os.stat(os.path.join(self.dir_path, 'pip2.txt')), 'def')
+        cache.evict()
+        self.assertIsNone(cache.get(os.stat(self.raw_file_path)))
+        self.assertEqual(cache.get(os.stat(os.path.join(self.dir_path, 'pip2.txt'))), 'def')
+        cache.close()
+
+    def test_evict_old(self):
+        cache = tarcheck.ChecksumCache(self.database_path, max_age=-1)
+        cache.put(os.stat(self.raw_file_path), 'abc')
+        cache.evict()
+        self.assertIsNone(cache.get(os.stat(self.raw_file_path)))
+        cache.close()
+
+    def test_verify_archive_uses_cached_checksums(self):
+        cache = tarcheck.ChecksumCache(self.database_path)
+        total_files, errors, _ = tarcheck.verify_archive(self.archive_path, self.dir_path, checksum_cache=cache)
+        self.assertEqual((total_files, errors), (5, []))
+        self.assertIsNotNone(cache.get(os.stat(self.raw_file_path)))
+
+        # A wrong cached checksum shows that the raw file wasn't read again:
+        cache.put(os.stat(self.raw_file_path), 'not-the-checksum')
+        total_files, errors, _ = tarcheck.verify_archive(
+            self.archive_path, self.dir_path, jobs=2, checksum_cache=cache)
+        self.assertEqual(total_files, 5)
+        self.assertEqual(len(errors), 1)
+        cache.close()
+
+
+class TestManifest(unittest.TestCase):
+    """
+    Unit tests for the manifest of an archive: `tarcheck.ManifestWriter` and `tarcheck.verify_archive_with_manifest`.
+    """
+    dir_path = 'test-cases/test-diff-content/test-data'
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.temp_directory, 'test-data.tar.bz2')
+        shutil.copy2('test-cases/test-diff-content/test-data.tar.bz2', self.archive_path)
+        self.manifest_path = tarcheck.get_default_manifest_path(self.archive_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_write_manifest(self):
+        tarcheck.verify_archive(self.archive_path, self.dir_path, manifest_path=self.manifest_path)
+        header = tarcheck.read_manifest_header(self.manifest_path)
+        with open(self.archive_path, 'rb') as archive:
+            self.assertEqual(header['archive']['md5'], hashlib.md5(archive.read()).hexdigest())
+        self.assertEqual(header['archive']['size'], os.path.getsize(self.archive_path))
+        members = list(tarcheck.read_manifest_members(self.manifest_path))
+        self.assertEqual(len(members), header['members'])
+        self.assertEqual(members[0], tarcheck.ArchiveMember(
+            'test-data', tarcheck.DIRECTORY_MEMBER, 0, members[0].mtime, None, None, 0o775, 1001, 1001))
+        self.assertEqual(members[1].digest, '98ec34e659b246932ea5b63e12b5a75d')
+
+    def test_manifest_written_with_raw_files_missing(self):
+        dir_path = os.path.join(self.temp_directory, 'test-data')
+        shutil.copytree(self.dir_path, dir_path)
+        os.remove(os.path.join(dir_path, 'pip2.txt'))
+        self.assertRaises(ValueError, tarcheck.verify_archive, self.archive_path, dir_path,
+                          manifest_path=self.manifest_path)
+        # The whole archive is in the manifest, with the error that failed the verification
+        header = tarcheck.read_manifest_header(self.manifest_path)
+        self.assertIn('pip2.txt', header['verification_error'])
+        self.assertEqual(len(list(tarcheck.read_manifest_members(self.manifest_path))), header['members'])
+
+        os.remove(self.manifest_path)
+        tarcheck.verify_archive(self.archive_path, dir_path, manifest_path=self.manifest_path, keep_going=True)
+        header = tarcheck.read_manifest_header(self.manifest_path)
+        self.assertEqual((header['raw_failures'], header['verification_error']), (1, None))
+        with open(self.manifest_path) as manifest:
+            failures = [member for member in map(json.loads, manifest.readlines()[1:]) if 'raw_failure' in member]
+        self.assertEqual([(member['path'], member['raw_failure']) for member in failures],
+                         [('test-data/pip2.txt', 'test-data/pip2.txt is missing from the directory')])
+
+    def test_manifest_records_algorithms(self):
+        expected = tarcheck.verify_archive(
+            self.archive_path, self.dir_path, manifest_path=self.manifest_path, algorithms=('sha256', ))
+        self.assertEqual(tarcheck.read_manifest_header(self.manifest_path)['algorithm'], 'sha256')
+        self.assertEqual(tarcheck.verify_archive_with_manifest(self.manifest_path, self.dir_path), expected)
+
+    def test_manifest_written_if_verification_fails(self):
+        archive_path = 'test-cases/test-files-missing/test-data.tar.bz2'
+        dir_path = 'test-cases/test-files-missing/test-data'
+        self.assertRaises(
+            ValueError, tarcheck.verify_archive, archive_path, dir_path, manifest_path=self.manifest_path)
+        self.assertEqual(sorted(os.listdir(self.temp_directory)), ['test-data.tar.bz2', 'test-data.tar.bz2.manifest'])
+
+    def test_verify_with_manifest(self):
+        expected = tarcheck.verify_archive(self.archive_path, self.dir_path, manifest_path=self.manifest_path)
+        self.assertEqual(
+            tarcheck.verify_archive_with_manifest(self.manifest_path, self.dir_path, self.archive_path), expected)
+        self.assertEqual(
+            tarcheck.verify_archive_with_manifest(
+                self.manifest_path, self.dir_path, self.archive_path, check_archive_checksum=True),
+            expected)
+
+    def test_verify_with_manifest_with_excluded_files(self):
+        tarcheck.verify_archive(self.archive_path, self.dir_path, manifest_path=self.manifest_path)
+        total_files, errors, _ = tarcheck.verify_archive_with_manifest(
+            self.manifest_path, self.dir_path, exclude_wildcard='*pip.txt')
+        self.assertEqual((total_files, errors), (4, []))
+
+    def test_verify_with_manifest_of_changed_archive(self):
+        tarcheck.verify_archive(self.archive_path, self.dir_path, manifest_path=self.manifest_path)
+        os.utime(self.archive_path, (0, 0))
+        self.assertFalse(
+            tarcheck.manifest_matches_archive(tarcheck.read_manifest_header(self.manifest_path), self.archive_path))
+        self.assertRaises(
+            ValueError, tarcheck.verify_archive_with_manifest, self.manifest_path, self.dir_path, self.archive_path)
+
+    def test_archive_checksum_with_each_decompressor(self):
+        with open(self.archive_path, 'rb') as archive:
+            expected_md5 = hashlib.md5(archive.read()).hexdigest()
+        for decompressor in (tarcheck.TARFILE_DECOMPRESSOR, tarcheck.BZIP2_BLOCKS_DECOMPRESSOR):
+            archive_hash = hashlib.md5()
+            list(tarcheck.iter_archive_members(
+                self.archive_path, decompressor=decompressor, decompress_jobs=2, archive_hash=archive_hash))
+            self.assertEqual(archive_hash.hexdigest(), expected_md5)
+
+    @unittest.skipUnless(find_executable('bzip2'), "bzip2 is not installed")
+    def test_archive_checksum_with_external_decompressor(self):
+        original_decompressors = tarcheck._EXTERNAL_DECOMPRESSORS
+        tarcheck._EXTERNAL_DECOMPRESSORS = {'bz2': (['bzip2', '-d', '-c'], )}
+        try:
+            archive_hash = hashlib.md5()
+            members = list(tarcheck.iter_archive_members(
+                self.archive_path, decompressor=tarcheck.EXTERNAL_DECOMPRESSOR, archive_hash=archive_hash))
+        finally:
+            tarcheck._EXTERNAL_DECOMPRESSORS = original_decompressors
+        self.assertEqual(len(members), 7)
+        with open(self.archive_path, 'rb') as archive:
+            self.assertEqual(archive_hash.hexdigest(), hashlib.md5(archive.read()).hexdigest())
+
+
+class TestVerificationJournal(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.VerificationJournal` and resuming verifications.
+    """
+    archive_path = 'test-cases/test-diff-content/test-data.tar.bz2'
+    dir_path = 'test-cases/test-diff-content/test-data'
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.temp_directory, 'test-data.tar.bz2.journal')
+        self.checksum_raw_file = tarcheck.checksum_raw_file
+
+    def tearDown(self):
+        tarcheck.checksum_raw_file = self.checksum_raw_file
+        shutil.rmtree(self.temp_directory)
+
+    def _journal(self, resume=True, **kwargs):
+        return tarcheck.VerificationJournal(self.journal_path, self.archive_path, self.dir_path, resume=resume, **kwargs)
+
+    def _verify_without_reading_raw_files(self, **kwargs):
+        def fail(*args):
+            raise AssertionError("A raw file was read again")
+        tarcheck.checksum_raw_file = fail
+        journal = self._journal()
+        try:
+            return tarcheck.verify_archive(self.archive_path, self.dir_path, journal=journal, **kwargs)
+        finally:
+            journal.close()
+
+    def test_waiting_for_raw_checksums_can_be_interrupted(self):
+        def raise_system_exit(signal_number, frame):
+            raise SystemExit(128 + signal_number)
+        pool = ThreadPool(1)
+        previous_handler = signal.signal(signal.SIGALRM, raise_system_exit)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.2)
+            # As a SIGTERM would be handled, and the journal flushed, while a raw file takes long to checksum
+            self.assertRaises(SystemExit, tarcheck._wait_for_result, pool.apply_async(time.sleep, (5, )))
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+            pool.terminate()
+
+    def test_resume_completed_verification(self):
+        expected = tarcheck.verify_archive(self.archive_path, self.dir_path)
+        journal = self._journal(resume=False)
+        self.assertEqual(tarcheck.verify_archive(self.archive_path, self.dir_path, journal=journal), expected)
+        journal.close()
+        self.assertEqual(self._verify_without_reading_raw_files(), expected)
+
+    def test_resume_part_way(self):
+        expected = tarcheck.verify_archive(self.archive_path, self.dir_path)
+        journal = self._journal(resume=False)
+        tarcheck.verify_archive(self.archive_path, self.dir_path, journal=journal)
+        journal.close()
+        with open(self.journal_path) as journal_file:
+            lines = journal_file.readlines()
+        # Only the first file was verified, and the line of the second was only partly written
+        with open(self.journal_path, 'w') as journal_file:
+            journal_file.writelines(lines[:2])
+            journal_file.write(lines[2][:10])
+
+        journal = self._journal()
+        self.assertEqual(journal.total_files, 1)
+        self.assertEqual(tarcheck.verify_archive(self.archive_path, self.dir_path, journal=journal), expected)
+        journal.close(completed=True)
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_resume_with_index(self):
+        index_path = os.path.join(self.temp_directory, 'test-data.tar.bz2.index')
+        index = tarcheck.ArchiveIndex.build(self.archive_path, index_path)
+        expected = tarcheck.verify_archive(self.archive_path, self.dir_path)
+        journal = self._journal(resume=False)
+        tarcheck.verify_archive(self.archive_path, self.dir_path, journal=journal)
+        journal.close()
+        try:
+            self.assertEqual(self._verify_without_reading_raw_files(index=index), expected)
+        finally:
+            index.close()
+
+    def test_journal_of_other_verification_is_started_afresh(self):
+        journal = self._journal(resume=False)
+        tarcheck.verify_archive(self.archive_path, self.dir_path, journal=journal)
+        journal.close()
+        journal = self._journal(algorithms=('sha1', ))
+        self.assertEqual((journal.verified_members, journal.total_files, journal.errors), (0, 0, []))
+        journal.close()
+
+    def test_not_resumed_without_resume(self):
+        journal = self._journal(resume=False)
+        tarcheck.verify_archive(self.archive_path, self.dir_path, journal=journal)
+        journal.close()
+        journal = self._journal(resume=False)
+        self.assertEqual(journal.verified_members, 0)
+        journal.close()
+
+
+class TestBatch(unittest.TestCase):
+    """
+    Unit tests for verifying batches of archives with `tarcheck.run_batch`.
+    """
+    same_content = tarcheck.BatchJob(
+        'test-cases/test-same-content/test-data.tar.bz2', 'test-cases/test-same-content/test-data', None, None, None)
+    diff_content = tarcheck.BatchJob(
+        'test-cases/test-diff-content/test-data.tar.bz2', 'test-cases/test-diff-content/test-data', None, None, None)
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def _write_job_list(self, name, content):
+        job_list_path = os.path.join(self.temp_directory, name)
+        with open(job_list_path, 'w') as job_list:
+            job_list.write(content)
+        return job_list_path
+
+    def test_read_tab_separated_jobs(self):
+        job_list_path = self._write_job_list(
+            'jobs.tsv', "# tar_path\tdir\n\na.tar\ta\nb.tar\tb\t*.tmp\nc.tar\tc\t\t.*~\n")
+        self.assertEqual(tarcheck.read_batch_jobs(job_list_path), [
+            tarcheck.BatchJob('a.tar', 'a', None, None, None), tarcheck.BatchJob('b.tar', 'b', '*.tmp', None, None),
+            tarcheck.BatchJob('c.tar', 'c', None, '.*~', None)])
+
+    def test_read_json_jobs(self):
+        job_list_path = self._write_job_list(
+            'jobs.json', '[{"tar_path": "a.tar", "dir": "a"}, '
+                         '{"tar_path": "b.tar", "dir": "b", "exclude": ["*.tmp"], "timeout": 60}]')
+        self.assertEqual(tarcheck.read_batch_jobs(job_list_path), [
+            tarcheck.BatchJob('a.tar', 'a', None, None, None), tarcheck.BatchJob('b.tar', 'b', ['*.tmp'], None, 60)])
+
+    def test_read_invalid_jobs(self):
+        self.assertRaises(ValueError, tarcheck.read_batch_jobs, self._write_job_list('jobs.tsv', "a.tar\n"))
+        self.assertRaises(ValueError, tarcheck.read_batch_jobs, self._write_job_list('jobs.json', '[{"dir": "a"}]'))
+
+    def test_run_batch(self):
+        missing = tarcheck.BatchJob('test-cases/missing.tar', 'test-cases/test-same-content/test-data', None, None, None)
+        results = tarcheck.run_batch([self.same_content, self.diff_content, missing], batch_jobs=2, filesystem_jobs=1)
+        self.assertEqual([result['tar_path'] for result in results],
+                         [self.same_content.tar_path, self.diff_content.tar_path, missing.tar_path])
+        self.assertEqual([result['status'] for result in results],
+                         [tarcheck.BATCH_OK, tarcheck.BATCH_DIFFERENT, tarcheck.BATCH_FAILED])
+        self.assertEqual(results[0]['total_files'], 5)
+        self.assertEqual(len(results[1]['errors']), 1)
+        self.assertTrue(results[2]['message'])
+        self.assertEqual(tarcheck.summarize_batch(results)['summary'], {
+            tarcheck.BATCH_OK: 1, tarcheck.BATCH_DIFFERENT: 1, tarcheck.BATCH_FAILED: 1, tarcheck.BATCH_TIMED_OUT: 0})
+
+    def test_run_batch_with_timeout(self):
+        # Reading a pipe nothing writes to never finishes
+        fifo_path = os.path.join(self.temp_directory, 'test-data.tar')
+        os.mkfifo(fifo_path)
+        stuck = tarcheck.BatchJob(fifo_path, self.same_content.dir, None, None, 0.2)
+        results = tarcheck.run_batch([stuck, self.same_content], batch_jobs=2, poll_interval=0.05)
+        self.assertEqual([result['status'] for result in results], [tarcheck.BATCH_TIMED_OUT, tarcheck.BATCH_OK])
+
+
+    def test_timed_out_verification_killed_with_its_decompressor(self):
+        pid_path = os.path.join(self.temp_directory, 'decompressor.pid')
+        # A decompressor that never gives anything
+        command = ['sh', '-c', 'echo $$ > %s; exec sleep 60' % pid_path]
+        find_external_decompressor = tarcheck.find_external_decompressor
+        tarcheck.find_external_decompressor = lambda compression, jobs: command
+        try:
+            stuck = self.same_content._replace(timeout=0.5)
+            results = tarcheck.run_batch(
+                [stuck], verify_options={'decompressor': tarcheck.EXTERNAL_DECOMPRESSOR}, poll_interval=0.05)
+        finally:
+            tarcheck.find_external_decompressor = find_external_decompressor
+        self.assertEqual(results[0]['status'], tarcheck.BATCH_TIMED_OUT)
+        with open(pid_path) as pid_file:
+            pid = int(pid_file.read())
+        for _ in range(50):
+            try:
+                with open('/proc/%d/stat' % pid) as stat_file:
+                    if stat_file.read().split()[2] == 'Z':
+                        break
+            except IOError:
+                break
+            time.sleep(0.05)
+        else:
+            self.fail("The decompressor of the timed out verification is still running")
+
+
+class TestArchiveIndex(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.ArchiveIndex` and verifying only some members of an archive.
+    """
+    archive_path = 'test-cases/test-diff-content/test-data.tar.bz2'
+    dir_path = 'test-cases/test-diff-content/test-data'
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        with open(self.archive_path, 'rb') as archive:
+            self.tar_data = bz2.decompress(archive.read())
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_index_uncompressed_archive(self):
+        self.__expect_only_members_verified(self.__write_archive('test-data.tar', self.tar_data))
+
+    def test_index_multistream_bzip2_archive(self):
+        streams = [bz2.compress(self.tar_data[i:i + 700]) for i in range(0, len(self.tar_data), 700)]
+        index = self.__expect_only_members_verified(self.__write_archive('test-data.tar.bz2', ''.join(streams)))
+        self.assertGreater(len(index.checkpoints()), 1)
+
+    def test_index_multimember_gzip_archive(self):
+        members = []
+        for i in range(0, len(self.tar_data), 700):
+            compressed = io.BytesIO()
+            with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+                gzip_file.write(self.tar_data[i:i + 700])
+            members.append(compressed.getvalue())
+        index = self.__expect_only_members_verified(self.__write_archive('test-data.tar.gz', ''.join(members)))
+        self.assertGreater(len(index.checkpoints()), 1)
+
+    def test_index_single_stream_archive(self):
+        archive_path = self.__write_archive('test-data.tar.bz2', bz2.compress(self.tar_data))
+        index = self.__expect_only_members_verified(archive_path)
+        self.assertEqual(index.checkpoints(), [(0, 0)])
+
+    def test_list_files_from_index(self):
+        archive_path = self.__write_archive('test-data.tar', self.tar_data)
+        index = tarcheck.ArchiveIndex.build(archive_path, tarcheck.get_default_index_path(archive_path))
+        self.assertEqual(tarcheck.get_all_files_in_archive(archive_path, index=index),
+                         tarcheck.get_all_files_in_archive(archive_path))
+        index.close()
+
+    def test_index_of_changed_archive(self):
+        archive_path = self.__write_archive('test-data.tar', self.tar_data)
+        index = tarcheck.ArchiveIndex.build(archive_path, tarcheck.get_default_index_path(archive_path))
+        os.utime(archive_path, (0, 0))
+        self.assertFalse(index.matches(archive_path))
+        self.assertRaises(ValueError, tarcheck.verify_archive, archive_path, self.dir_path, only=['test-data'],
+                          index=index)
+        index.close()
+
+    def test_only_without_index(self):
+        total_files, errors, report = tarcheck.verify_archive(
+            self.archive_path, self.dir_path, only=['test-data/dir2', 'test-data/pip.txt'])
+        self.assertEqual((total_files, len(errors), report), (3, 1, None))
+
+    def __write_archive(self, name, data):
+        archive_path = os.path.join(self.temp_directory, name)
+        with open(archive_path, 'wb') as archive:
+            archive.write(data)
+        return archive_path
+
+    def __expect_only_members_verified(self, archive_path):
+        index = tarcheck.ArchiveIndex.build(archive_path, tarcheck.get_default_index_path(archive_path), 1)
+        self.addCleanup(index.close)
+        self.assertEqual(
+            [member.path for member in index.members(['test-data/dir2/'])],
+            ['test-data/dir2', 'test-data/dir2/smthelse.err', 'test-data/dir2/pip-freeze.txt'])
+
+        total_files, errors, report = tarcheck.verify_archive(
+            archive_path, self.dir_path, only=['test-data/dir2', 'test-data/pip.txt', 'test-data/pip2.txt'],
+            index=index)
+        self.assertEqual(total_files, 4)
+        self.assertEqual(errors, ["test-data/pip.txt size 16 != 15"])
+        self.assertIsNone(report)
+
+        members = list(tarcheck.iter_indexed_archive_members(archive_path, index))
+        self.assertEqual(members, list(tarcheck.iter_archive_members(archive_path)))
+        return index
+
+
 class TestExcludeFiles(unittest.TestCase):
 
     def test_is_excluded1(self):
@@ -123,6 +1082,49 @@ class TestExcludeFiles(unittest.TestCase):
         self.assertEqual(len(errors), 0)
 
 
+class TestExclusionRules(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.ExclusionRules` and `tarcheck.read_exclusion_rules`.
+    """
+    def test_wildcard_and_regex_both_apply(self):
+        self.assertTrue(tarcheck.is_excluded('photo.jpg', wildcard='*.jpg', regex='sepi'))
+        self.assertTrue(tarcheck.is_excluded('sepi.bam', wildcard='*.jpg', regex='sepi'))
+        self.assertFalse(tarcheck.is_excluded('photo.txt', wildcard='*.jpg', regex='sepi'))
+
+    def test_several_rules(self):
+        rules = tarcheck.ExclusionRules(['*.jpg', '*.png'], ['tmp/', 'scratch'])
+        for path in ('a.jpg', 'b/c.png', 'tmp/x', 'scratch'):
+            self.assertTrue(rules.matches(path), path)
+        for path in ('a.txt', 'b/tmp/x', 'a.jpg.txt'):
+            self.assertFalse(rules.matches(path), path)
+
+    def test_wildcard_excludes_directory_contents(self):
+        rules = tarcheck.ExclusionRules(['.snapshot'])
+        self.assertTrue(rules.matches('.snapshot'))
+        self.assertTrue(rules.matches('.snapshot/daily/file'))
+        self.assertFalse(rules.matches('.snapshots'))
+
+    def test_no_rules(self):
+        self.assertFalse(tarcheck.ExclusionRules())
+        self.assertFalse(tarcheck.ExclusionRules().matches('anything'))
+
+    def test_invalid_regex(self):
+        self.assertRaises(ValueError, tarcheck.ExclusionRules, regexes=['('])
+
+    def test_rules_are_compiled_once(self):
+        self.assertIs(tarcheck.get_exclusion_rules('*.a', ['b']), tarcheck.get_exclusion_rules(['*.a'], 'b'))
+
+    def test_read_exclusion_rules(self):
+        temp_directory = tempfile.mkdtemp()
+        try:
+            rules_path = os.path.join(temp_directory, 'exclude')
+            with open(rules_path, 'w') as rules_file:
+                rules_file.write('# Scratch space\n*.tmp\n\nregex:scratch/.*\n.snapshot\n')
+            self.assertEqual(tarcheck.read_exclusion_rules(rules_path), (['*.tmp', '.snapshot'], ['scratch/.*']))
+        finally:
+            shutil.rmtree(temp_directory)
+
+
 class TestFilterExcludedFromList(unittest.TestCase):
     """
     Unit tests for `tarcheck.filter_excluded_from_list`.
@@ -158,12 +1160,72 @@ class TestGetAllFilesInDirectoryRecursively(unittest.TestCase):
     def test_with_hierarchical_directory(self):
         self.__expect_files_in_directory(['1', 'a', 'b', 'a/2', 'a/3', 'b/4', 'a/c', 'a/c/5'], 'hierarchical')
 
-    def __expect_files_in_directory(self, expected_files, directory_name):
+    def test_excluded_directories_are_pruned(self):
+        self.__expect_files_in_directory(['1', 'b', 'b/4'], 'hierarchical', exclude_wildcard='a')
+
+    def test_with_several_exclusion_rules(self):
+        self.__expect_files_in_directory(
+            ['1', 'a', 'a/c', 'a/c/5'], 'hierarchical', exclude_wildcard=['b', 'a/2'], exclude_regex=['a/3'])
+
+    def __expect_files_in_directory(self, expected_files, directory_name, exclude_wildcard=None, exclude_regex=None):
         test_directory = os.path.join(TEST_FILES_BASE_PATH, 'test-get-all-files-in-directory-recursively', directory_name)
-        files_list = tarcheck.get_all_files_in_directory_recursively(test_directory)
+        files_list = tarcheck.get_all_files_in_directory_recursively(test_directory, exclude_wildcard, exclude_regex)
         self.assertItemsEqual(files_list, expected_files)
 
 
+class TestScanDirectory(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.scan_directory`.
+    """
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_serial_and_parallel_scans_agree(self):
+        test_directory = os.path.join(TEST_FILES_BASE_PATH, 'test-get-all-files-in-directory-recursively', 'hierarchical')
+        serial = list(tarcheck.scan_directory(test_directory))
+        parallel = list(tarcheck.scan_directory(test_directory, jobs=4))
+        self.assertItemsEqual(parallel, serial)
+        self.assertItemsEqual(
+            [entry.path for entry in serial], ['1', 'a', 'b', 'a/2', 'a/3', 'b/4', 'a/c', 'a/c/5'])
+
+    def test_waiting_for_directories_can_be_interrupted(self):
+        def raise_system_exit(signal_number, frame):
+            raise SystemExit(128 + signal_number)
+        previous_handler = signal.signal(signal.SIGALRM, raise_system_exit)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.2)
+            # Blocked until the signal, like the main thread waiting for directories that take long to list
+            self.assertRaises(SystemExit, tarcheck._get_from_queue, Queue.Queue())
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+    def test_gives_stat(self):
+        with open(os.path.join(self.temp_directory, 'file'), 'w') as raw_file:
+            raw_file.write('12345')
+        entry, = tarcheck.scan_directory(self.temp_directory, jobs=2)
+        self.assertEqual(entry.path, 'file')
+        self.assertEqual(entry.stat.st_size, 5)
+        self.assertEqual(entry.stat.st_ino, os.stat(os.path.join(self.temp_directory, 'file')).st_ino)
+
+    def test_directory_path_repeated_in_subdirectory(self):
+        nested_directory = os.path.join(self.temp_directory, self.temp_directory.lstrip(os.sep))
+        os.makedirs(nested_directory)
+        open(os.path.join(nested_directory, 'file'), 'w').close()
+        paths = tarcheck.get_all_files_in_directory_recursively(self.temp_directory, jobs=3)
+        self.assertIn(os.path.join(self.temp_directory.lstrip(os.sep), 'file'), paths)
+
+    def test_symlinks(self):
+        os.mkdir(os.path.join(self.temp_directory, 'directory'))
+        os.symlink('directory', os.path.join(self.temp_directory, 'directory-link'))
+        os.symlink('missing', os.path.join(self.temp_directory, 'broken-link'))
+        self.assertItemsEqual(
+            [entry.path for entry in tarcheck.scan_directory(self.temp_directory)], ['directory', 'broken-link'])
+
+
 class TestGetAllFilesInArchive(unittest.TestCase):
     """
     Unit tests for `tarcheck.get_all_files_in_archive`.
@@ -242,6 +1304,800 @@ class TestGetFilesInDirectoryNotInArchive(unittest.TestCase):
         self.assertItemsEqual(difference, expected_difference)
 
 
+class TestCompareInventories(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.compare_inventories` and `tarcheck.report_missing_files`.
+    """
+    def test_contents_archived(self):
+        difference = tarcheck.compare_inventories(['a', 'a/1', '2', '3'], ['a', 'a/1', '2', '4'])
+        self.assertEqual(difference, tarcheck.InventoryDifference(0, ['3'], ['4'], 1, 1))
+
+    def test_parent_directory_archived(self):
+        difference = tarcheck.compare_inventories(['a', 'a/1', '2'], ['dir', 'dir/a', 'dir/a/1', 'dir/2', 'dir/5'])
+        self.assertEqual(difference, tarcheck.InventoryDifference(1, [], ['5'], 0, 1))
+
+    def test_dot_directory_archived(self):
+        difference = tarcheck.compare_inventories(['1', '2'], ['.', './1', './2'])
+        self.assertEqual(difference, tarcheck.InventoryDifference(1, [], [], 0, 0))
+
+    def test_exclusions_apply_both_ways(self):
+        difference = tarcheck.compare_inventories(
+            ['1', '2.tmp'], ['dir', 'dir/1', 'dir/3.tmp'], exclude_wildcard='*.tmp')
+        self.assertEqual(difference, tarcheck.InventoryDifference(1, [], [], 0, 0))
+
+    def test_nothing_matches(self):
+        difference = tarcheck.compare_inventories(['1', '2'], ['3'])
+        self.assertEqual(difference, tarcheck.InventoryDifference(0, ['1', '2'], ['3'], 2, 1))
+
+    def test_report_members_missing_from_directory(self):
+        report = tarcheck.report_missing_files(['1'], ['dir', 'dir/1', 'dir/2'])
+        self.assertEqual(report, "All files in the directory are in the archive\n"
+                                 "Some members of the archive are missing from the directory: ['2']")
+
+    def test_report_lists_the_first_missing_files(self):
+        difference = tarcheck.compare_inventories(['1', '2', '3'], ['4', '5'], max_listed=1)
+        self.assertEqual(difference, tarcheck.InventoryDifference(0, ['1'], ['4'], 3, 2))
+        report = tarcheck.report_missing_files(['1', '2', '3'], ['dir', 'dir/1', 'dir/4', 'dir/5'], max_listed=1)
+        self.assertEqual(report, "Some files in directory are missing from the archive: ['2'] and 1 more\n"
+                                 "Some members of the archive are missing from the directory: ['4'] and 1 more")
+
+    def test_many_files(self):
+        files_in_dir = ['directory/file-%d' % number for number in range(100000)]
+        files_in_archive = ['parent/' + path for path in files_in_dir[1:]]
+        difference = tarcheck.compare_inventories(files_in_dir, files_in_archive)
+        self.assertEqual(difference, tarcheck.InventoryDifference(1, ['directory/file-0'], [], 1, 0))
+
+
+class TestPathList(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.PathList`.
+    """
+    def test_in_memory(self):
+        paths = tarcheck.PathList(['b', 'a/1', 'a', 'b'])
+        self.assertEqual(len(paths), 4)
+        self.assertFalse(paths.spilled)
+        self.assertEqual(list(paths.sorted_paths()), ['a', 'a/1', 'b'])
+
+    def test_sorted_on_disk(self):
+        expected = ['dir/file-%05d' % number for number in range(2000)]
+        paths = tarcheck.PathList(reversed(expected), max_memory=4096)
+        try:
+            self.assertTrue(paths.spilled)
+            self.assertEqual(list(paths.sorted_paths()), expected)
+            # The sorted paths can be read more than once
+            self.assertEqual(list(paths), expected)
+        finally:
+            paths.close()
+
+    def test_compare_inventories_on_disk(self):
+        files_in_dir = ['directory/file-%d' % number for number in range(3000)]
+        files_in_archive = ['parent/' + path for path in files_in_dir[1:]] + ['parent/extra']
+        difference = tarcheck.compare_inventories(files_in_dir, files_in_archive, max_memory=4096)
+        self.assertEqual(difference, tarcheck.InventoryDifference(1, ['directory/file-0'], ['extra'], 1, 1))
+
+    def test_verify_archive_with_little_memory(self):
+        archive_path = 'test-cases/test-diff-content/test-data.tar.bz2'
+        dir_path = 'test-cases/test-diff-content/test-data'
+        self.assertEqual(tarcheck.verify_archive_members(
+            tarcheck.iter_archive_members(archive_path), dir_path, inventory_memory=1),
+            tarcheck.verify_archive(archive_path, dir_path))
+
+    def test_memory_usage(self):
+        self.assertGreater(tarcheck.memory_usage()['hwm'], 0)
+
+
+class TestFileResults(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.iter_verify_archive` and the results it gives.
+    """
+    archive_path = 'test-cases/test-diff-content/test-data.tar.bz2'
+    dir_path = 'test-cases/test-diff-content/test-data'
+
+    def test_results(self):
+        summary = tarcheck.VerificationSummary()
+        results = list(tarcheck.iter_verify_archive(self.archive_path, self.dir_path, jobs=2, summary=summary))
+        self.assertEqual([result.path for result in results], [
+            'test-data/pip.txt', 'test-data/pip2.txt', 'test-data/smth.err', 'test-data/dir2/smthelse.err',
+            'test-data/dir2/pip-freeze.txt'])
+        different = results[0]
+        self.assertEqual(different.status, tarcheck.RESULT_DIFFERENT)
+        self.assertEqual(different.error, 'test-data/pip.txt size 16 != 15')
+        self.assertEqual(different.metadata_differences, [('size', 16, 15)])
+        # The raw files of different sizes aren't checksummed, though the archived files are
+        self.assertEqual((different.raw_digest, different.raw_seconds), (None, None))
+        self.assertIsNotNone(different.archived_digest)
+
+        same = results[1]
+        self.assertEqual(same.status, tarcheck.RESULT_OK)
+        self.assertEqual(same.size, 1623)
+        self.assertEqual(same.archived_digest, same.raw_digest)
+        self.assertIsNone(same.error)
+        self.assertTrue(same.archive_seconds >= 0 and same.raw_seconds >= 0)
+
+        self.assertEqual(summary.total_files, 5)
+        self.assertEqual(summary.report, "All files in the directory are in the archive")
+        self.assertEqual(tarcheck.collect_errors(results, summary), tarcheck.verify_archive(
+            self.archive_path, self.dir_path))
+
+    def test_results_given_as_members_are_read(self):
+        read = []
+
+        def members():
+            for member in tarcheck.iter_archive_members(self.archive_path):
+                read.append(member.path)
+                yield member
+        results = tarcheck.iter_verify_archive_members(members(), self.dir_path)
+        self.assertEqual(next(results).path, 'test-data/pip.txt')
+        # Only the members up to the first file were read
+        self.assertEqual(read[-1], 'test-data/pip.txt')
+        self.assertEqual(len(list(results)), 4)
+
+    def test_metadata_different(self):
+        result = tarcheck.FileResult(
+            'a.txt', 4, tarcheck.RESULT_METADATA_DIFFERENT, None, None, [('mtime', 1000, 2000)],
+            'a.txt mtime 1000 != 2000', 0.5, None)
+        self.assertEqual(json.loads(tarcheck.format_result_json(result)), {
+            'type': 'file', 'path': 'a.txt', 'size': 4, 'status': 'metadata different', 'archived_digest': None,
+            'raw_digest': None, 'metadata_differences': {'mtime': {'raw': 1000, 'archived': 2000}},
+            'error': 'a.txt mtime 1000 != 2000', 'archive_seconds': 0.5, 'raw_seconds': None})
+
+
+class TestKeepGoingAndFailFast(unittest.TestCase):
+    """
+    Unit tests for verifying archives with `keep_going` and `fail_fast`.
+    """
+    archive_path = 'test-cases/test-same-content/test-data.tar.bz2'
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.dir_path = os.path.join(self.temp_directory, 'test-data')
+        shutil.copytree('test-cases/test-same-content/test-data', self.dir_path)
+        # A raw file missing, and one that isn't a file
+        os.remove(os.path.join(self.dir_path, 'pip.txt'))
+        os.remove(os.path.join(self.dir_path, 'smth.err'))
+        os.mkdir(os.path.join(self.dir_path, 'smth.err'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_missing_raw_file_raises(self):
+        self.assertRaises(ValueError, tarcheck.verify_archive, self.archive_path, self.dir_path)
+
+    def test_keep_going(self):
+        for jobs in (1, 2):
+            summary = tarcheck.VerificationSummary()
+            results = list(tarcheck.iter_verify_archive(
+                self.archive_path, self.dir_path, jobs=jobs, keep_going=True, summary=summary))
+            self.assertEqual([(result.path, result.status) for result in results], [
+                ('test-data/pip.txt', tarcheck.RESULT_MISSING), ('test-data/pip2.txt', tarcheck.RESULT_OK),
+                ('test-data/smth.err', tarcheck.RESULT_UNREADABLE), ('test-data/dir2/smthelse.err', tarcheck.RESULT_OK),
+                ('test-data/dir2/pip-freeze.txt', tarcheck.RESULT_OK)])
+            self.assertEqual(results[0].error, 'test-data/pip.txt is missing from the directory')
+            self.assertEqual(results[2].error, "test-data/smth.err can't be read: not a readable file")
+            self.assertEqual(summary.total_files, 5)
+            self.assertFalse(summary.stopped)
+            self.assertIsNotNone(summary.report)
+
+    def test_keep_going_journaled(self):
+        journal_path = os.path.join(self.temp_directory, 'test-data.tar.bz2.journal')
+        journal = tarcheck.VerificationJournal(journal_path, self.archive_path, self.dir_path)
+        expected = tarcheck.verify_archive(self.archive_path, self.dir_path, keep_going=True, journal=journal)
+        journal.close()
+        journal = tarcheck.VerificationJournal(journal_path, self.archive_path, self.dir_path, resume=True)
+        self.assertEqual(journal.total_files, 5)
+        self.assertEqual(journal.errors, expected[1])
+        journal.close()
+
+    def test_fail_fast(self):
+        manifest_path = os.path.join(self.temp_directory, 'test-data.tar.bz2.manifest')
+        summary = tarcheck.VerificationSummary()
+        results = list(tarcheck.iter_verify_archive(
+            self.archive_path, self.dir_path, manifest_path=manifest_path, fail_fast=True, summary=summary))
+        self.assertEqual([(result.path, result.status) for result in results], [
+            ('test-data/pip.txt', tarcheck.RESULT_MISSING)])
+        self.assertTrue(summary.stopped)
+        self.assertEqual(summary.total_files, 1)
+        self.assertIsNone(summary.report)
+        # The archive wasn't read to its end
+        self.assertFalse(os.path.exists(manifest_path))
+
+        # Without anything missing, the first file that differs stops the verification
+        with open(os.path.join(self.dir_path, 'pip.txt'), 'w') as raw_file:
+            raw_file.write('Not pip')
+        os.rmdir(os.path.join(self.dir_path, 'smth.err'))
+        shutil.copy('test-cases/test-same-content/test-data/smth.err', self.dir_path)
+        with open(os.path.join(self.dir_path, 'pip2.txt'), 'a') as raw_file:
+            raw_file.write('More pip')
+        total_files, errors, report = tarcheck.verify_archive(self.archive_path, self.dir_path, fail_fast=True)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('test-data/pip.txt size 7 != '))
+        self.assertIsNone(report)
+
+
+class TestRawFilePrefetcher(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.RawFilePrefetcher`.
+    """
+    def setUp(self):
+        self.read_ahead_raw_file = tarcheck.read_ahead_raw_file
+        self.read_ahead = []
+        tarcheck.read_ahead_raw_file = lambda raw_file_path, size: self.read_ahead.append(raw_file_path)
+
+    def tearDown(self):
+        tarcheck.read_ahead_raw_file = self.read_ahead_raw_file
+
+    class DeferredPool(object):
+        """
+        Runs the read-aheads when told to, rather than in threads of its own.
+        """
+        def __init__(self):
+            self.pending = []
+
+        def apply_async(self, function, args):
+            self.pending.append((function, args))
+
+        def run_pending(self):
+            pending, self.pending = self.pending, []
+            for function, args in pending:
+                function(*args)
+
+        def terminate(self):
+            pass
+
+        def join(self):
+            pass
+
+    @staticmethod
+    def _raw_files(*files):
+        return dict((name, (name, os.stat_result((0o100644, inode, 1, 1, 0, 0, size, 0, 0, 0))))
+                    for name, inode, size in files)
+
+    def _prefetcher(self, *args, **kwargs):
+        prefetcher = tarcheck.RawFilePrefetcher(*args, **kwargs)
+        prefetcher.close()
+        prefetcher._pool = self.DeferredPool()
+        return prefetcher
+
+    def test_look_ahead(self):
+        raw_files = self._raw_files(('a', 3, 10), ('b', 2, 10), ('c', 1, 10), ('huge', 4, 1000))
+        prefetcher = self._prefetcher(4, max_bytes=100, jobs=1)
+        items = prefetcher.look_ahead(['a', 'b', 'huge', 'cached', 'c'], raw_files.get)
+        self.assertEqual(next(items), 'a')
+        # The files are read ahead in the order of their inodes within each batch - but for those given already
+        prefetcher._pool.run_pending()
+        self.assertEqual(self.read_ahead, ['b'])
+        self.assertEqual([next(items), next(items)], ['b', 'huge'])
+        prefetcher._pool.run_pending()
+        self.assertEqual(list(items), ['cached', 'c'])
+        # The files bigger than the memory allowed aren't read ahead
+        self.assertEqual(self.read_ahead, ['b', 'c'])
+
+    def test_read_ahead_bounded(self):
+        names = ['file-%d' % number for number in range(20)]
+        raw_files = self._raw_files(*[(name, number, 10) for number, name in enumerate(names)])
+        prefetcher = self._prefetcher(4, max_bytes=1000, jobs=1)
+        items = prefetcher.look_ahead(names, raw_files.get)
+        self.assertEqual([next(items) for _ in range(10)], names[:10])
+        # The reads have fallen behind: no more than the look-ahead are waiting
+        self.assertEqual(len(prefetcher._pool.pending), 4)
+        prefetcher._pool.run_pending()
+        self.assertEqual(self.read_ahead, [])
+        # Their places are free again once they have been done
+        self.assertEqual(list(items), names[10:])
+        self.assertEqual(len(prefetcher._pool.pending), 4)
+
+    def test_checksum_cache_looked_up_once(self):
+        archive_path = 'test-cases/test-same-content/test-data.tar.bz2'
+        dir_path = 'test-cases/test-same-content/test-data'
+        temp_directory = tempfile.mkdtemp()
+        try:
+            checksum_cache = tarcheck.ChecksumCache(os.path.join(temp_directory, 'checksums.sqlite'))
+            looked_up = []
+            get = checksum_cache.get
+            checksum_cache.get = lambda raw_file_stat, *args: looked_up.append(raw_file_stat) or get(
+                raw_file_stat, *args)
+            for _ in range(2):
+                del looked_up[:]
+                self.assertEqual(tarcheck.verify_archive(
+                    archive_path, dir_path, checksum_cache=checksum_cache, prefetch_files=10)[1], [])
+                self.assertEqual(len(looked_up), len(set(looked_up)))
+                self.assertTrue(looked_up)
+            checksum_cache.close()
+        finally:
+            shutil.rmtree(temp_directory)
+
+    def test_verify_archive_reading_ahead(self):
+        tarcheck.read_ahead_raw_file = self.read_ahead_raw_file
+        archive_path = 'test-cases/test-diff-content/test-data.tar.bz2'
+        dir_path = 'test-cases/test-diff-content/test-data'
+        expected = tarcheck.verify_archive(archive_path, dir_path)
+        for jobs in (1, 2):
+            for prefetch_files in (1, 10):
+                self.assertEqual(tarcheck.verify_archive(
+                    archive_path, dir_path, jobs=jobs, prefetch_files=prefetch_files), expected)
+
+    def test_read_ahead_raw_file(self):
+        tarcheck.read_ahead_raw_file = self.read_ahead_raw_file
+        tarcheck.read_ahead_raw_file('test-cases/test-same-content/test-data/pip.txt', 13)
+        # Failures are left for when the file is checksummed
+        tarcheck.read_ahead_raw_file('test-cases/test-same-content/test-data/missing.txt', 13)
+
+
+class TestCreateArchive(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.create_archive` and `tarcheck.verify_archive_against_manifest`.
+    """
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.dir_path = os.path.join(self.temp_directory, 'test-data')
+        shutil.copytree('test-cases/test-same-content/test-data', self.dir_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def _create(self, name, **kwargs):
+        archive_path = os.path.join(self.temp_directory, name)
+        self.assertEqual(tarcheck.create_archive(archive_path, self.dir_path, **kwargs), 5)
+        return archive_path
+
+    def test_create_and_verify(self):
+        for name in ('test-data.tar', 'test-data.tar.gz', 'test-data.tar.bz2'):
+            archive_path = self._create(name, compressor=tarcheck.TARFILE_DECOMPRESSOR)
+            manifest_path = archive_path + '.manifest'
+            self.assertEqual(tarcheck.verify_archive_against_manifest(archive_path, manifest_path), (5, []))
+            # The manifest has what a verification of the archive would have written
+            self.assertEqual(list(tarcheck.read_manifest_members(manifest_path)),
+                             list(tarcheck.iter_archive_members(archive_path)))
+            self.assertTrue(tarcheck.manifest_matches_archive(
+                tarcheck.read_manifest_header(manifest_path), archive_path, check_archive_checksum=True))
+            self.assertEqual(tarcheck.verify_archive_with_manifest(manifest_path, self.dir_path, archive_path),
+                             (5, [], "All files in the directory are in the archive"))
+        self.assertEqual(tarcheck.get_all_files_in_archive(archive_path), [
+            'test-data', 'test-data/dir2', 'test-data/dir2/pip-freeze.txt', 'test-data/dir2/smthelse.err',
+            'test-data/pip.txt', 'test-data/pip2.txt', 'test-data/smth.err'])
+
+    @unittest.skipUnless(find_executable('xz'), "xz is not installed")
+    def test_create_with_external_compressor(self):
+        archive_path = self._create('test-data.tar.xz', compress_jobs=2)
+        self.assertEqual(tarcheck.detect_compression(archive_path), 'xz')
+        self.assertEqual(tarcheck.verify_archive_against_manifest(archive_path, archive_path + '.manifest'), (5, []))
+
+    def test_create_with_exclusions_and_hard_links(self):
+        os.link(os.path.join(self.dir_path, 'pip.txt'), os.path.join(self.dir_path, 'pip-link.txt'))
+        archive_path = os.path.join(self.temp_directory, 'test-data.tar')
+        manifest_path = os.path.join(self.temp_directory, 'manifest')
+        self.assertEqual(tarcheck.create_archive(
+            archive_path, self.dir_path, manifest_path, exclude_wildcard=['*/dir2']), 3)
+        members = list(tarcheck.read_manifest_members(manifest_path))
+        self.assertEqual([(member.path, member.type) for member in members], [
+            ('test-data', tarcheck.DIRECTORY_MEMBER), ('test-data/pip-link.txt', tarcheck.FILE_MEMBER),
+            ('test-data/pip.txt', tarcheck.HARDLINK_MEMBER), ('test-data/pip2.txt', tarcheck.FILE_MEMBER),
+            ('test-data/smth.err', tarcheck.FILE_MEMBER)])
+        self.assertEqual(tarcheck.verify_archive_against_manifest(archive_path, manifest_path), (3, []))
+
+    def test_exclusions_match_archive_paths(self):
+        # As when verifying the archive, the rules are matched on the paths in the archive
+        archive_path = os.path.join(self.temp_directory, 'test-data.tar')
+        self.assertEqual(tarcheck.create_archive(
+            archive_path, self.dir_path, exclude_wildcard=['dir2'], exclude_regex=['test-data/smth']), 4)
+        self.assertEqual(tarcheck.get_all_files_in_archive(archive_path), [
+            'test-data', 'test-data/dir2', 'test-data/dir2/pip-freeze.txt', 'test-data/dir2/smthelse.err',
+            'test-data/pip.txt', 'test-data/pip2.txt'])
+
+    def test_create_in_archived_directory(self):
+        manifest_path = os.path.join(self.dir_path, 'dir2', 'test-data.manifest')
+        with open(manifest_path, 'w') as manifest:
+            manifest.write('An earlier manifest\n')
+        archive_path = os.path.join(self.dir_path, 'test-data.tar.gz')
+        self.assertEqual(tarcheck.create_archive(
+            archive_path, self.dir_path, manifest_path, compressor=tarcheck.TARFILE_DECOMPRESSOR), 5)
+        self.assertEqual(tarcheck.get_all_files_in_archive(archive_path), [
+            'test-data', 'test-data/dir2', 'test-data/dir2/pip-freeze.txt', 'test-data/dir2/smthelse.err',
+            'test-data/pip.txt', 'test-data/pip2.txt', 'test-data/smth.err'])
+        self.assertEqual(tarcheck.verify_archive_against_manifest(archive_path, manifest_path), (5, []))
+
+    def test_existing_archive_not_overwritten(self):
+        archive_path = self._create('test-data.tar')
+        with open(archive_path, 'rb') as archive:
+            contents = archive.read()
+        self.assertRaises(ValueError, tarcheck.create_archive, archive_path, self.dir_path)
+        with open(archive_path, 'rb') as archive:
+            self.assertEqual(archive.read(), contents)
+
+    def test_archive_removed_if_not_written(self):
+        archive_path = os.path.join(self.temp_directory, 'test-data.tar.gz')
+        find_external_compressor = tarcheck.find_external_compressor
+        # A compressor that fails
+        tarcheck.find_external_compressor = lambda compression, jobs: ['sh', '-c', 'cat > /dev/null; exit 1']
+        try:
+            self.assertRaises(IOError, tarcheck.create_archive, archive_path, self.dir_path,
+                              compressor=tarcheck.EXTERNAL_DECOMPRESSOR)
+        finally:
+            tarcheck.find_external_compressor = find_external_compressor
+        self.assertFalse(os.path.exists(archive_path))
+        self.assertFalse(os.path.exists(archive_path + '.manifest'))
+        self.assertEqual(self._create('test-data.tar.gz', compressor=tarcheck.TARFILE_DECOMPRESSOR), archive_path)
+
+    def test_read_back_differences(self):
+        archive_path = self._create('test-data.tar')
+        manifest_path = archive_path + '.manifest'
+        with open(manifest_path) as manifest:
+            lines = manifest.readlines()
+        # A file with another checksum, and a member missing
+        lines[3] = lines[3].replace('"digest": "', '"digest": "0')
+        lines.append(lines[-1].replace('smth.err', 'smth2.err'))
+        with open(manifest_path, 'w') as manifest:
+            manifest.writelines(lines)
+        total_files, errors = tarcheck.verify_archive_against_manifest(archive_path, manifest_path)
+        self.assertEqual(total_files, 5)
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0].startswith('test-data/dir2/pip-freeze.txt '))
+        self.assertEqual(errors[1], 'test-data/smth2.err is missing from the archive')
+
+        with open(archive_path, 'r+b') as archive:
+            archive.seek(0, 2)
+            archive.write('\0' * 512)
+        _, errors = tarcheck.verify_archive_against_manifest(archive_path, manifest_path)
+        self.assertTrue(errors[-1].startswith('The checksum of the archive '))
+
+
+class TestCompareArchives(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.compare_archives`.
+    """
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.dir_path = os.path.join(self.temp_directory, 'test-data')
+        shutil.copytree('test-cases/test-same-content/test-data', self.dir_path)
+        self.archive_path = os.path.join(self.temp_directory, 'test-data.tar')
+        tarcheck.create_archive(self.archive_path, self.dir_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def _repack(self, name, mode='w', reverse=False, arcname=lambda path: path):
+        """
+        Repacks the archive with its members in another order or under other names.
+        """
+        repacked_path = os.path.join(self.temp_directory, name)
+        paths = sorted(tarcheck.get_all_files_in_archive(self.archive_path), reverse=reverse)
+        with tarfile.open(repacked_path, mode) as tar:
+            for path in paths:
+                tar.add(os.path.join(self.temp_directory, path), arcname(path), recursive=False)
+        return repacked_path
+
+    def test_same_members(self):
+        for repacked_path in (self._repack('same.tar.gz', 'w:gz'), self._repack('reversed.tar', reverse=True),
+                              self._repack('dotted.tar', arcname=lambda path: './' + path)):
+            self.assertEqual(tarcheck.compare_archives(self.archive_path, repacked_path),
+                             (5, [], "The archives have the same members"))
+
+    def test_differences(self):
+        with open(os.path.join(self.dir_path, 'pip.txt'), 'a') as raw_file:
+            raw_file.write('more')
+        os.remove(os.path.join(self.dir_path, 'smth.err'))
+        with open(os.path.join(self.dir_path, 'new.txt'), 'w') as raw_file:
+            raw_file.write('new')
+        other_path = os.path.join(self.temp_directory, 'other.tar')
+        tarcheck.create_archive(other_path, self.dir_path)
+        total_files, errors, report = tarcheck.compare_archives(self.archive_path, other_path)
+        self.assertEqual(total_files, 5)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('test-data/pip.txt size '))
+        self.assertEqual(report.splitlines(), [
+            "Some members of %s are missing from %s: ['test-data/smth.err']" % (self.archive_path, other_path),
+            "Some members of %s are missing from %s: ['test-data/new.txt']" % (other_path, self.archive_path)])
+        # The excluded members aren't compared
+        self.assertEqual(tarcheck.compare_archives(
+            self.archive_path, other_path, exclude_wildcard=['*.txt', '*.err']),
+            (0, [], "The archives have the same members"))
+
+    def test_unmatched_members_on_disk(self):
+        repacked_path = self._repack('reversed.tar', reverse=True)
+        self.assertEqual(tarcheck.compare_archives(self.archive_path, repacked_path, max_memory=1),
+                         (5, [], "The archives have the same members"))
+        other_path = self._repack('renamed.tar', arcname=lambda path: path.replace('pip', 'pop'))
+        self.assertEqual(tarcheck.compare_archives(self.archive_path, other_path, max_memory=1)[2].splitlines(), [
+            "Some members of %s are missing from %s: ['test-data/dir2/pip-freeze.txt', 'test-data/pip.txt', "
+            "'test-data/pip2.txt']" % (self.archive_path, other_path),
+            "Some members of %s are missing from %s: ['test-data/dir2/pop-freeze.txt', 'test-data/pop.txt', "
+            "'test-data/pop2.txt']" % (other_path, self.archive_path)])
+
+    def test_unmatched_members(self):
+        unmatched = tarcheck.UnmatchedMembers(max_memory=1000)
+        members = [tarcheck.ArchiveMember('dir/%d' % i, tarcheck.FILE_MEMBER, i, 0, '', 'digest') for i in range(4)]
+        for member in members:
+            unmatched.put(member)
+        self.assertEqual(unmatched.pop('dir/1'), members[1])
+        self.assertIsNone(unmatched.pop('dir/1'))
+        self.assertEqual(list(unmatched.paths()), ['dir/0', 'dir/2', 'dir/3'])
+        self.assertEqual(len(unmatched), 3)
+        unmatched.close()
+
+    def test_unmatched_members_with_the_same_path(self):
+        for max_memory in (10000, 1):
+            unmatched = tarcheck.UnmatchedMembers(max_memory=max_memory)
+            members = [tarcheck.ArchiveMember('dir/a', tarcheck.FILE_MEMBER, i, 0, '', 'digest') for i in range(3)]
+            for member in members:
+                unmatched.put(member)
+            self.assertEqual(list(unmatched.paths()), ['dir/a'] * 3)
+            # In the order they were kept in
+            self.assertEqual([unmatched.pop('dir/a') for _ in range(4)], members + [None])
+            self.assertEqual(len(unmatched), 0)
+            unmatched.close()
+
+    def test_duplicate_paths(self):
+        duplicated_path = self._repack('duplicated.tar')
+        with tarfile.open(duplicated_path, 'a') as tar:
+            tar.add(os.path.join(self.dir_path, 'pip.txt'), 'test-data/pip.txt')
+        for max_memory in (tarcheck.INVENTORY_MEMORY, 1):
+            total_files, errors, report = tarcheck.compare_archives(
+                self.archive_path, duplicated_path, max_memory=max_memory)
+            self.assertEqual((total_files, errors), (5, []))
+            self.assertEqual(report.splitlines(), [
+                "Some members of %s are missing from %s: ['test-data/pip.txt']" % (duplicated_path, self.archive_path),
+                "Some paths are more than once in %s: ['test-data/pip.txt']" % duplicated_path])
+        # Each member with the path is matched with one in the other archive
+        reversed_path = self._repack('reversed.tar', reverse=True)
+        with tarfile.open(reversed_path, 'a') as tar:
+            tar.add(os.path.join(self.dir_path, 'pip.txt'), './test-data/pip.txt')
+        self.assertEqual(tarcheck.compare_archives(duplicated_path, reversed_path), (6, [], "\n".join(
+            "Some paths are more than once in %s: ['test-data/pip.txt']" % path
+            for path in (duplicated_path, reversed_path))))
+
+    def test_exclusions_on_normalised_paths(self):
+        dotted_path = self._repack('dotted.tar', arcname=lambda path: './' + path)
+        for exclusions in ({'exclude_wildcard': ['test-data/dir2', 'test-data/*.err']},
+                           {'exclude_regex': [r'test-data/(dir2|smth\.err)']}):
+            self.assertEqual(tarcheck.compare_archives(self.archive_path, dotted_path, **exclusions),
+                             (2, [], tarcheck.SAME_MEMBERS))
+
+    def test_listed_paths_capped(self):
+        other_path = self._repack('renamed.tar', arcname=lambda path: path.replace('pip', 'pop'))
+        self.assertEqual(tarcheck.compare_archives(self.archive_path, other_path, max_listed=1)[2].splitlines(), [
+            "Some members of %s are missing from %s: ['test-data/dir2/pip-freeze.txt'] and 2 more" % (
+                self.archive_path, other_path),
+            "Some members of %s are missing from %s: ['test-data/dir2/pop-freeze.txt'] and 2 more" % (
+                other_path, self.archive_path)])
+
+    def test_archive_errors(self):
+        with self.assertRaises(IOError):
+            tarcheck.compare_archives(self.archive_path, os.path.join(self.temp_directory, 'nonexistent.tar'))
+
+
+class TestMemberSample(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.MemberSample` and verifying a sample of the files of an archive.
+    """
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.dir_path = os.path.join(self.temp_directory, 'data')
+        os.mkdir(self.dir_path)
+        for number in range(200):
+            with open(os.path.join(self.dir_path, 'file%d.txt' % number), 'w') as raw_file:
+                raw_file.write('file %d\n' % number)
+        self.archive_path = os.path.join(self.temp_directory, 'data.tar')
+        with tarfile.open(self.archive_path, 'w') as tar:
+            tar.add(self.dir_path, 'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def _members(self, sizes):
+        return [tarcheck.ArchiveMember('dir/%d' % number, tarcheck.FILE_MEMBER, size, 0, '', None)
+                for number, size in enumerate(sizes)]
+
+    def test_seeded_sample(self):
+        members = self._members([10] * 1000)
+        sampled = [member.path for member in tarcheck.MemberSample(0.1, seed=1).select(members)]
+        self.assertTrue(50 < len(sampled) < 150)
+        # The same seed gives the same sample, in any order
+        self.assertEqual(sorted(member.path for member in tarcheck.MemberSample(0.1, seed=1).select(
+            reversed(members))), sorted(sampled))
+        self.assertNotEqual([member.path for member in tarcheck.MemberSample(0.1, seed=2).select(members)], sampled)
+        # Only files are sampled
+        sample = tarcheck.MemberSample(1)
+        self.assertTrue(sample.is_sampled(members[0]))
+        self.assertFalse(sample.is_sampled(members[0]._replace(type=tarcheck.HARDLINK_MEMBER)))
+        self.assertFalse(sample.is_sampled(members[0]._replace(type=tarcheck.DIRECTORY_MEMBER)))
+        self.assertRaises(ValueError, tarcheck.MemberSample, 0)
+        self.assertRaises(ValueError, tarcheck.MemberSample, 1.5)
+
+    def test_sample_by_bytes(self):
+        sample = tarcheck.MemberSample(0.001, by_bytes=True)
+        small_files = len(list(sample.select(self._members([10] * 1000))))
+        large_files = len(list(sample.select(self._members([10000] * 1000))))
+        self.assertTrue(small_files < 50 < 900 < large_files)
+        self.assertEqual((sample.total_files, sample.total_bytes), (2000, 10010000))
+        self.assertEqual(sample.sampled_bytes, small_files * 10 + large_files * 10000)
+        # Empty files have no bytes to sample
+        self.assertEqual(list(tarcheck.MemberSample(1, by_bytes=True).select(self._members([0, 1]))),
+                         self._members([0, 1])[1:])
+
+    def test_missed_bound(self):
+        sample = tarcheck.MemberSample(0.1)
+        sample.total_files, sample.sampled_files = 300, 30
+        # With none found, more than 28 differing files would all be missed less than 5% of the time: 0.9 ** 29 < 0.05
+        self.assertEqual(sample.get_missed_bound(0), (28, 28 / 300.0))
+        self.assertEqual(sample.get_missed_bound(0, confidence=0.99)[0], 43)
+        self.assertTrue(sample.get_missed_bound(2)[0] > 28)
+        # There can't be more missed than files out of the sample
+        self.assertEqual(sample.get_missed_bound(100), (270, 0.9))
+        self.assertRaises(ValueError, sample.get_missed_bound, 0, 1)
+        self.assertEqual(tarcheck.MemberSample(1).get_missed_bound(0), (0, 0.0))
+        self.assertIn("Sampled 30 of 300 files", sample.format_report(0))
+
+    def test_verify_sample(self):
+        manifest_path = os.path.join(self.temp_directory, 'manifest')
+        tarcheck.verify_archive(self.archive_path, self.dir_path, manifest_path=manifest_path)
+        sampled_paths = set(member.path for member in tarcheck.MemberSample(0.2, seed=3).select(
+            tarcheck.iter_archive_members(self.archive_path)))
+        # The raw files out of the sample aren't looked at, nor the inventory checked
+        for number in range(200):
+            if 'data/file%d.txt' % number not in sampled_paths:
+                os.remove(os.path.join(self.dir_path, 'file%d.txt' % number))
+        os.mkdir(os.path.join(self.dir_path, 'not-in-archive'))
+        index = tarcheck.ArchiveIndex.build(self.archive_path, tarcheck.get_default_index_path(self.archive_path))
+        for kwargs in ({}, {'index': index}, {'jobs': 2}):
+            sample = tarcheck.MemberSample(0.2, seed=3)
+            summary = tarcheck.VerificationSummary()
+            results = list(tarcheck.iter_verify_archive(
+                self.archive_path, self.dir_path, summary=summary, sample=sample, **kwargs))
+            self.assertEqual(set(result.path for result in results), sampled_paths)
+            self.assertEqual(set(result.status for result in results), set([tarcheck.RESULT_OK]))
+            self.assertIsNone(summary.report)
+            self.assertEqual((sample.total_files, sample.sampled_files), (200, len(sampled_paths)))
+        index.close()
+        self.assertEqual(tarcheck.verify_archive_with_manifest(
+            manifest_path, self.dir_path, sample=tarcheck.MemberSample(0.2, seed=3)), (len(sampled_paths), [], None))
+
+        # A differing file in the sample is found
+        path = sorted(sampled_paths)[0]
+        with open(os.path.join(self.temp_directory, path), 'a') as raw_file:
+            raw_file.write('more')
+        total_files, errors, report = tarcheck.verify_archive(
+            self.archive_path, self.dir_path, sample=tarcheck.MemberSample(0.2, seed=3))
+        self.assertEqual((total_files, len(errors)), (len(sampled_paths), 1))
+        self.assertTrue(errors[0].startswith(path))
+
+
+class TestExitStatus(unittest.TestCase):
+    """
+    Tests for the exit status of a verification run from the command line.
+    """
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.dir_path = os.path.join(self.temp_directory, 'test-data')
+        shutil.copytree('test-cases/test-same-content/test-data', self.dir_path)
+        self.archive_path = 'test-cases/test-same-content/test-data.tar.bz2'
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def _run(self, *args):
+        process = subprocess.Popen([sys.executable, 'tarcheck.py', '--tar_path', self.archive_path,
+                                    '--dir', self.dir_path] + list(args), stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def test_same_content(self):
+        self.assertEqual(self._run()[0], 0)
+
+    def test_different_content(self):
+        with open(os.path.join(self.dir_path, 'pip.txt'), 'a') as f:
+            f.write('changed')
+        self.assertEqual(self._run()[0], 1)
+
+    def test_missing_raw_file(self):
+        os.remove(os.path.join(self.dir_path, 'pip.txt'))
+        self.assertEqual(self._run()[0], 1)
+
+    def test_jsonl_error(self):
+        os.remove(os.path.join(self.dir_path, 'pip.txt'))
+        returncode, output = self._run('--format', 'jsonl')
+        self.assertEqual(returncode, 1)
+        # Every line is still JSON, with the error and then the summary last:
+        records = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([record['type'] for record in records[-2:]], ['error', 'summary'])
+        self.assertTrue(records[-2]['error'].startswith("ERROR: "))
+        self.assertEqual(records[-1]['error'], records[-2]['error'])
+
+    def test_file_not_in_archive(self):
+        with open(os.path.join(self.dir_path, 'extra.txt'), 'w') as f:
+            f.write('extra')
+        self.assertEqual(self._run()[0], 1)
+
+    def test_error(self):
+        self.archive_path = os.path.join(self.temp_directory, 'missing.tar.bz2')
+        self.assertEqual(self._run()[0], 1)
+
+    def test_batch(self):
+        batch_path = os.path.join(self.temp_directory, 'batch.txt')
+        with open(batch_path, 'w') as f:
+            f.write('%s\t%s\n' % (self.archive_path, self.dir_path))
+        batch = [sys.executable, 'tarcheck.py', '--batch', batch_path]
+        with open(os.devnull, 'w') as devnull:
+            self.assertEqual(subprocess.call(batch, stdout=devnull), 0)
+            with open(batch_path, 'a') as f:
+                f.write('test-cases/test-diff-content/test-data.tar.bz2\ttest-cases/test-diff-content/test-data\n')
+            self.assertEqual(subprocess.call(batch, stdout=devnull), 1)
+
+
+class TestStats(unittest.TestCase):
+    """
+    Unit tests for `tarcheck.Stats`.
+    """
+    def tearDown(self):
+        tarcheck.STATS.enable(False)
+        tarcheck.STATS.reset()
+
+    def test_nothing_is_collected_when_disabled(self):
+        stats = tarcheck.Stats()
+        with stats.stage('checksum', 10):
+            pass
+        items = [1, 2]
+        self.assertIs(stats.timed(items, 'read'), items)
+        self.assertEqual(stats.report()['stages'], {})
+
+    def test_size_is_not_kept_when_disabled(self):
+        tarcheck.checksum_raw_file('test-cases/test-same-content/test-data/pip.txt', ['md5'])
+        tarcheck._TimedReader(io.BytesIO(b'data')).read()
+        with tarcheck.Stats().stage('checksum') as stage:
+            stage.size = 10
+        # The stage stood in by every thread when disabled is left as it was:
+        self.assertEqual(vars(tarcheck._NO_STAGE), {})
+        self.assertEqual(tarcheck._NO_STAGE.size, 0)
+
+    def test_nested_stages_are_timed_exclusively(self):
+        stats = tarcheck.Stats()
+        stats.enable()
+        with stats.stage('outer'):
+            time.sleep(0.05)
+            with stats.stage('inner') as inner:
+                time.sleep(0.1)
+                inner.size = 2 ** 20
+        stages = stats.report()['stages']
+        self.assertTrue(0.04 <= stages['outer']['seconds'] < 0.1)
+        self.assertTrue(stages['inner']['seconds'] >= 0.09)
+        self.assertEqual(stages['inner']['bytes'], 2 ** 20)
+        self.assertEqual(stages['inner']['calls'], 1)
+        self.assertTrue(stages['inner']['mb_per_s'] > 0)
+        self.assertIsNone(stages['outer']['mb_per_s'])
+
+    def test_timed_iterable_counts_each_item(self):
+        stats = tarcheck.Stats()
+        stats.enable()
+        self.assertEqual(list(stats.timed(iter([1, 2, 3]), 'read')), [1, 2, 3])
+        # The last call finds that there are no more items
+        self.assertEqual(stats.report()['stages']['read']['calls'], 4)
+
+    def test_stages_of_a_verification(self):
+        tarcheck.STATS.enable()
+        tarcheck.STATS.reset()
+        total_files, errors, _ = tarcheck.verify_archive(
+            'test-cases/test-same-content/test-data.tar.bz2', 'test-cases/test-same-content/test-data', jobs=2)
+        self.assertEqual((total_files, errors), (5, []))
+        report = tarcheck.STATS.report()
+        stages = report['stages']
+        for name in ('decompress', 'archive_headers', 'archive_checksum', 'raw_checksum', 'raw_wait', 'scan',
+                     'inventory'):
+            self.assertIn(name, stages)
+        self.assertEqual(stages['archive_checksum']['calls'], 5)
+        self.assertEqual(stages['raw_checksum']['calls'], 5)
+        self.assertEqual(stages['archive_checksum']['bytes'], stages['raw_checksum']['bytes'])
+        self.assertTrue(stages['decompress']['bytes'] >= stages['archive_checksum']['bytes'])
+        self.assertTrue(report['peak_rss_kb'] > 0)
+
+    def test_progress_lines(self):
+        stats = tarcheck.Stats()
+        stats.enable()
+        output = io.BytesIO()
+        stats.start_progress(0.01, output)
+        time.sleep(0.1)
+        stats.stop_progress()
+        self.assertTrue(output.getvalue().startswith('Progress: '))
+
+
 class TestSetUserDefinedLoggingLevel(unittest.TestCase):
     """
     Unit tests for `tarcheck.set_user_defined_logging_level`.